@@ -1,11 +1,18 @@
 # encoding: utf-8
 
-import requests
-from PIL import Image
 from urllib import quote
-from StringIO import StringIO
+from io import BytesIO
 
+import re
 import logging
+from urlparse import urlsplit
+
+from changes import PageMemo
+from parsecache import ParseCache
+from metrics import MetricsRegistry
+from scheduler import RequestScheduler, ScheduledSession
+from sessionstore import Heartbeat
+from transport import TransportConfig, TunedAdapter, accept_encoding, default_endpoint
 
 
 class BaseWebScraping(object):
@@ -18,11 +25,50 @@ class BaseWebScraping(object):
     ses : requests.Session
     url_prefix : str
     logger : logging.Logger
+    scheduler : RequestScheduler
+        Per-host request pacing, shared by all instances unless replaced
+        before refresh_session.
+    throttle_markers : tuple of str
+        Encoded markers of the site's throttling page.
+    transport_config : TransportConfig
+        Pool sizes, timeouts and retries used by refresh_session.
+    max_image_size : int
+        Bytes, url2byte refuses larger bodies.
+    image_dump_path : str or None
+        If set, url2byte also writes the image there for debugging.
+    metrics : MetricsRegistry
+        Per-request timings and spans, shared by all instances.
+    endpoint_labels : tuple of (str, str)
+        (regex on the URL, label) pairs naming endpoints in the metrics,
+        other URLs are labelled by the last component of their path.
+    parse_cache : ParseCache
+        Parse results by parser name and body digest, shared by all instances.
+    pages : PageMemo
+        Digest, validators and parsed value of the last body of each polled page.
+    session_store : SessionStore or None
+        Where the logged in session is saved, None to log in on every start.
+    snapshots : SnapshotStore or None
+        Where the parsed pages are appended, None to keep no history.
+    log_payload_limit : int
+        Characters of a page body written to the log, see excerpt.
 
     """
+    scheduler = RequestScheduler()
+    throttle_markers = ()
+    metrics = MetricsRegistry()
+    endpoint_labels = ()
+    parse_cache = ParseCache()
+
     def __init__(self):
         self.ses = None
         self.url_prefix = ""
+        self.transport_config = TransportConfig()
+        self.max_image_size = 2 * 1024 * 1024
+        self.image_dump_path = None
+        self.pages = PageMemo(self.parse_cache)
+        self.session_store = None
+        self.snapshots = None
+        self.log_payload_limit = 2000
 
         self.logger = logging.getLogger(self.__class__.__name__)
         handler = logging.StreamHandler()
@@ -41,13 +87,101 @@ class BaseWebScraping(object):
         pass
 
     def refresh_session(self):
-        self.ses = requests.Session()
+        self.ses = ScheduledSession(self.scheduler, self.throttle_markers, self.logger)
+        self.mount(TunedAdapter(self.transport_config))
+        if self.transport_config.compress:
+            self.ses.headers['Accept-Encoding'] = ', '.join(('gzip', 'deflate'))
+
+    def mount(self, adapter):
+        """Use adapter for both http and https requests of the session."""
+        if isinstance(adapter, TunedAdapter):
+            adapter.metrics = self.metrics
+            adapter.endpoint = self.endpoint
+        self.ses.mount('http://', adapter)
+        self.ses.mount('https://', adapter)
+
+    def endpoint(self, url):
+        """Label of url in the metrics."""
+        for ptn, label in self.endpoint_labels:
+            if re.search(ptn, url):
+                return label
+        return default_endpoint(url)
+
+    def span(self, name, endpoint=''):
+        """Context manager timing a named span into the metrics."""
+        return self.metrics.span(name, endpoint)
+
+    def connection_stats(self):
+        """Sum of the connection counters of the session's adapters."""
+        res = {'requests': 0, 'new_connections': 0, 'reused': 0}
+        for adapter in set(self.ses.adapters.values()):
+            if isinstance(adapter, TunedAdapter):
+                for k, v in adapter.connection_stats().items():
+                    res[k] += v
+        return res
+
+    def session_key(self):
+        """(site, account) of the saved session."""
+        return urlsplit(self.url_prefix).netloc, getattr(self, 'user', '')
+
+    def is_session_alive(self):
+        """One cheap request telling whether the site still knows the session, False for a login."""
+        return False
+
+    def save_session(self):
+        if self.session_store is not None:
+            site, account = self.session_key()
+            self.session_store.save(site, account, self.ses)
+
+    def resume_session(self):
+        """Load the saved session and check it, True if no login is needed."""
+        if self.session_store is None:
+            return False
+        site, account = self.session_key()
+        if not self.session_store.load(site, account, self.ses):
+            return False
+
+        if self.is_session_alive():
+            self.logger.info("Session of {} on {} restored.".format(account, site))
+            self.login_state = True
+            return True
+        self.logger.info("Saved session of {} on {} expired.".format(account, site))
+        self.session_store.delete(site, account)
+        self.ses.cookies.clear()
+        return False
+
+    def trim_session(self):
+        """
+        Drop the expired cookies of the session, the jar keeps them until asked to.
+
+        Returns
+        -------
+        size : int
+            Cookies left in the jar.
+
+        """
+        self.ses.cookies.clear_expired_cookies()
+        return len(self.ses.cookies)
+
+    def excerpt(self, text):
+        """text cut to log_payload_limit characters, a page in a log line is not kept whole."""
+        if len(text) <= self.log_payload_limit:
+            return text
+        return text[:self.log_payload_limit] + u'... [{} more characters]'.format(len(text) - self.log_payload_limit)
+
+    def start_heartbeat(self):
+        """The started Heartbeat of the session, None without a store or heartbeat."""
+        if self.session_store is None or not self.session_store.heartbeat:
+            return None
+        return Heartbeat(self, self.session_store.heartbeat).start()
 
     def update_header(self, dic):
         if not self.ses:
             return
 
         self.ses.headers.update(dic)
+        if 'Accept-Encoding' in dic:
+            self.ses.headers['Accept-Encoding'] = accept_encoding(dic['Accept-Encoding'])
 
     @staticmethod
     def _dict_to_url(d):
@@ -79,19 +213,60 @@ class BaseWebScraping(object):
         return quote(s)
 
     def show_img(self, url):
-        res = self.ses.get(url, stream=True)
-        image = Image.open(res.raw)
-        image.show()
+        from PIL import Image
 
-    def url2byte(self, url):
-        res = self.ses.get(url)#, stream=True)
-        r = StringIO(res.content)
+        image = Image.open(BytesIO(self.url2byte(url)))
+        image.show()
 
+    @staticmethod
+    def _read_body(res, max_size, chunk_size=16384):
         """
-        with open('download.jpg', 'wb') as f:
-            f.write(raw)
+        Read a streamed response into one bytearray.
+
+        The buffer is allocated once when Content-Length is known, otherwise it
+        grows in place.  Raise ValueError once the body exceeds max_size.
+
         """
-        c = r.read()
-        with open('download.jpg', 'wb') as f:
-            f.write(c)
-        return c
+        length = res.headers.get('Content-Length')
+        length = int(length) if length and not res.headers.get('Content-Encoding') else None
+        if length is not None and length > max_size:
+            raise ValueError("Body of {} is {} bytes > {}".format(res.url, length, max_size))
+
+        if length is None:
+            buf = bytearray()
+            for chunk in res.iter_content(chunk_size):
+                buf.extend(chunk)
+                if len(buf) > max_size:
+                    raise ValueError("Body of {} is larger than {} bytes".format(res.url, max_size))
+            return buf
+
+        buf = bytearray(length)
+        view = memoryview(buf)
+        pos = 0
+        for chunk in res.iter_content(chunk_size):
+            end = pos + len(chunk)
+            if end > length:
+                raise ValueError("Body of {} is longer than its Content-Length".format(res.url))
+            view[pos:end] = chunk
+            pos = end
+        del view  # a bytearray cannot be resized while viewed
+        if pos < length:
+            del buf[pos:]
+        return buf
+
+    def url2buffer(self, url):
+        """Download url in memory and return the bytearray holding its body."""
+        res = self.ses.get(url, stream=True)
+        try:
+            buf = self._read_body(res, self.max_image_size)
+        finally:
+            res.close()
+
+        if self.image_dump_path:
+            with open(self.image_dump_path, 'wb') as f:
+                f.write(buf)
+        return buf
+
+    def url2byte(self, url):
+        """Download url in memory and return its bytes, e.g. of a captcha image."""
+        return bytes(self.url2buffer(url))
@@ -0,0 +1,650 @@
+# encoding: utf-8
+
+"""
+Benchmarks of the scraping hot paths.
+
+Micro-benchmarks time single functions on canned input, end-to-end
+benchmarks time full polling iterations against the local stand-in server
+of replay.py.  Results are compared with the stored baseline::
+
+    python benchmark.py                    # run all and report against baseline
+    python benchmark.py str2dic check_res  # only benchmarks whose name starts so
+    python benchmark.py --save-baseline    # store current results as baseline
+    python benchmark.py --check            # exit 1 if any benchmark regressed
+
+"""
+import re
+import sys
+import json
+import timeit
+import logging
+import platform
+from os import path
+from collections import OrderedDict
+
+from outcome import JW_CLASSIFIER
+from scheduler import RequestScheduler
+from seatparser import parse_seat_table, parse_seat_table_soup, load_fixture
+from soak import memory_kb
+
+
+BASELINE_PATH = path.join(path.dirname(path.abspath(__file__)), 'benchmark_baseline.json')
+
+BENCHMARKS = OrderedDict()
+
+# keeps the scheduler bookkeeping in the measurements without ever waiting
+UNPACED = RequestScheduler(rate=1e9, max_rate=1e9, burst=1e9)
+
+
+def benchmark(func):
+    """Register a function yielding (name, milliseconds) pairs."""
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def best_of(func, number=10, repeat=5):
+    """Returns the best per-call time of func in milliseconds."""
+    times = timeit.repeat(func, number=number, repeat=repeat)
+    return min(times) / number * 1e3
+
+
+def quiet(scraper):
+    scraper.logger.setLevel(logging.ERROR)
+    scraper.scheduler = UNPACED
+    return scraper
+
+
+def canned_response(content, status_code=200):
+    import requests
+    res = requests.models.Response()
+    res._content = content
+    res.status_code = status_code
+    return res
+
+
+def synthetic_seats_page(n_dates=30):
+    """Build a large SeatsQuery page by repeating the rows of a recorded one."""
+    page = load_fixture('seats_query_open.html')
+    start = page.index(u'<tr bgcolor="#E0E0E0">')
+    end = page.index(u'</table>', start)
+    rows = page[start:end]
+    return page[:start] + rows * (n_dates // 2) + page[end:]
+
+
+def synthetic_submit_page(filler_kb=512, message=u'班级已满'):
+    """A course submit response with a large course table before the alert script."""
+    row = u'<tr><td>99975432</td><td>毛泽东思想和中国特色社会主义理论体系概论</td><td>仙林校区</td></tr>\n'
+    filler = row * (filler_kb * 1024 // len(row.encode('utf8')))
+    script = u'<script>function initSelectedList(){{\n{}\n alert("{}");\n}}</script>'.format(filler, message)
+    return (u'<html><body>' + filler + script + u'</body></html>').encode('utf8')
+
+
+def new_toefl_scraping(stand_in=False):
+    from grasptoefl import ToeflScraping
+    grasper = quiet(ToeflScraping())
+    grasper.refresh_session()
+    grasper.url_prefix = 'https://toefl.etest.net.cn/cn/'
+    grasper.user, grasper.password = '0123456789', 'password'
+    grasper.captcha_solver = lambda img: ('abcd', None)
+    if stand_in:
+        from replay import replay, fixture_path
+        return grasper, replay(grasper, fixture_path('toefl'), seed=0)
+    return grasper
+
+
+def new_course_grasper(stand_in=False):
+    from graspcourse import CourseGrasper
+    grasper = quiet(CourseGrasper())
+    grasper.refresh_session()
+    grasper.url_prefix = 'http://jw.nju.edu.cn/jiaowu/'
+    if stand_in:
+        from replay import replay, fixture_path
+        return grasper, replay(grasper, fixture_path('jw'), seed=0)
+    return grasper
+
+
+def _import_ms(module):
+    """Import module in a fresh interpreter, returns the milliseconds it took."""
+    import subprocess
+    code = 'from time import time; t = time(); import {}; print (time() - t) * 1e3'.format(module)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=path.dirname(path.abspath(__file__)))
+    return float(out.split()[-1])
+
+
+@benchmark
+def bench_import_time():
+    # the modules imported by a restart of each task, then the heavy ones they used to import
+    for module in ['cli', 'grasptoefl', 'graspcourse', 'numpy', 'pandas', 'scipy.stats', 'bs4', 'PIL.Image']:
+        try:
+            yield 'import_time.' + module, min(_import_ms(module) for _ in range(5))
+        except Exception:  # CalledProcessError when the module is not installed
+            print '{:40s} skipped: cannot import'.format('import_time.' + module)
+
+
+@benchmark
+def bench_str2dic():
+    for name, page in [('recorded', load_fixture('seats_query_open.html')),
+                       ('synthetic', synthetic_seats_page())]:
+        yield 'str2dic.' + name, best_of(lambda: parse_seat_table(page))
+        try:
+            yield 'str2dic.soup.' + name, best_of(lambda: parse_seat_table_soup(page))
+        except ImportError:
+            pass
+
+
+@benchmark
+def bench_check_res():
+    from graspcourse import CourseGrasper
+
+    pattern = r'function initSelectedList[\s,\S]*?alert\((".*?")\)'
+    for kb in [16, 512, 4096]:
+        page = synthetic_submit_page(kb)
+        res = canned_response(page)
+        yield 'check_res.regex.{}KB'.format(kb), best_of(
+            lambda: re.search(pattern, page.decode('utf8')).group(1), number=3)
+        yield 'check_res.{}KB'.format(kb), best_of(lambda: CourseGrasper.check_res(res), number=3)
+
+
+@benchmark
+def bench_page_memo():
+    from changes import PageMemo
+
+    grasper = new_toefl_scraping()
+    res = canned_response(synthetic_seats_page().encode('gb2312'))
+
+    def changed():
+        memo = PageMemo()
+        if memo.lookup('SeatsQuery', res) is None:
+            memo.store('SeatsQuery', res, grasper.str2dic(res.content.decode('gb2312')))
+
+    memo = PageMemo()
+    memo.store('SeatsQuery', res, [])
+    yield 'page_memo.changed.synthetic', best_of(changed)
+    yield 'page_memo.unchanged.synthetic', best_of(lambda: memo.lookup('SeatsQuery', res), number=100)
+
+    from parsecache import ParseCache
+    cache = ParseCache()
+    cache.put('str2dic', res.content, [])
+    yield 'parse_cache.hit.synthetic', best_of(lambda: cache.get('str2dic', res.content), number=100)
+
+
+@benchmark
+def bench_classifier():
+    page = synthetic_submit_page(512)
+    yield 'classifier.512KB', best_of(lambda: JW_CLASSIFIER.classify(page), number=3)
+
+
+@benchmark
+def bench_generate_params():
+    grasper = new_course_grasper()
+    for course_type in ['tongxiu', 'tongshi', 'kuayuanxi']:
+        yield 'generate_params.' + course_type, best_of(
+            lambda: grasper.generate_params(course_type, submit_id=99975432, academy='15'), number=10000)
+
+
+@benchmark
+def bench_submit_request():
+    """Everything grasp_course_renew does for the submit request before the adapter."""
+    import requests
+    from graspcourse import JwCourse
+
+    grasper = new_course_grasper()
+    grasper.ses.cookies.set('JSESSIONID', '0123456789ABCDEF', domain='jw.nju.edu.cn')
+    course = JwCourse(99975432, 'tongxiu', 'GanJiGuo_Tue', '15')
+
+    def per_call():
+        url, params = grasper.generate_params(course.type, submit_id=course.id, academy=course.academy)
+        req = grasper.ses.prepare_request(requests.Request('POST', url, params=params))
+        grasper.ses.merge_environment_settings(req.url, {}, None, None, None)
+
+    def prepared():
+        p = grasper.course_requests(course)
+        req = p.submit.copy()
+        req.prepare_cookies(grasper.ses.cookies)
+
+    yield 'submit_request.per_call', best_of(per_call, number=2000)
+    yield 'submit_request.prepared', best_of(prepared, number=2000)
+
+
+@benchmark
+def bench_process_time_dic():
+    grasper = new_toefl_scraping()
+    records = [r._replace(status=False) for r in parse_seat_table(synthetic_seats_page()).records]
+    yield 'process_time_dic', best_of(lambda: grasper.process_time_dic(records), number=100)
+
+
+def synthetic_seat_records(n, n_sites=500, n_dates=30, open_ratio=0.3, seed=0):
+    """n SeatRecords of random sites and dates, open_ratio of them open."""
+    import random
+    from seatrecords import SeatRecord
+
+    rng = random.Random(seed)
+    sites = [('STN8{:04d}A'.format(i), u'考点{}'.format(i)) for i in range(n_sites)]
+    dates = [str(20171001 + i) for i in range(n_dates)]
+    return [SeatRecord(rng.choice(dates), *(rng.choice(sites) + (rng.random() < open_ratio,)))
+            for _ in xrange(n)]
+
+
+@benchmark
+def bench_seat_selection():
+    import numpy as np
+    from seatselect import SeatSelector, DEFAULT_PRIORITY
+
+    records = synthetic_seat_records(100000)
+    selector = SeatSelector(date_from=20171005, date_to=20171020,
+                            priorities=dict(('STN8{:04d}A'.format(i), i % 7) for i in range(0, 500, 5)))
+
+    def loop():
+        # a scan of the records in Python, as process_time_dic did
+        best = None
+        for date, location_code, location, status in records:
+            if status and selector.date_from <= int(date) <= selector.date_to:
+                key = (selector.priorities.get(location_code, DEFAULT_PRIORITY), int(date))
+                if best is None or key < best[0]:
+                    best = key, location_code
+        return best
+
+    assert loop()[1] == selector.best(records).location_code
+    yield 'seat_selection.100k.python_loop', best_of(loop, number=1, repeat=3)
+    yield 'seat_selection.100k.best', best_of(lambda: selector.best(records), number=1, repeat=3)
+    yield 'seat_selection.100k.rank', best_of(lambda: selector.rank(records), number=1, repeat=3)
+
+    # the columns of the records as numpy arrays, the scoring alone
+    dates = np.array([int(r.date) for r in records])
+    prio = selector.site_priorities(r.location_code for r in records)
+    yield 'seat_selection.100k.scores', best_of(lambda: selector.order(selector.scores(dates, prio)),
+                                                number=1, repeat=3)
+
+
+def _history_rows(n):
+    """Yields n rows of snapshots of the recorded seat table, with new strings per row as parsing makes them."""
+    from seatrecords import SeatRecord
+
+    def fresh(s):
+        return (s + u' ')[:-1]
+
+    records = parse_seat_table(load_fixture('seats_query_open.html')).records
+    for i in xrange(n):
+        r = records[i % len(records)]
+        yield float(i // len(records)), SeatRecord(fresh(r.date), fresh(r.location_code), fresh(r.location), r.status)
+
+
+def _history_rss(n, form):
+    """Keep n rows in a fresh interpreter, returns how much it raised the RSS in KB."""
+    import subprocess
+    code = 'import benchmark; print benchmark._build_history_once({}, {!r})'.format(n, form)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=path.dirname(path.abspath(__file__)))
+    return int(out.split()[-1])
+
+
+def _build_history_once(n, form):
+    from seatrecords import SeatHistory
+
+    before = memory_kb()
+    rows = _history_rows(n)
+    if form == 'dicts':
+        # the former form: one time dict of site dicts per snapshot
+        history = [(ts, {r.date: [{'location': r.location, 'status': r.status, 'location_code': r.location_code}]})
+                   for ts, r in rows]
+    elif form == 'records':
+        history = list(rows)
+    else:
+        history = SeatHistory()
+        for ts, r in rows:
+            history.append(r, ts)
+    return memory_kb() - before
+
+
+@benchmark
+def bench_seat_history():
+    from seatrecords import SeatHistory
+
+    n = 100000
+    rows = list(_history_rows(n))
+
+    def fill():
+        history = SeatHistory()
+        for ts, r in rows:
+            history.append(r, ts)
+        return history
+
+    yield 'seat_history.append.100k', best_of(fill, number=1, repeat=3)
+    history = fill()
+    yield 'seat_history.to_dataframe.100k', best_of(history.to_dataframe, number=1, repeat=3)
+
+    print 'RSS increase of a 100k-row history: dicts {} KB, records {} KB, SeatHistory {} KB'.format(
+        *[_history_rss(n, form) for form in ['dicts', 'records', 'columns']])
+
+
+@benchmark
+def bench_poll_planner():
+    from polling import PollPlanner, simulate
+
+    now = [0.]
+    planner = PollPlanner(['Shanghai', 'Jiangsu', 'Zhejiang'], clock=lambda: now[0])
+
+    def poll():
+        target, wait = planner.next()
+        now[0] += wait
+        planner.observe(target, target == 'Shanghai')
+
+    yield 'poll_planner.next_observe', best_of(poll, number=1000)
+
+    # changes every 20 s, 200 s and 2000 s, over 6 hours
+    rates = {'Shanghai': 1. / 20, 'Jiangsu': 1. / 200, 'Zhejiang': 1. / 2000}
+    print 'polls and mean detection delay: random {} / {:.1f} s, planned {} / {:.1f} s'.format(
+        *(simulate(rates, 6 * 3600., adaptive=False) + simulate(rates, 6 * 3600.)))
+
+
+@benchmark
+def bench_snapshot_store():
+    import shutil
+    import tempfile
+    from snapshotstore import SnapshotStore
+
+    records = parse_seat_table(synthetic_seats_page()).records
+    directory = tempfile.mkdtemp()
+    try:
+        store = SnapshotStore(path.join(directory, 'snapshots.db'))
+        ts = [0.]
+
+        def add():
+            ts[0] += 1.
+            # a changed page each time, unchanged ones are not appended
+            store.add_seats('201710', 'Shanghai', records, '{:016.0f}'.format(ts[0]), ts=ts[0])
+
+        # ms per seat table of the poll loop, flushes included
+        yield 'snapshot_store.add_seats', best_of(add, number=200)
+        while store.count() < 100000:
+            add()
+        site = records[0].location_code
+        yield 'snapshot_store.site_query.100k', best_of(lambda: sum(1 for _ in store.seats(site)),
+                                                        number=1, repeat=3)
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+@benchmark
+def bench_get_encoded_pwd():
+    grasper = new_toefl_scraping()
+    yield 'get_encoded_pwd', best_of(lambda: grasper.get_encoded_pwd('AbCd'), number=10000)
+
+
+@benchmark
+def bench_dict_to_url():
+    from base import BaseWebScraping
+    form = {'mvfAdminMonths': '201710', 'mvfSiteProvinces': 'Shanghai', 'whichFirst': 'AS',
+            'afCalcResult': 'abcd', '__act': '__id.34.AdminsSelected.adp.actListSelected',
+            'submit.x': '45', 'submit.y': '8'}
+    yield 'dict_to_url', best_of(lambda: BaseWebScraping._dict_to_url(form), number=10000)
+
+
+@benchmark
+def bench_priority_queue():
+    from graspcourse import PriorityQueue, JwCourse
+
+    for n in [1000, 50000]:
+        courses = [JwCourse(99970000 + i, 'tongxiu', str(i), '15') for i in range(n)]
+        priors = [(i * 7919) % n for i in range(n)]
+
+        def put_all():
+            pq = PriorityQueue()
+            for course, prior in zip(courses, priors):
+                pq.put(course, prior)
+            return pq
+        yield 'priority_queue.put.{}'.format(n), best_of(put_all, number=1, repeat=3)
+
+        def extend_all():
+            pq = PriorityQueue()
+            pq.extend(zip(courses, priors))
+            return pq
+        yield 'priority_queue.extend.{}'.format(n), best_of(extend_all, number=1, repeat=3)
+
+        pq = extend_all()
+
+        def run_generator():
+            gen = pq.generator()
+            gen.next()
+            while True:
+                try:
+                    gen.send(False)
+                except StopIteration:
+                    break
+        yield 'priority_queue.generator.{}'.format(n), best_of(run_generator, number=3, repeat=3)
+
+        def reprioritize():
+            for course in courses[:100]:
+                pq.update_priority(course, n // 2)
+            pq.generator().next()
+        yield 'priority_queue.update_priority.100of{}'.format(n), best_of(reprioritize, number=1, repeat=3)
+
+
+def _url2byte_legacy(ses, url, dump_path):
+    """url2byte before the in-memory path: full body, StringIO round trip and a disk write."""
+    from StringIO import StringIO
+    res = ses.get(url)
+    r = StringIO(res.content)
+    c = r.read()
+    with open(dump_path, 'wb') as f:
+        f.write(c)
+    return c
+
+
+def _image_stand_in(size):
+    import os
+    from replay import StandInServer
+    exchange = {'method': 'GET', 'path': '/cn/image.jpg', 'params': {}, 'status': 200,
+                'headers': {'Content-Type': 'image/jpeg'}, 'content': os.urandom(size)}
+    return StandInServer([exchange]).start()
+
+
+def _url2byte_peak_rss(server, size, mode):
+    """Run one fetch in a fresh interpreter, returns how much it raised the peak RSS in KB."""
+    import subprocess
+    code = 'import benchmark; print benchmark._fetch_image_once({!r}, {}, {!r})'.format(server.url, size, mode)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=path.dirname(path.abspath(__file__)))
+    return int(out.split()[-1])
+
+
+def _fetch_image_once(stand_in_url, size, mode):
+    import os
+    import tempfile
+    from replay import RedirectAdapter
+
+    grasper = new_toefl_scraping()
+    grasper.max_image_size = size
+    grasper.mount(RedirectAdapter(stand_in_url, grasper.transport_config))
+    url = grasper.url_prefix + 'image.jpg'
+    dump_path = os.path.join(tempfile.mkdtemp(), 'download.jpg')
+
+    before = memory_kb('VmHWM')
+    if mode == 'legacy':
+        _url2byte_legacy(grasper.ses, url, dump_path)
+    elif mode == 'bytes':
+        grasper.url2byte(url)
+    else:
+        grasper.url2buffer(url)
+    return memory_kb('VmHWM') - before
+
+
+@benchmark
+def bench_url2byte():
+    import os
+    import tempfile
+
+    dump_path = os.path.join(tempfile.mkdtemp(), 'download.jpg')
+    for size, label in [(4 * 1024, '4KB'), (4 * 1024 * 1024, '4MB')]:
+        grasper = new_toefl_scraping()
+        grasper.max_image_size = size
+        server = _image_stand_in(size)
+        server.attach(grasper)
+        url = grasper.url_prefix + 'image.jpg'
+        try:
+            yield 'url2byte.legacy.' + label, best_of(lambda: _url2byte_legacy(grasper.ses, url, dump_path),
+                                                      number=5, repeat=3)
+            yield 'url2byte.' + label, best_of(lambda: grasper.url2byte(url), number=5, repeat=3)
+        finally:
+            server.stop()
+
+    size = 32 * 1024 * 1024
+    server = _image_stand_in(size)
+    try:
+        print 'peak RSS increase of one 32MB fetch: legacy {} KB, url2byte {} KB, url2buffer {} KB'.format(
+            *[_url2byte_peak_rss(server, size, mode) for mode in ['legacy', 'bytes', 'buffer']])
+    finally:
+        server.stop()
+
+
+@benchmark
+def bench_seize_seats():
+    grasper, server = new_toefl_scraping(stand_in=True)
+    try:
+        yield 'seize_seats.iteration', best_of(lambda: grasper.seize_seats('201710', 'Jiangsu'),
+                                               number=20, repeat=3)
+    finally:
+        server.stop()
+
+
+@benchmark
+def bench_concurrent_seize_seats():
+    from engine import RequestEngine, gather
+    from grasptoefl import AsyncToeflScraping
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    provinces = ['Shanghai', 'Jiangsu', 'Zhejiang']
+    server = StandInServer(load_exchanges(fixture_path('toefl')), latency=0.02, seed=0).start()
+    engine = RequestEngine(len(provinces))
+    graspers = []
+    for _ in provinces:
+        grasper = quiet(AsyncToeflScraping(engine))
+        grasper.refresh_session()
+        grasper.url_prefix = 'https://toefl.etest.net.cn/cn/'
+        grasper.captcha_solver = lambda img: ('abcd', None)
+        grasper.register = lambda date, location_code: False
+        server.attach(grasper)
+        graspers.append(grasper)
+    try:
+        yield 'seize_seats.3_provinces.serial', best_of(
+            lambda: [g.seize_seats('201710', p) for g, p in zip(graspers, provinces)], number=3, repeat=3)
+        yield 'seize_seats.3_provinces.concurrent', best_of(
+            lambda: gather([g.seize_seats_async('201710', p) for g, p in zip(graspers, provinces)]),
+            number=3, repeat=3)
+    finally:
+        server.stop()
+        engine.close()
+
+
+@benchmark
+def bench_pipeline():
+    from time import sleep
+    from seatparser import parse_seat_page
+    from pipeline import Pipeline
+
+    # distinct seat tables, each behind 20 ms of network
+    pages = [synthetic_seats_page(30 + i).encode('gb2312') for i in range(12)]
+
+    def fetch(i):
+        sleep(0.02)
+        return None, pages[i]
+
+    def serial():
+        for i in range(len(pages)):
+            parse_seat_page(fetch(i)[1])
+
+    with Pipeline(fetchers=3, parsers=2) as pipeline:
+        yield 'pipeline.12_pages.serial', best_of(serial, number=1, repeat=3)
+        yield 'pipeline.12_pages.pipelined', best_of(
+            lambda: list(pipeline.run(fetch, parse_seat_page, range(len(pages)))), number=1, repeat=3)
+
+
+@benchmark
+def bench_grasp_course_renew():
+    from graspcourse import JwCourse
+
+    grasper, server = new_course_grasper(stand_in=True)
+    course = JwCourse(99975432, 'tongxiu', 'GanJiGuo_Tue', '15')
+    try:
+        yield 'grasp_course_renew.iteration', best_of(lambda: grasper.grasp_course_renew(course),
+                                                      number=20, repeat=3)
+        grasper.warm_ttl = 3600.
+        yield 'grasp_course_renew.skip_warm_up', best_of(lambda: grasper.grasp_course_renew(course),
+                                                         number=20, repeat=3)
+    finally:
+        server.stop()
+
+
+def run(prefixes=None):
+    """Returns an OrderedDict of benchmark name -> milliseconds."""
+    results = OrderedDict()
+    for name, func in BENCHMARKS.items():
+        if prefixes and not any(name.startswith(p) for p in prefixes):
+            continue
+        try:
+            for bench_name, ms in func():
+                results[bench_name] = ms
+                print '{:40s} {:10.4f} ms'.format(bench_name, ms)
+        except ImportError as e:
+            print '{:40s} skipped: {}'.format(name, e)
+    return results
+
+
+def load_baseline(file_path=BASELINE_PATH):
+    if not path.exists(file_path):
+        return {}
+    with open(file_path) as f:
+        return json.load(f)['results']
+
+
+def save_baseline(results, file_path=BASELINE_PATH):
+    baseline = load_baseline(file_path)
+    baseline.update(results)
+    data = {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': OrderedDict(sorted(baseline.items()))}
+    with open(file_path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def report(results, baseline, tolerance=0.25):
+    """Print current results against the baseline, returns names of regressed benchmarks."""
+    regressed = []
+    print
+    print '{:40s} {:>12s} {:>12s} {:>8s}'.format('benchmark', 'baseline ms', 'current ms', 'ratio')
+    for name, ms in results.items():
+        if name not in baseline:
+            print '{:40s} {:>12s} {:12.4f} {:>8s}'.format(name, '-', ms, 'new')
+            continue
+        ratio = ms / baseline[name]
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressed.append(name)
+        print '{:40s} {:12.4f} {:12.4f} {:8.2f}{}'.format(name, baseline[name], ms, ratio, flag)
+    return regressed
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks of the scraping hot paths.')
+    parser.add_argument('prefixes', nargs='*', help='only run benchmarks whose name starts with these')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown ratio over baseline, default 0.25')
+    args = parser.parse_args(argv)
+
+    results = run(args.prefixes)
+    if args.save_baseline:
+        save_baseline(results)
+        print 'baseline saved to {}'.format(BASELINE_PATH)
+        return 0
+
+    regressed = report(results, load_baseline(), args.tolerance)
+    if regressed and args.check:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
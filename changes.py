@@ -0,0 +1,227 @@
+# encoding: utf-8
+
+"""
+Change detection of polled pages.
+
+Most polls return the same bytes as the previous one.  PageMemo keeps, per
+key, the digest of the last body with the value parsed from it, so an
+unchanged body is neither decoded nor parsed again; for GET pages it also
+keeps the ETag/Last-Modified validators and sends them back, then a 304
+costs no body at all.  SnapshotDiff compares the records parsed from a page
+with the previous ones of the same key and returns only those whose status
+changed.
+
+"""
+import hashlib
+from collections import namedtuple
+from operator import itemgetter
+
+
+Page = namedtuple('Page', ['digest', 'value', 'etag', 'last_modified'])
+
+# old is None for a new record, new is None for a record gone from the page
+Change = namedtuple('Change', ['key', 'old', 'new'])
+
+
+def body_digest(content):
+    return hashlib.md5(content).digest()
+
+
+class PageMemo(object):
+    """
+    Last page body digest and parsed value per key, e.g. ('SeatsQuery', month, province).
+
+    Parameters
+    ----------
+    parse_cache : ParseCache, default None
+        Asked for the value of a changed body before its parser.
+
+    Attributes
+    ----------
+    stats : dict
+        Counts of 'changed', 'unchanged' and 'not_modified' (304) lookups.
+
+    """
+    def __init__(self, parse_cache=None):
+        self.parse_cache = parse_cache
+        self.__pages = dict()
+        self.stats = {'changed': 0, 'unchanged': 0, 'not_modified': 0}
+
+    def conditional_headers(self, key):
+        """If-None-Match/If-Modified-Since of the page stored under key, only for GET requests."""
+        page = self.__pages.get(key)
+        headers = dict()
+        if page is not None:
+            if page.etag:
+                headers['If-None-Match'] = page.etag
+            if page.last_modified:
+                headers['If-Modified-Since'] = page.last_modified
+        return headers
+
+    def lookup(self, key, res):
+        """
+        The stored Page if res is a 304 or has the same body as it, else None.
+
+        Parameters
+        ----------
+        key : hashable
+        res : requests.Response
+
+        """
+        page = self.__pages.get(key)
+        if page is None:
+            self.stats['changed'] += 1
+            return None
+        if res.status_code == 304:
+            self.stats['not_modified'] += 1
+            return page
+        if page.digest == body_digest(res.content):
+            self.stats['unchanged'] += 1
+            return page
+        self.stats['changed'] += 1
+        return None
+
+    def store(self, key, res, value):
+        self.__pages[key] = Page(body_digest(res.content), value,
+                                 res.headers.get('ETag'), res.headers.get('Last-Modified'))
+
+    def digest(self, key):
+        """Digest of the last body stored under key, None if there is none."""
+        page = self.__pages.get(key)
+        return page.digest if page is not None else None
+
+    def forget(self, key):
+        self.__pages.pop(key, None)
+
+    def parse(self, key, res, parser, name=None):
+        """
+        parser(res) for a changed page, the value stored under key otherwise, only 200 pages are stored.
+
+        With a name, changed bodies go through the parse cache under that name.
+
+        """
+        page = self.lookup(key, res)
+        if page is not None:
+            return page.value
+        if name and self.parse_cache is not None:
+            value = self.parse_cache.parse(name, res.content, lambda content: parser(res))
+        else:
+            value = parser(res)
+        if res.status_code == 200:
+            self.store(key, res, value)
+        return value
+
+
+class SnapshotDiff(object):
+    """
+    Status changes of records between consecutive snapshots of the same key.
+
+    Parameters
+    ----------
+    record_key : callable
+        record -> identity of the record within a snapshot.
+    status : callable
+        record -> the value whose changes are reported.
+
+    """
+    def __init__(self, record_key, status):
+        self.record_key = record_key
+        self.status = status
+        self.__last = dict()
+        self.__sources = dict()
+
+    def last(self, key):
+        """{record key: record} of the last snapshot of key."""
+        return self.__last.get(key, {})
+
+    def update(self, key, records):
+        """
+        Store records as the snapshot of key.
+
+        Returns
+        -------
+        changes : list of Change
+            Empty for the first snapshot of a key, and when records is the
+            same object as last time, e.g. a value of PageMemo.
+
+        """
+        if self.__sources.get(key) is records:
+            return []
+        self.__sources[key] = records
+
+        current = dict((self.record_key(r), r) for r in records)
+        previous = self.__last.get(key)
+        self.__last[key] = current
+        if previous is None:
+            return []
+
+        status = self.status
+        changes = [Change(k, previous.get(k), r) for k, r in current.iteritems()
+                   if k not in previous or status(previous[k]) != status(r)]
+        changes.extend(Change(k, r, None) for k, r in previous.iteritems() if k not in current)
+        return changes
+
+
+def seat_diff():
+    """SnapshotDiff of SeatRecord by (date, location_code) on status."""
+    return SnapshotDiff(itemgetter(0, 1), itemgetter(3))
+
+
+def course_diff():
+    """SnapshotDiff of CourseRecord by id on status."""
+    return SnapshotDiff(itemgetter(0), itemgetter(3))
+
+
+def test_page_memo():
+    from requests.models import Response
+    from seatrecords import SeatRecord
+
+    def canned_response(content, status_code=200):
+        res = Response()
+        res._content = content
+        res.status_code = status_code
+        return res
+
+    memo = PageMemo()
+    res = canned_response('<html>1</html>')
+    res.headers['ETag'] = '"1"'
+    calls = []
+    parser = lambda r: calls.append(r) or len(calls)
+
+    assert memo.parse('a', res, parser) == 1
+    assert memo.parse('a', canned_response('<html>1</html>'), parser) == 1
+    assert memo.parse('a', canned_response('', 304), parser) == 1
+    assert memo.parse('b', canned_response('<html>1</html>'), parser) == 2
+    assert memo.parse('a', canned_response('<html>2</html>'), parser) == 3
+    assert memo.parse('c', canned_response('<html>1</html>', 500), parser) == 4
+    assert memo.parse('c', canned_response('<html>1</html>', 500), parser) == 5
+    assert memo.stats == {'changed': 5, 'unchanged': 1, 'not_modified': 1}
+    assert memo.conditional_headers('a') == {} and memo.conditional_headers('c') == {}
+    memo.store('a', res, 4)
+    assert memo.conditional_headers('a') == {'If-None-Match': '"1"'}
+    assert memo.digest('a') == body_digest('<html>1</html>') and memo.digest('c') is None
+
+    from parsecache import ParseCache
+    memo = PageMemo(ParseCache())
+    assert memo.parse('a', canned_response('<html>1</html>'), parser, 'p') == 6
+    assert memo.parse('b', canned_response('<html>1</html>'), parser, 'p') == 6  # a cache hit
+    assert memo.parse('b', canned_response('<html>1</html>'), parser) == 6  # unchanged
+
+    diff = seat_diff()
+    first = [SeatRecord('20171014', 'STN80001A', u'上海交通大学', False),
+             SeatRecord('20171014', 'STN80002A', u'上海财经大学', True)]
+    assert diff.update(('201710', 'Shanghai'), first) == []
+    assert diff.update(('201710', 'Shanghai'), first) == []
+    second = [first[0]._replace(status=True), SeatRecord('20171028', 'STN80001A', u'上海交通大学', True)]
+    changes = sorted(diff.update(('201710', 'Shanghai'), second))
+    assert changes == [Change(('20171014', 'STN80001A'), first[0], second[0]),
+                       Change(('20171014', 'STN80002A'), first[1], None),
+                       Change(('20171028', 'STN80001A'), None, second[1])], changes
+    assert diff.update(('201710', 'Jiangsu'), second) == []
+    assert diff.update(('201710', 'Jiangsu'), first) != [] and diff.update(('201710', 'Jiangsu'), first) == []
+
+    print 'page memo test passed'
+
+
+if __name__ == '__main__':
+    test_page_memo()
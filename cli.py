@@ -0,0 +1,101 @@
+# encoding: utf-8
+
+"""
+Command line entry point of the scrapers::
+
+    python cli.py toefl --config toefl.json
+    python cli.py toefl --config toefl.json --concurrent --provinces Shanghai,Jiangsu
+    python cli.py toefl --config toefl.json --pipeline --parsers 2
+    python cli.py course --config jiaowu.json
+
+The scraper modules are imported by the subcommand that runs them, so
+``--help`` and argument errors return at once, and a restart only pays for
+the modules of one task.
+
+"""
+import sys
+import argparse
+
+
+def run_toefl(args):
+    from functools import partial
+    import grasptoefl
+
+    if args.concurrent:
+        main = partial(grasptoefl.main_concurrent, args.month, args.provinces.split(','),
+                       args.max_concurrency, args.config)
+    elif args.pipeline:
+        main = partial(grasptoefl.main_pipeline, args.month, args.provinces.split(','),
+                       args.parsers, args.config)
+    else:
+        main = partial(grasptoefl.main_with_captcha, args.config)
+
+    if args.once:
+        main()
+    else:
+        grasptoefl.run_forever(main)
+
+
+def run_course(args):
+    import graspcourse
+
+    graspcourse.main_with_captcha(args.config)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Grasp TOEFL seats or NJU courses.')
+    subparsers = parser.add_subparsers(title='tasks')
+
+    toefl = subparsers.add_parser('toefl', help='check and register TOEFL seats')
+    toefl.add_argument('--config', default=None, help='json config, default is the path in grasptoefl.py')
+    toefl.add_argument('--concurrent', action='store_true', help='check all provinces at the same time')
+    toefl.add_argument('--pipeline', action='store_true',
+                       help='check all provinces, parsing the pages in other processes')
+    toefl.add_argument('--month', default='201710', help='YYYYMM, only with --concurrent or --pipeline')
+    toefl.add_argument('--provinces', default='Shanghai,Jiangsu,Zhejiang',
+                       help='comma separated, only with --concurrent or --pipeline')
+    toefl.add_argument('--max-concurrency', type=int, default=3)
+    toefl.add_argument('--parsers', type=int, default=None,
+                       help='parser processes of --pipeline, the number of CPUs by default')
+    toefl.add_argument('--once', action='store_true', help='do not restart after an error')
+    toefl.set_defaults(func=run_toefl)
+
+    course = subparsers.add_parser('course', help='watch the course renew page')
+    course.add_argument('--config', default=None, help='json config, default is the path in graspcourse.py')
+    course.set_defaults(func=run_course)
+
+    return parser
+
+
+def main(argv):
+    args = make_parser().parse_args(argv)
+    if args.config is None:
+        # the default paths live in the task modules, not imported before here
+        module = __import__('grasptoefl' if args.func is run_toefl else 'graspcourse')
+        args.config = module.DEFAULT_CONFIG
+    args.func(args)
+    return 0
+
+
+def test_lazy_imports():
+    import subprocess
+    from os import path
+
+    heavy = ['numpy', 'pandas', 'scipy', 'bs4', 'PIL', 'winsound', 'ruokuai']
+    code = ('import sys, {}; print " ".join(m for m in {!r} if m in sys.modules)')
+    cwd = path.dirname(path.abspath(__file__))
+    for modules, unexpected in [('cli', heavy + ['grasptoefl', 'graspcourse', 'requests']),
+                                ('grasptoefl, graspcourse', heavy)]:
+        out = subprocess.check_output([sys.executable, '-c', code.format(modules, unexpected)], cwd=cwd)
+        assert not out.strip(), (modules, out)
+
+    args = make_parser().parse_args(['toefl', '--concurrent', '--provinces', 'Shanghai,Jiangsu'])
+    assert args.func is run_toefl and args.provinces == 'Shanghai,Jiangsu' and args.max_concurrency == 3
+    args = make_parser().parse_args(['toefl', '--pipeline', '--parsers', '2'])
+    assert args.pipeline and args.parsers == 2 and not args.concurrent
+
+    print 'lazy imports test passed'
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,52 @@
+# encoding: utf-8
+
+"""
+Rows of the course list of the jw system, e.g. the commonCourseRenewList page.
+
+"""
+import re
+from collections import namedtuple
+
+
+CourseRecord = namedtuple('CourseRecord', ['id', 'name', 'campus', 'status'])
+
+_ROW = re.compile(r'<tr[^>]*>(.*?)</tr>', re.S | re.I)
+_CELL = re.compile(r'<td[^>]*>(.*?)</td>', re.S | re.I)
+_TAG = re.compile(r'<[^>]+>')
+
+
+def parse_course_list(content, encoding='utf8'):
+    """
+    Parameters
+    ----------
+    content : str
+        Raw page.
+
+    Returns
+    -------
+    records : list of CourseRecord
+        Rows whose first cell is a course ID, status is the last cell, e.g. '30/30'.
+
+    """
+    records = []
+    for row in _ROW.findall(content):
+        cells = [_TAG.sub('', c).strip() for c in _CELL.findall(row)]
+        if len(cells) >= 4 and cells[0].isdigit():
+            records.append(CourseRecord(cells[0], cells[1].decode(encoding), cells[2].decode(encoding), cells[-1]))
+    return records
+
+
+def test_parse_course_list():
+    from replay import fixture_path
+
+    with open(fixture_path('jw/course_list.html'), 'rb') as f:
+        records = parse_course_list(f.read())
+    assert len(records) > 10
+    assert records[0] == CourseRecord('99970000', u'毛泽东思想和中国特色社会主义理论体系概论', u'仙林校区', '30/30')
+    assert parse_course_list('<table><tr><th>ID</th></tr></table>') == []
+
+    print 'course list test passed'
+
+
+if __name__ == '__main__':
+    test_parse_course_list()
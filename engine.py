@@ -0,0 +1,120 @@
+# encoding: utf-8
+
+"""
+Concurrent request engine for BaseWebScraping.
+
+Independent checks, e.g. one scraper per province, share one RequestEngine
+whose worker pool is the global concurrency cap, so their network latency
+overlaps instead of adding up.  Each scraper keeps its own session with a
+pooled keep-alive adapter, since captcha and Referer state is per session.
+
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+from base import BaseWebScraping
+
+
+class RequestEngine(object):
+    """
+    A worker pool shared by several scrapers.
+
+    Parameters
+    ----------
+    max_concurrency : int, default 4
+        At most this number of calls run at the same time.
+
+    """
+    __default = None
+    __default_lock = threading.Lock()
+
+    def __init__(self, max_concurrency=4):
+        self.max_concurrency = max_concurrency
+        self.__pool = ThreadPool(processes=max_concurrency)
+
+    @classmethod
+    def default(cls):
+        """The engine shared by scrapers created without one."""
+        with cls.__default_lock:
+            if cls.__default is None:
+                cls.__default = cls()
+            return cls.__default
+
+    def submit(self, func, *args, **kwargs):
+        """Run func in the pool, returns a multiprocessing.pool.AsyncResult."""
+        return self.__pool.apply_async(func, args, kwargs)
+
+    def map(self, func, iterable):
+        return self.__pool.map(func, iterable)
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
+
+
+def gather(async_results, timeout=3600):
+    """Wait for all results and return their values in order, the first exception is re-raised."""
+    return [r.get(timeout) for r in async_results]
+
+
+class AsyncBaseWebScraping(BaseWebScraping):
+    """
+    Counterpart of BaseWebScraping whose calls can run on a shared RequestEngine.
+
+    Mix it in before a concrete scraper, e.g.
+    ``class AsyncToeflScraping(AsyncBaseWebScraping, ToeflScraping)``,
+    then every ``*_async`` method returns an AsyncResult.
+
+    Attributes
+    ----------
+    engine : RequestEngine
+
+    """
+    def __init__(self, engine=None):
+        super(AsyncBaseWebScraping, self).__init__()
+        self.engine = engine or RequestEngine.default()
+
+    def refresh_session(self):
+        size = max(self.transport_config.pool_maxsize, self.engine.max_concurrency)
+        self.transport_config = self.transport_config.replace(pool_maxsize=size)
+        super(AsyncBaseWebScraping, self).refresh_session()
+
+    def spawn(self, func, *args, **kwargs):
+        return self.engine.submit(func, *args, **kwargs)
+
+    def get_async(self, url, **kwargs):
+        return self.spawn(self.ses.get, url, **kwargs)
+
+    def post_async(self, url, data=None, **kwargs):
+        return self.spawn(self.ses.post, url, data, **kwargs)
+
+
+def test_request_engine():
+    from time import time
+    from replay import StandInServer, load_exchanges, fixture_path
+    from scheduler import RequestScheduler
+
+    engine = RequestEngine(max_concurrency=3)
+    server = StandInServer(load_exchanges(fixture_path('toefl')), latency=0.2).start()
+    scrapers = []
+    for _ in range(3):
+        scraper = AsyncBaseWebScraping(engine)
+        scraper.scheduler = RequestScheduler(enabled=False)
+        scraper.refresh_session()
+        server.attach(scraper)
+        scrapers.append(scraper)
+
+    start = time()
+    results = gather([s.get_async('https://toefl.etest.net.cn/cn/MyHome/?') for s in scrapers])
+    elapsed = time() - start
+    server.stop()
+    engine.close()
+
+    assert all(r.status_code == 200 for r in results)
+    assert elapsed < 0.5, elapsed
+
+    print 'request engine test passed'
+
+
+if __name__ == '__main__':
+    test_request_engine()
@@ -1,21 +1,34 @@
 # encoding: utf-8
 
 import requests
-from PIL import Image
 from urllib import quote
 from StringIO import StringIO
 
-from bs4 import BeautifulSoup
 
 import logging
 
-import re
+import heapq
+import itertools
+from collections import namedtuple
 
-import winsound
-
-from time import sleep
+from time import sleep, time
 
 from base import BaseWebScraping
+from transport import TransportConfig
+from engine import AsyncBaseWebScraping
+from outcome import JW_CLASSIFIER, Outcome
+from changes import course_diff
+from courselist import parse_course_list
+from profiling import LoopProfiler
+from sessionstore import SessionStore
+from snapshotstore import SnapshotStore
+from notify import Notifier, LogSink, SoundSink
+from launch import LaunchScheduler
+from polling import PollPlanner
+
+
+# polls of the course lists, a static list is still checked about every max_interval seconds
+COURSE_POLLING = {'budget': 0.5, 'max_interval': 2.}
 
 
 class JwScraping(BaseWebScraping):
@@ -24,6 +37,9 @@ class JwScraping(BaseWebScraping):
     Support login with captcha (manually input)
 
     """
+    endpoint_labels = ((r'login\.do$', 'login'),
+                       (r'ValidateCode\.jsp$', 'captcha'))
+
     def __init__(self):
         BaseWebScraping.__init__(self)
 
@@ -34,6 +50,11 @@ class JwScraping(BaseWebScraping):
     def init_from_config(self, json_path):
         props = self.read_json(json_path)
 
+        self.transport_config = TransportConfig.from_dict(props.get('transport', {}))
+        self.metrics.configure(**props.get('metrics', {}))
+        self.parse_cache.configure(**props.get('parse_cache', {}))
+        self.session_store = SessionStore.from_dict(props.get('session_store', {}), json_path)
+        self.snapshots = SnapshotStore.from_dict(props.get('snapshot_store', {}), json_path)
         self.refresh_session()
 
         self.update_header(props['headers'])
@@ -44,6 +65,8 @@ class JwScraping(BaseWebScraping):
     def _input_captcha(self):
         img_url = self.url_prefix + r'ValidateCode.jsp'
 
+        from PIL import Image
+
         res = self.ses.get(img_url, stream=True)
         image = Image.open(res.raw)
         image.show()
@@ -61,8 +84,8 @@ class JwScraping(BaseWebScraping):
 
         res = self.ses.post(url, data=form)
 
-        decoded_content = res.content.decode('utf-8')
-        self.login_state = 'teachinginfo' in decoded_content
+        with self.span('parse', 'login'):
+            self.login_state = JW_CLASSIFIER.classify(res.content).outcome == Outcome.LOGIN_OK
         if self.login_state:
             msg = 'User {} login success!'.format(self.user)
             self.logger.info(msg)
@@ -70,6 +93,11 @@ class JwScraping(BaseWebScraping):
             msg = 'User {} login FAILED!'.format(self.user)
             self.logger.warn(msg)
 
+    def is_session_alive(self):
+        # the page of a logged out session is the login form, without the menu
+        res = self.ses.get(self.url_prefix + r'student/elective/index.do')
+        return res.status_code == 200 and 'id="Function"' in res.content
+
 
 class JwCourse(object):
     """
@@ -87,6 +115,8 @@ class JwCourse(object):
         Type of the course.
 
     """
+    __slots__ = ('id', 'name', 'academy', 'type')
+
     def __init__(self, id_, type_, name="", academy=""):
         self.id = str(id_)
         self.name = name
@@ -100,49 +130,106 @@ class JwCourse(object):
         return self.__repr__()
 
 
+_REMOVED = object()  # placeholder of a removed item in PriorityQueue
+
+# prepared requests of grasp_course_renew for one course, headers are the
+# session headers they were prepared with, visit is None but for 'tongxiu'
+CourseRequests = namedtuple('CourseRequests', ['headers', 'visit', 'course_list', 'submit', 'send_kwargs'])
+
+
 class PriorityQueue(object):
     """
     A priority queue supporting loop.
     Small value means higher priority.
 
+    Items are kept in a binary heap of [prior, count, item] entries, count
+    keeps insertion order among equal priorities.  Removed items are only
+    marked and dropped the next time the ordered view is built.  Each item
+    is held at most once, putting it again changes its priority.
+
     Attributes
     ----------
-    __queue : list
-        container
-    __size : int
-        size of __queue
+    __heap : list
+        container, a heap of [prior, count, item]
+    __entries : dict
+        item -> its live entry in __heap
+    __ordered : list or None
+        cached entries sorted by priority, None when outdated
     __priority : int
         current priority upper limit.
 
     """
     def __init__(self):
-        self.__queue = []
-        self.__size = 0
+        self.__heap = []
+        self.__entries = dict()
+        self.__counter = itertools.count()
+        self.__ordered = None
         self.__priority = 65535
 
     @property
     def size(self):
-        return self.__size
+        return len(self.__entries)
 
     @property
     def priority(self):
         return self.__priority
 
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, item):
+        return item in self.__entries
+
+    def _ordered(self):
+        if self.__ordered is None:
+            self.__ordered = [e for e in sorted(self.__heap) if e[2] is not _REMOVED]
+            # a sorted list is a valid heap, rebuilding it drops removed entries
+            self.__heap = list(self.__ordered)
+        return self.__ordered
+
     def get_pos(self, pos):
-        return self.__queue[pos]
+        prior, _, item = self._ordered()[pos]
+        return prior, item
 
-    def put(self, item, prior=0):
-        for idx in range(self.size):
-            if self.get_pos(idx)[0] > prior:
-                self.__queue.insert(idx, (prior, item))
-                break
-        else:
-            self.__queue.append((prior, item))
+    def _new_entry(self, item, prior):
+        if item in self.__entries:
+            self.__entries.pop(item)[2] = _REMOVED
+        entry = [prior, next(self.__counter), item]
+        self.__entries[item] = entry
+        self.__ordered = None
+        return entry
 
-        self.__size += 1
+    def put(self, item, prior=0):
+        heapq.heappush(self.__heap, self._new_entry(item, prior))
+
+    def extend(self, pairs):
+        """Bulk load an iterable of (item, prior) in O(n)."""
+        for item, prior in pairs:
+            self.__heap.append(self._new_entry(item, prior))
+        heapq.heapify(self.__heap)
+
+    def remove(self, item):
+        """Remove item from the queue, raise KeyError if absent."""
+        self.__entries.pop(item)[2] = _REMOVED
+        self.__ordered = None
+
+    def update_priority(self, item, prior):
+        """Change the priority of an item in the queue, raise KeyError if absent."""
+        if item not in self.__entries:
+            raise KeyError(item)
+        self.put(item, prior)
+
+    def peek(self):
+        """Returns (prior, item) with the highest priority."""
+        while self.__heap[0][2] is _REMOVED:
+            heapq.heappop(self.__heap)
+        prior, _, item = self.__heap[0]
+        return prior, item
 
     def generator(self):
-        for prior, item in self.__queue:
+        for prior, _, item in self._ordered():
+            if item is _REMOVED:
+                continue
             if prior >= self.priority:
                 break
             result = yield item
@@ -152,7 +239,23 @@ class PriorityQueue(object):
 
 
 class CourseGrasper(JwScraping):
-    """CourseGrasper is a class used to grasp course."""
+    """
+    CourseGrasper is a class used to grasp course.
+
+    Attributes
+    ----------
+    warm_ttl : float
+        Seconds during which grasp_course_renew skips the visit and course
+        list requests before a submit of a course type whose warm-up went
+        through, 0 always sends them.
+    warm_stats : dict
+        Counts of 'warmed' and 'skipped' submits, 'fallbacks' to the warm-up
+        after a skipped one was rejected, and the estimated 'saved_seconds'.
+    planner : PollPlanner
+        Which course type main_with_captcha checks next and when, of those
+        in RENEW_PAGE_MAP.
+
+    """
     def __init__(self):
         JwScraping.__init__(self)
 
@@ -164,6 +267,28 @@ class CourseGrasper(JwScraping):
                                'gong': 'publicCourseList.do',
                                'kuayuanxi': 'open.do',
                                'tongxiu': r'commonRenew.do'}
+        # status changes of courses per course type
+        self.course_changes = course_diff()
+        # course id -> CourseRequests
+        self.__course_requests = dict()
+        self.notifier = Notifier([LogSink(self.logger), SoundSink(DEFAULT_SOUND)], logger=self.logger)
+
+        self.warm_ttl = 0.
+        self.warm_stats = {'warmed': 0, 'skipped': 0, 'fallbacks': 0, 'saved_seconds': 0.}
+        # course type -> (session, time of its last successful warm-up)
+        self.__warmed = dict()
+        # moving average of the seconds of a warm-up
+        self.__warm_seconds = None
+        # a check every 2 s on average, as the former random sleeps: a single course type has no
+        # budget to share and its list stays the same until the renew opens, the planner would back off
+        self.planner = PollPlanner(['tongxiu'], **COURSE_POLLING)
+
+    def init_from_config(self, json_path):
+        JwScraping.init_from_config(self, json_path)
+        props = self.read_json(json_path)
+        self.notifier = Notifier.from_dict(props.get('notify', {'sound': DEFAULT_SOUND}), self.logger)
+        self.warm_ttl = props.get('warm_ttl', 0.)
+        self.planner = PollPlanner.from_dict(dict(COURSE_POLLING, **props.get('polling', {})), ['tongxiu'])
 
     def visit_once(self, course_type):
         # TODO this func has not been updated
@@ -173,47 +298,55 @@ class CourseGrasper(JwScraping):
         url = self.url_prefix + infix + postfix
 
         res = self.ses.get(url)
+        self._log_visit(course_type, res)
+
+    def _log_visit(self, course_type, res):
         if res.status_code == 200:
             self.logger.info('Visited {} success.'.format(course_type))
         else:
             self.logger.warn('Visited {} failed.'.format(course_type))
 
-    def notify_change(self):
-
-        fp = r'E:\SYS Files\Documents\Python files\WebScraping\NJU_Login\jiaowu\SeizeCourse\ringtong.wav'
+    def notify_change(self, course_type='tongxiu'):
+        """Check the pages and queue the notifications, the sinks run on the notifier's thread."""
         flag1 = False  # self._check_xuanke_page_sections()
-        flag2 = self._check_renew_page()
+        flag2 = self._check_renew_page(course_type)
 
-        if flag1 or flag2:
-            self.logger.warn("Please go check the course and shut me down!")
-            if flag1:
-                self.logger.info("flag 1 is True!")
-                winsound.PlaySound(fp, winsound.SND_ALIAS)
-            if flag2:
-                winsound.PlaySound(fp, winsound.SND_ALIAS)
-                self.logger.info("flag 1 is True!")
+        if flag1:
+            self.notifier.notify('xuanke-sections', 'New course selection section',
+                                 "Please go check the course and shut me down!")
+        if flag2:
+            self.notifier.notify('renew-started', 'Course renew started',
+                                 "Please go check the course and shut me down!")
 
     def _check_xuanke_page_sections(self):
         """Check whether there are more than 3 sections on the course selecting page."""
         page = r'student/elective/index.do'
         url = self.url_prefix + page
 
-        res = self.ses.get(url)
-        content = res.content.decode('utf8')
-
-        soup = BeautifulSoup(content, 'html.parser')
-        main = soup.find_all('div', {'id': 'Function'})[0]
-        sections = main.find_all('li')
-        for i in sections:
-            print i.text
+        res = self.ses.get(url, headers=self.pages.conditional_headers('index'))
+        return self.pages.parse('index', res, self._parse_xuanke_sections, 'xuanke_sections')
 
-        bool_list = map(lambda sec: u'通修课补选' in sec.text, sections)
-        return any(bool_list)
+    def _parse_xuanke_sections(self, res):
+        with self.span('decode', 'index'):
+            content = res.content.decode('utf8')
 
-    def _check_renew_page(self):
-        """Check whether course renew of tongxiu has started."""
-        course_type = 'tongxiu'
+        from bs4 import BeautifulSoup
 
+        with self.span('parse', 'index'):
+            soup = BeautifulSoup(content, 'html.parser')
+        try:
+            main = soup.find_all('div', {'id': 'Function'})[0]
+            texts = [sec.text for sec in main.find_all('li')]
+        finally:
+            # the tree is a web of parent/sibling references, freed at once rather than by the gc
+            soup.decompose()
+        for text in texts:
+            print text
+
+        return any(u'通修课补选' in text for text in texts)
+
+    def _check_renew_page(self, course_type='tongxiu'):
+        """Check whether course renew of course_type has started."""
         self.visit_once(course_type)
 
         url0, params_0 = self.generate_params(course_type,
@@ -221,11 +354,21 @@ class CourseGrasper(JwScraping):
                                               academy="",
                                               xianlin=True)
         res0 = self.ses.post(url0, params_0)
-        content = res0.content.decode('utf8')
+        started, courses = self.pages.parse(('courseList', course_type), res0, self._parse_renew_page, 'renew_page')
 
-        msg = u'现在还没有开始通修课补选'
+        if self.snapshots is not None:
+            self.snapshots.add_courses(course_type, courses, self.pages.digest(('courseList', course_type)))
+        for change in self.course_changes.update(course_type, courses):
+            msg = u"Course changed in {}: {} -> {}".format(course_type, change.old, change.new)
+            self.logger.info(msg)
+            self.notifier.notify(('course', change.key, change.new and change.new.status), 'Course changed', msg)
+        return started
 
-        return msg not in content
+    def _parse_renew_page(self, res):
+        """Returns whether the renew has started and the list of CourseRecord."""
+        with self.span('parse', 'courseList'):
+            started = JW_CLASSIFIER.classify(res.content).outcome != Outcome.NOT_STARTED
+            return started, parse_course_list(res.content)
 
     def grasp_course_renew(self, course_obj):
         """
@@ -240,32 +383,121 @@ class CourseGrasper(JwScraping):
         success : bool
 
         """
-        # first visit once
-        if course_obj.type == 'tongxiu':
-            self.visit_once('tongxiu')
+        prepared = self.course_requests(course_obj)
 
-        url0, params_0 = self.generate_params(course_obj.type,
-                                              submit_id=None,
-                                              academy=course_obj.academy,
-                                              xianlin=True)
-        res0 = self.ses.post(url0, params_0)
-        if not res0.status_code == 200:
-            self.logger.warn("Error! Visit once failed.")
+        # first visit once, unless this session did it a moment ago
+        skipped = self.is_warm(course_obj.type)
+        if not skipped:
+            self._warm_up(course_obj.type, prepared)
 
         # then submit request
-        url, params_ = self.generate_params(course_obj.type,
-                                            submit_id=course_obj.id,
-                                            academy=course_obj.academy,
-                                            xianlin=True)
-        res = self.ses.post(url, params=params_)
-
-        err_msg = self.check_res(res)
+        res = self.send_prepared(prepared.submit, prepared.send_kwargs)
+        if skipped and self._submit_rejected(res):
+            self.logger.info("Submit without warm-up rejected, warm up {} again.".format(course_obj.type))
+            self.warm_stats['fallbacks'] += 1
+            self._warm_up(course_obj.type, prepared)
+            res = self.send_prepared(prepared.submit, prepared.send_kwargs)
+        elif skipped:
+            self._count_skipped(course_obj.type)
+
+        with self.span('parse', 'courseList'):
+            err_msg = self.pages.parse(('submit', course_obj.id), res, self.check_res, 'check_res')
+        if self.snapshots is not None:
+            self.snapshots.add_submit(course_obj.id, course_obj.type, err_msg,
+                                      self.pages.digest(('submit', course_obj.id)))
         if err_msg:
             self.logger.info(str(course_obj) + "  ---  " + err_msg)
             return False
         else:
             return True
 
+    def is_warm(self, course_type):
+        """Whether the submit of course_type can go without the warm-up requests."""
+        entry = self.__warmed.get(course_type)
+        return (self.warm_ttl > 0 and entry is not None and entry[0] is self.ses
+                and time() - entry[1] < self.warm_ttl)
+
+    def warm_up(self, course_obj):
+        """Prepare the requests of course_obj and send its warm-up ones."""
+        self._warm_up(course_obj.type, self.course_requests(course_obj))
+
+    def _warm_up(self, course_type, prepared):
+        start = time()
+        ok = True
+        if prepared.visit is not None:
+            res = self.send_prepared(prepared.visit, prepared.send_kwargs)
+            self._log_visit(course_type, res)
+            ok = res.status_code == 200
+
+        res0 = self.send_prepared(prepared.course_list, prepared.send_kwargs)
+        if not res0.status_code == 200:
+            self.logger.warn("Error! Visit once failed.")
+            ok = False
+
+        elapsed = time() - start
+        self.__warm_seconds = elapsed if self.__warm_seconds is None else 0.8 * self.__warm_seconds + 0.2 * elapsed
+        self.warm_stats['warmed'] += 1
+        if ok:
+            self.__warmed[course_type] = (self.ses, time())
+        else:
+            self.__warmed.pop(course_type, None)
+
+    @staticmethod
+    def _submit_rejected(res):
+        """Whether a submit response is an error rather than an outcome of the course."""
+        if res.status_code != 200:
+            return True
+        outcome, message = JW_CLASSIFIER.classify(res.content)
+        return outcome == Outcome.UNKNOWN and message is None
+
+    def _count_skipped(self, course_type):
+        saved = self.__warm_seconds or 0.
+        self.warm_stats['skipped'] += 1
+        self.warm_stats['saved_seconds'] += saved
+        self.metrics.observe('scraping_saved_seconds', {'endpoint': 'submit'}, saved)
+        self.logger.info("Warm-up of {} skipped, about {:.0f} ms saved, {:.1f} s in total.".format(
+            course_type, saved * 1e3, self.warm_stats['saved_seconds']))
+
+    def course_requests(self, course_obj):
+        """
+        CourseRequests of course_obj, prepared again only when the session headers changed.
+
+        Cookies are not part of them, send_prepared adds the current ones.
+
+        """
+        cached = self.__course_requests.get(course_obj.id)
+        if cached is not None and cached.headers == self.ses.headers:
+            return cached
+
+        headers = self.ses.headers.copy()
+
+        visit = None
+        if course_obj.type == 'tongxiu':
+            url = self.url_prefix + 'student/elective/' + self.RENEW_PAGE_MAP['tongxiu']
+            visit = requests.Request('GET', url, headers=headers).prepare()
+        url0, params_0 = self.generate_params(course_obj.type, submit_id=None,
+                                              academy=course_obj.academy, xianlin=True)
+        course_list = requests.Request('POST', url0, data=params_0, headers=headers).prepare()
+        url, params_ = self.generate_params(course_obj.type, submit_id=course_obj.id,
+                                            academy=course_obj.academy, xianlin=True)
+        submit = requests.Request('POST', url, params=params_, headers=headers).prepare()
+        send_kwargs = self.ses.merge_environment_settings(submit.url, {}, None, None, None)
+
+        cached = CourseRequests(headers, visit, course_list, submit, send_kwargs)
+        self.__course_requests[course_obj.id] = cached
+        return cached
+
+    def prepare_courses(self, courses):
+        """Prepare the requests of the courses before they are grasped."""
+        for course_obj in courses:
+            self.course_requests(course_obj)
+
+    def send_prepared(self, prepared, send_kwargs):
+        """Send a copy of a prepared request with the current cookies of the session."""
+        req = prepared.copy()
+        req.prepare_cookies(self.ses.cookies)
+        return self.ses.send(req, **send_kwargs)
+
     def _check_course_type(self, t):
         if t not in self.COURSE_RENEW_TYPE_MAP:
             raise NotImplementedError("course type of {} not support yet.".format(t))
@@ -333,66 +565,122 @@ class CourseGrasper(JwScraping):
             None means no error.
 
         """
-        res_str = request_res.content.decode('utf8')
-
-        # success_str = u'\u8bfe\u7a0b\u9009\u62e9\u6210\u529f' # 课程选择成功
-        # full_str = u'\u73ed\u7ea7\u5df2\u6ee1' # 课程已满
-        # conflict_str = u'\u548c\u5df2\u9009\u8bfe\u7a0b\u5b58\u5728\u65f6\u95f4\u51b2\u7a81'
-
-        # if success_str in res_str:
-        #     err_msg = None
-        # elif full_str in res_str:
-        #     err_msg = 'Course is FULL'
-        # elif conflict_str in res_str:
-        #     err_msg = 'Course is conflict with others'
-        # else:
-        #     err_msg = 'Other failure'
-        pattern = r'function initSelectedList[\s,\S]*?alert\((".*?")\)'
-        search_res = re.search(pattern, res_str)
-        err_msg = search_res.group(1)
-        return err_msg
-
-
-def main_with_captcha():
+        outcome, message = JW_CLASSIFIER.classify(request_res.content)
+        if outcome == Outcome.SUCCESS:
+            return None
+        elif message:
+            return message
+        elif outcome == Outcome.FULL:
+            return 'Course is FULL'
+        elif outcome == Outcome.CONFLICT:
+            return 'Course is conflict with others'
+        else:
+            return 'Other failure'
+
+
+class AsyncCourseGrasper(AsyncBaseWebScraping, CourseGrasper):
+    """CourseGrasper whose requests can run on a shared RequestEngine."""
+
+    def login_async(self):
+        return self.spawn(self.login)
+
+    def visit_once_async(self, course_type):
+        return self.spawn(self.visit_once, course_type)
+
+    def post_params_async(self, course_type, submit_id=None, academy="", xianlin=True):
+        """POST the request built by generate_params."""
+        url, params = self.generate_params(course_type, submit_id, academy, xianlin)
+        if submit_id:
+            return self.spawn(self.ses.post, url, params=params)
+        return self.post_async(url, params)
+
+    def grasp_course_renew_async(self, course_obj):
+        return self.spawn(self.grasp_course_renew, course_obj)
+
+
+DEFAULT_CONFIG = r'E:\SYS Files\Documents\Python files\WebScraping\NJU_Login\jiaowu\SeizeCourse\jiaowu.json'
+DEFAULT_SOUND = r'E:\SYS Files\Documents\Python files\WebScraping\NJU_Login\jiaowu\SeizeCourse\ringtong.wav'
+
+
+def main_with_captcha(props_path=DEFAULT_CONFIG):
     """Main function to add courses and priorities and grasp them."""
-    props_path = r'E:\SYS Files\Documents\Python files\WebScraping\NJU_Login\jiaowu\SeizeCourse\jiaowu.json'
 
     grasper = CourseGrasper()
     grasper.init_from_config(props_path)
-    grasper.login()
-    assert grasper.login_state
+    if not grasper.resume_session():
+        grasper.login()
+        assert grasper.login_state
+        grasper.save_session()
+    heartbeat = grasper.start_heartbeat()
 
-    from scipy.stats import chi2
-    """
-    # when use this program, we only need to change following lines to add course and priority
-    ganjiguo_tue = JwCourse(99975432, 'tongxiu', 'GanJiGuo_Tue', '15')
-    ganjiguo_fri = JwCourse(99975431, 'tongxiu', 'GanJiGuo_Fri', '15')
-    gaojing_mon = JwCourse(99972222, 'tongxiu', 'GaoJing_Mon', '15')
-    mao_gai_pq = PriorityQueue()
-    mao_gai_pq.put(ganjiguo_tue, 0)
-    mao_gai_pq.put(ganjiguo_fri, 1)
-    mao_gai_pq.put(gaojing_mon, 2)
-
-    gen = mao_gai_pq.generator()
-    target_course = gen.next()
-    while True:
-        r = chi2.rvs(df=2)
-        sleep(r)
-
-        select_success = grasper.grasp_course(target_course)
+    try:
+        # submit at a published opening time, e.g.
+        # "launch": {"open_at": "2017-09-04 12:30:00", "tz": "+08:00",
+        #            "courses": [[99975432, "tongxiu", "GanJiGuo_Tue", "15"]]}
+        launch = grasper.read_json(props_path).get('launch')
+        if launch:
+            courses = [JwCourse(*c) for c in launch['courses']]
+            if LaunchScheduler.from_dict(grasper, launch, courses).run():
+                grasper.notifier.notify('launch', 'Course selected', ', '.join(map(str, courses)))
 
-        try:
-            target_course = gen.send(select_success)
-        except StopIteration:
-            gen = mao_gai_pq.generator()
-            target_course = gen.next()
-            # break
-    """
-    while True:
-        r = chi2.rvs(df=2)
-        sleep(r)
-        grasper.logger.info("sleep {:.1f} seconds...".format(r))
-        grasper.notify_change()
+        """
+        # when use this program, we only need to change following lines to add course and priority
+        ganjiguo_tue = JwCourse(99975432, 'tongxiu', 'GanJiGuo_Tue', '15')
+        ganjiguo_fri = JwCourse(99975431, 'tongxiu', 'GanJiGuo_Fri', '15')
+        gaojing_mon = JwCourse(99972222, 'tongxiu', 'GaoJing_Mon', '15')
+        mao_gai_pq = PriorityQueue()
+        mao_gai_pq.put(ganjiguo_tue, 0)
+        mao_gai_pq.put(ganjiguo_fri, 1)
+        mao_gai_pq.put(gaojing_mon, 2)
+        grasper.prepare_courses([ganjiguo_tue, ganjiguo_fri, gaojing_mon])
+
+        gen = mao_gai_pq.generator()
+        target_course = gen.next()
+        while True:
+            r = random.expovariate(0.5)
+            sleep(r)
+
+            select_success = grasper.grasp_course(target_course)
+
+            try:
+                target_course = gen.send(select_success)
+            except StopIteration:
+                gen = mao_gai_pq.generator()
+                target_course = gen.next()
+                # break
+        """
+        # the random sleeps are left out of the profile
+        profiler = LoopProfiler.from_env(grasper.logger)
+        i = 0
+        while True:
+            if not grasper.login_state:
+                grasper.login()
+                assert grasper.login_state
+                grasper.save_session()
+
+            # the course types share the polls by how often their lists change, none waits past max_interval
+            course_type, r = grasper.planner.next()
+            sleep(r)
+            grasper.logger.info("sleep {:.1f} seconds...".format(r))
+            key = ('courseList', course_type)
+            digest = grasper.pages.digest(key)
+            with profiler.iteration(), grasper.span('notify_change'):
+                grasper.notify_change(course_type)
+            grasper.planner.observe(course_type, grasper.pages.digest(key) != digest)
+
+            i += 1
+            if i % 50 == 0:
+                grasper.logger.info(grasper.parse_cache.summary())
+                grasper.logger.info("polling: {}".format(grasper.planner.summary()))
+                grasper.metrics.flush()
+                grasper.trim_session()
+                grasper.save_session()
+    finally:
+        if heartbeat:
+            heartbeat.stop()
+        # the pending snapshots are written on Ctrl-C too
+        if grasper.snapshots is not None:
+            grasper.snapshots.close()
 
 
 def test_priority_queue():
@@ -424,6 +712,24 @@ def test_priority_queue():
             break
     assert i == '4'
 
+    pq = PriorityQueue()
+    pq.extend([('b', 2), ('a', 1), ('c', 2), ('d', 0)])
+    pq.remove('d')
+    pq.update_priority('c', 1)
+    assert pq.size == 3 and 'd' not in pq
+    assert pq.peek() == (1, 'a')
+    assert [pq.get_pos(k)[1] for k in range(pq.size)] == ['a', 'c', 'b']
+    gen = pq.generator()
+    assert gen.next() == 'a'
+    assert gen.send(False) == 'c'
+    pq.remove('b')
+    try:
+        gen.send(False)
+    except StopIteration:
+        pass
+    else:
+        assert False
+
     print 'priority_queue test passed'
 
 
@@ -435,5 +741,190 @@ def test_generate_api():
     print q.generate_params('gongxuan', False, True)
     print 'func generate_api test passed'
 
+
+def test_course_requests():
+    from scheduler import RequestScheduler
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    server = StandInServer(load_exchanges(fixture_path('jw'))).start()
+    grasper = CourseGrasper()
+    grasper.scheduler = RequestScheduler(enabled=False)
+    grasper.refresh_session()
+    grasper.url_prefix = 'http://jw.nju.edu.cn/jiaowu/'
+    server.attach(grasper)
+    sent = []
+    send = grasper.ses.send
+    grasper.ses.send = lambda req, **kwargs: sent.append(req) or send(req, **kwargs)
+
+    course = JwCourse(74533, 'tongxiu', 'GanJiGuo_Tue', '15')
+    try:
+        grasper.prepare_courses([course])
+        prepared = grasper.course_requests(course)
+        grasper.ses.cookies.set('JSESSIONID', 'abc', domain='jw.nju.edu.cn')
+        assert not grasper.grasp_course_renew(course)
+        assert grasper.course_requests(course) is prepared
+
+        # the same requests as ses.post, the stand-in has only replaced the host
+        url0, params_0 = grasper.generate_params('tongxiu', academy='15')
+        url, params = grasper.generate_params('tongxiu', submit_id=74533, academy='15')
+        expected = [grasper.ses.prepare_request(requests.Request('POST', url0, data=params_0)),
+                    grasper.ses.prepare_request(requests.Request('POST', url, params=params))]
+        assert [r.method for r in sent] == ['GET', 'POST', 'POST']
+        for req, exp in zip(sent[1:], expected):
+            assert req.path_url == exp.path_url and req.body == exp.body and req.headers == exp.headers
+        assert sent[2].headers['Cookie'] == 'JSESSIONID=abc' and 'Cookie' not in prepared.submit.headers
+
+        grasper.update_header({'Referer': grasper.url_prefix + 'student/elective/commonRenew.do'})
+        assert grasper.course_requests(course) is not prepared
+        assert grasper.course_requests(course).submit.headers['Referer'].endswith('commonRenew.do')
+    finally:
+        server.stop()
+
+    print 'course requests test passed'
+
+
+def test_skip_warm_up():
+    from requests.models import Response
+    from scheduler import RequestScheduler
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    server = StandInServer(load_exchanges(fixture_path('jw')), latency=0.01).start()
+    grasper = CourseGrasper()
+    grasper.scheduler = RequestScheduler(enabled=False)
+    grasper.refresh_session()
+    grasper.url_prefix = 'http://jw.nju.edu.cn/jiaowu/'
+    grasper.logger.setLevel(logging.WARN)
+    grasper.warm_ttl = 60.
+    server.attach(grasper)
+
+    sent, failures = [], []
+    send = grasper.ses.send
+
+    def send_or_fail(req, **kwargs):
+        sent.append(req.method)
+        if failures and 'submit' in req.url:
+            failures.pop()
+            res = Response()
+            res.status_code, res._content = 500, ''
+            return res
+        return send(req, **kwargs)
+    grasper.ses.send = send_or_fail
+
+    course = JwCourse(74533, 'tongxiu', 'GanJiGuo_Tue', '15')
+    try:
+        grasper.grasp_course_renew(course)
+        assert sent == ['GET', 'POST', 'POST']
+        del sent[:]
+        grasper.grasp_course_renew(course)
+        assert sent == ['POST']  # only the submit
+        assert grasper.warm_stats['skipped'] == 1 and grasper.warm_stats['saved_seconds'] >= 0.02
+
+        # the server rejects the submit, the warm-up is sent again
+        del sent[:]
+        failures.append(1)
+        assert not grasper.grasp_course_renew(course)
+        assert sent == ['POST', 'GET', 'POST', 'POST'] and grasper.warm_stats['fallbacks'] == 1
+
+        grasper.warm_ttl = 0.
+        del sent[:]
+        grasper.grasp_course_renew(course)
+        assert len(sent) == 3
+    finally:
+        server.stop()
+
+    assert grasper.metrics.histogram('scraping_saved_seconds', endpoint='submit').count >= 1
+
+    print 'skip warm up test passed'
+
+
+def test_launch():
+    from scheduler import RequestScheduler
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    server = StandInServer(load_exchanges(fixture_path('jw'))).start()
+    grasper = CourseGrasper()
+    # a token a second: the submits spaced by 0.1 s are only on time past the scheduler
+    grasper.scheduler = RequestScheduler(rate=1., burst=1, increase=0.)
+    grasper.refresh_session()
+    grasper.url_prefix = 'http://jw.nju.edu.cn/jiaowu/'
+    grasper.logger.setLevel(logging.WARN)
+    server.attach(grasper)
+    # timed where they leave for the wire, past any wait for a token
+    sent = []
+    adapter = grasper.ses.get_adapter(grasper.url_prefix)
+    send = adapter.send
+    adapter.send = lambda req, **kwargs: sent.append((time(), req.url)) or send(req, **kwargs)
+
+    course = JwCourse(74533, 'tongxiu', 'GanJiGuo_Tue', '15')
+    open_at = time() + 6.5
+    launcher = LaunchScheduler(grasper, open_at, [course], prewarm=6., attempts=2, spacing=0.1, sync_samples=3)
+    try:
+        assert not launcher.run()  # the course is full
+    finally:
+        server.stop()
+
+    # the stand-in shares the local clock
+    est = launcher.estimate
+    assert abs(est.offset) <= est.error + 0.01 and est.error <= 0.25, est
+    fire_at = open_at - est.offset - est.rtt / 2.
+    submits = [t for t, url in sent if 'submit' in url]
+    assert len(submits) == 2
+    assert abs(submits[0] - fire_at) < 0.02 and abs(submits[1] - fire_at - 0.1) < 0.02, (fire_at, submits)
+    assert grasper.warm_stats['warmed'] == 1
+
+    print 'launch test passed'
+
+
+def test_course_polling():
+    now = [0.]
+    grasper = CourseGrasper()
+    planner = PollPlanner(grasper.planner.targets, clock=lambda: now[0], **COURSE_POLLING)
+    # an unchanged course list for 10 minutes: no back-off past the former mean of 2 s
+    waits = []
+    while now[0] < 600.:
+        course_type, wait = planner.next()
+        now[0] += wait
+        planner.observe(course_type, False)
+        waits.append(wait)
+    assert max(waits[1:]) <= 2. * (1. + planner.jitter), max(waits)
+    assert 1.9 < now[0] / len(waits) < 2.3, now[0] / len(waits)
+
+    print 'course polling test passed'
+
+
+def test_notify_change():
+    from time import time
+    from scheduler import RequestScheduler
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    class SlowSink(object):
+        received = []
+
+        def send(self, notification):
+            sleep(0.5)  # a sound being played
+            self.received.append(notification)
+
+    server = StandInServer(load_exchanges(fixture_path('jw'))).start()
+    grasper = CourseGrasper()
+    grasper.scheduler = RequestScheduler(enabled=False)
+    grasper.refresh_session()
+    grasper.url_prefix = 'http://jw.nju.edu.cn/jiaowu/'
+    grasper.notifier = Notifier([SlowSink()], min_interval=0.)
+    server.attach(grasper)
+    try:
+        start = time()
+        grasper.notify_change()
+        grasper.notify_change()
+        assert time() - start < 0.5
+        grasper.notifier.flush()
+    finally:
+        server.stop()
+        grasper.notifier.close()
+
+    assert [n.key for n in SlowSink.received] == ['renew-started']
+    assert grasper.notifier.stats['deduped'] == 1
+
+    print 'notify change test passed'
+
 if __name__ == '__main__':
     main_with_captcha()
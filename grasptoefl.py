@@ -1,28 +1,53 @@
 # encoding: utf-8
 
+import os
 import datetime
 import hashlib
+import random
 import re
+import threading
 from time import sleep
-from collections import defaultdict
-
-import numpy as np
-import pandas as pd
-from bs4 import BeautifulSoup
 
 from base import BaseWebScraping
-import ruokuai
+from transport import TransportConfig
+from engine import AsyncBaseWebScraping, RequestEngine, gather
+from seatparser import parse_seat_table, parse_seat_page
+from seatrecords import SeatHistory, time_dic_to_records
+from seatselect import SeatSelector
+from changes import seat_diff
+from profiling import LoopProfiler
+from sessionstore import SessionStore
+from snapshotstore import SnapshotStore
+from pipeline import Pipeline, Parsed
+from polling import PollPlanner
 
 
 class ShouldTerminateException(Exception):
     pass
 
+
+# (month, province) seat tables polled by grasp_seats unless the config lists others
+SEAT_TARGETS = [('201710', 'Shanghai'), ('201710', 'Jiangsu'), ('201710', 'Zhejiang')]
+
+
+def ruokuai_captcha(img_byte):
+    """Solve a captcha with the ruokuai service, imported on first use."""
+    import ruokuai
+    return ruokuai.bypass_captcha(img_byte)
+
+
 class ToeflScraping(BaseWebScraping):
     """
     JwScraping is for web scraping on our jw system.
     Support login with captcha (manually input)
 
     """
+    throttle_markers = (u'操作太频繁'.encode('gb2312'), )
+    endpoint_labels = ((r'TOEFLAPP$', 'login'),
+                       (r'VerifyCode\d\.jpg$', 'captcha'),
+                       (r'MyHome', 'homepage'),
+                       (r'/cn/$', 'register'))
+
     def __init__(self):
         BaseWebScraping.__init__(self)
 
@@ -34,10 +59,30 @@ class ToeflScraping(BaseWebScraping):
 
         self.__epoch = datetime.datetime.utcfromtimestamp(0)
         self.last_seat_query_url = ""
+        # every seat table seen, about 20 bytes per row
+        self.seat_history = SeatHistory(max_rows=1000000)
+        # status changes of seats per (month, province)
+        self.seat_changes = seat_diff()
+
+        # img_bytes -> (captcha, err_msg), replaced by a fixed answer when replaying fixtures
+        self.captcha_solver = ruokuai_captcha
+        # the captcha of a seat query is per session, so are its queries
+        self.query_lock = threading.Lock()
+        # which seat table grasp_seats queries next, and when
+        self.planner = PollPlanner(SEAT_TARGETS)
+        # which open seats to register, in which order
+        self.seat_selector = SeatSelector()
 
     def init_from_config(self, json_path):
         props = self.read_json(json_path)
 
+        self.transport_config = TransportConfig.from_dict(props.get('transport', {}))
+        self.metrics.configure(**props.get('metrics', {}))
+        self.parse_cache.configure(**props.get('parse_cache', {}))
+        self.session_store = SessionStore.from_dict(props.get('session_store', {}), json_path)
+        self.snapshots = SnapshotStore.from_dict(props.get('snapshot_store', {}), json_path)
+        self.planner = PollPlanner.from_dict(props.get('polling', {}), SEAT_TARGETS)
+        self.seat_selector = SeatSelector.from_dict(props.get('seat_preferences', {}))
         self.refresh_session()
 
         self.update_header(props['headers'])
@@ -57,7 +102,7 @@ class ToeflScraping(BaseWebScraping):
         # milli seconds since 19700101, mimic `new Date().getTime()` of JavaScript
         a = self.milli_since_epoch()
         # random number between 0 and 1, mimic `Math.Random()` of JavaScript
-        r = np.random.random()
+        r = random.random()
         a_len, r_len = 14, 16  # from source code of the website
         img_url = self.url_prefix + "{:14.16f}".format(a+r) + 'VerifyCode3.jpg'
 
@@ -92,12 +137,13 @@ class ToeflScraping(BaseWebScraping):
                 '__act': '__id.24.TOEFLAPP.appadp.actLogin',
                 'password': encoded_password,
                 'LoginCode': captcha,
-                'btn_submit.x': str(25 + np.random.randint(-3, 3)),
-                'btn_submit.y': str(6 + np.random.randint(-3, 3))}
+                'btn_submit.x': str(25 + random.randrange(-3, 3)),
+                'btn_submit.y': str(6 + random.randrange(-3, 3))}
 
         res = self.ses.post(url, data=form)
         res.encoding = self.encoding
-        decoded_content = res.text
+        with self.span('decode', 'login'):
+            decoded_content = res.text
 
         self.login_state = 'Refresh' in decoded_content
         return self.login_state
@@ -110,6 +156,9 @@ class ToeflScraping(BaseWebScraping):
         decoded_content = res.text
         return 'RMB'.encode(self.encoding) in decoded_content
 
+    def is_session_alive(self):
+        return self.visit_homepage()
+
     def get_register_page_captcha(self):
         url = self.url_prefix + 'CityAdminTable'
         self.update_header({'Referer': self.url_prefix + 'MyHome?'})
@@ -132,7 +181,7 @@ class ToeflScraping(BaseWebScraping):
 
     def img_url_ruokuai(self, url):
         img_byte = self.url2byte(url)
-        captcha, err_msg = ruokuai.bypass_captcha(img_byte)
+        captcha, err_msg = self.captcha_solver(img_byte)
         if err_msg:
             if u'快豆不足' in err_msg:
                 print "Error msg: {}".format(err_msg)
@@ -141,14 +190,20 @@ class ToeflScraping(BaseWebScraping):
             self.logger.warn("RuoKuai error: {}".format(err_msg))
         return captcha
 
-    def seize_seats(self, month='201710', province='Shanghai'):
-        captcha_pass = False
-        decoded_content = ""
-        err_count = 0
-        while not captcha_pass:
-            err_count += 1
-            if err_count > 8:
-                raise ValueError("captcha err_count > 8 in seize seats")
+    def fetch_seats(self, month='201710', province='Shanghai'):
+        """
+        Query the seat table until the captcha passes.
+
+        Returns
+        -------
+        res : requests.Response
+        body : str or Parsed
+            The raw seat table, or Parsed(records) for a body parsed before.
+
+        """
+        key = ('SeatsQuery', month, province)
+        retry_captcha = u'请重新输入验证码'.encode(self.encoding)
+        for _ in range(8):
             url = self.url_prefix + r'SeatsQuery'
 
             captcha = self.get_register_page_captcha()
@@ -158,89 +213,94 @@ class ToeflScraping(BaseWebScraping):
                     'whichFirst': 'AS',
                     'afCalcResult': captcha,
                     '__act': '__id.34.AdminsSelected.adp.actListSelected',
-                    'submit.x': str(np.random.randint(-7, 7) + 45),
-                    'submit.y': str(np.random.randint(-7, 7) + 8)}
+                    'submit.x': str(random.randrange(-7, 7) + 45),
+                    'submit.y': str(random.randrange(-7, 7) + 8)}
 
             self.update_header({'Referer': self.url_prefix + 'CityAdminTable'})
             self.last_seat_query_url = url + '?' + self._dict_to_url(form)
             res = self.ses.post(url, form)
-            res.encoding = self.encoding
-            decoded_content = res.text
-
-            if u'请重新输入验证码' in decoded_content:
+            page = self.pages.lookup(key, res)
+            if page is not None:
+                # the same bytes as the last seat table, neither decoded nor parsed
+                return res, Parsed(page.value)
+            records = self.parse_cache.get('str2dic', res.content)
+            if records is not None:
+                # a seat table seen before, only seat tables are cached
+                self.pages.store(key, res, records)
+                return res, Parsed(records)
+
+            # the markers are searched in the raw bytes, only seat tables are decoded
+            if retry_captcha in res.content:
                 self.logger.info("Re-enter captcha in seize_seats.")
-            elif u'操作太频繁' in decoded_content:
-                sleep_len = 31 + np.random.rand() * 3
-                self.logger.info("Too frequent, sleep for {:.2f} seconds".format(sleep_len))
-                sleep(sleep_len)
+            elif any(m in res.content for m in self.throttle_markers):
+                # the session scheduler has slowed down this host, no new captcha is paid for before its hold is over
+                host = self.scheduler.for_url(url)
+                waited = host.cool_down() if host is not None else 0.
+                self.logger.info("Too frequent, waited {:.0f} s, rate of requests: {}".format(
+                    waited, self.scheduler.rates()))
             else:
-                captcha_pass = True
+                return res, res.content
+        raise ValueError("captcha err_count > 8 in seize seats")
 
-        time_dic = self.str2dic(decoded_content)
+    def store_seats(self, month, province, res, records):
+        """Remember the records parsed from the body of res."""
+        self.parse_cache.put('str2dic', res.content, records)
+        self.pages.store(('SeatsQuery', month, province), res, records)
 
-        register_res = self.process_time_dic(time_dic)
+    def seize_seats(self, month='201710', province='Shanghai'):
+        res, body = self.fetch_seats(month, province)
+        if isinstance(body, Parsed):
+            records = body.value
+        else:
+            res.encoding = self.encoding
+            with self.span('decode', 'SeatsQuery'):
+                decoded_content = res.text
+            with self.span('parse', 'SeatsQuery'):
+                records = self.str2dic(decoded_content)
+            self.store_seats(month, province, res, records)
+        return self.handle_seats(month, province, records)
+
+    def handle_seats(self, month, province, records):
+        """Log the changes, keep the history and register from the records of a seat table."""
+        for change in self.seat_changes.update((month, province), records):
+            self.logger.info(u"Seat changed in {} {}: {} -> {}".format(month, province, change.old, change.new))
+        self.seat_history.extend(records)
+        if self.snapshots is not None:
+            self.snapshots.add_seats(month, province, records, self.pages.digest(('SeatsQuery', month, province)))
+
+        with self.span('process', 'SeatsQuery'):
+            register_res = self.process_time_dic(records, province)
         return register_res
 
     def str2dic(self, s):
-        """Convert query results from html string to pd.DataFrame"""
-        time_dic = defaultdict(list)
+        """Convert query results from html string to a list of SeatRecord in page order."""
+        parser = parse_seat_table(s)
+        if not parser.row_count:
+            self.logger.warn("No sections in maincontent. HTML is:")
+            self.logger.info(self.excerpt(parser.main_text))
 
-        soup = BeautifulSoup(s, 'html.parser')
-        main = soup.find_all('div', {'id': 'maincontent'})[0]
+        return parser.records
+
+    def process_time_dic(self, records, province=None):
+        """
+        Register the open seats in the order of the seat preferences until one goes through.
+
+        records is a list of SeatRecord or a time dict, province that of the seat table.
+
+        """
+        if isinstance(records, dict):
+            records = time_dic_to_records(records)
 
-        sections_raw = main.find_all('tr')
-        if not sections_raw:
-            self.logger.warn("No sections in maincontent. HTML is:")
-            self.logger.info(main.text)
-            return time_dic
-
-        # E0E0E0 means time, CCCCCC means seat info
-        color_allowed = [u'#E0E0E0', u'#CCCCCC']
-        sections = filter(lambda x: x.attrs['bgcolor'] in color_allowed, sections_raw)
-
-        date = '0'*8
-        for sec in sections:
-            color = sec.attrs['bgcolor']
-
-            if color == color_allowed[0]:
-                date = sec.text.encode('ascii', 'ignore')[:9]
-            else:  # color == color_allowed[1]
-                tds = sec.find_all('td')
-
-                location = tds[2].text
-                status = tds[4].text
-                location_code = tds[1].text
-                if status == u'有名额':
-                    status_bool = True
-                elif status == u'名额已报满':
-                    status_bool = False
-                else:
-                    raise NotImplementedError(u"status = ".format(status))
-
-                site_dic = {'location': location,
-                            'status': status_bool,
-                            'location_code': location_code}
-                time_dic[date].append(site_dic)
-
-        return time_dic
-
-    def process_time_dic(self, d):
-        date_ddl = 20171018
         register_res = False
-        for date, sites in d.viewitems():
-            if int(date) > date_ddl:
-                continue
-
-            for site_dic in sites:
-                if site_dic['status']:
-                    print '='*10 + "Register! "
-                    print site_dic
-                    register_res = self.register(date, site_dic['location_code'])
-                    if register_res:
-                        self.logger.warn(u"Register! location={}, date={}".format(site_dic['location'], date))
-                        break
-            else:
-                self.logger.info("No sites available.")
+        for date, location_code, location, status in self.seat_selector.rank(records, province):
+            self.logger.info(u"Register! {} {}".format(location_code, location))
+            register_res = self.register(date, location_code)
+            if register_res:
+                self.logger.warn(u"Register! location={}, date={}".format(location, date))
+                self.seat_selector.accept(location_code)
+                break
+        if not register_res:
+            self.logger.info("No sites available.")
         return register_res
 
     def register(self, date, location_code):
@@ -259,64 +319,339 @@ class ToeflScraping(BaseWebScraping):
         res = self.ses.post(url, form)
         res.encoding = self.encoding
         decoded_content = res.text
-        self.logger.warn("Register response HTML:\n" + decoded_content)
+        self.logger.warn(u"Register response HTML:\n" + self.excerpt(decoded_content))
 
         return False
 
 
-def main_with_captcha():
+class AsyncToeflScraping(AsyncBaseWebScraping, ToeflScraping):
+    """ToeflScraping whose login and seat queries can run on a shared RequestEngine."""
+
+    def login_async(self):
+        return self.spawn(self.login)
+
+    def visit_homepage_async(self):
+        return self.spawn(self.visit_homepage)
+
+    def seize_seats_async(self, month='201710', province='Shanghai'):
+        return self.spawn(self.seize_seats, month, province)
+
+
+DEFAULT_CONFIG = r'E:\SYS Files\Documents\Python files\WebScraping\NJU_Login\jiaowu\SeizeCourse\toefl.json'
+
+
+def login_with_retry(grasper, retries=8):
+    """Resume the saved session or login, False if all retries failed."""
+    if grasper.resume_session():
+        return True
+
+    for _ in range(retries):
+        login_success = grasper.login()
+        homepage_success = grasper.visit_homepage()
+        if login_success and homepage_success:
+            grasper.save_session()
+            msg = 'User {} login success!'.format(grasper.user)
+            grasper.logger.info(msg)
+            return True
+    grasper.logger.warn("login retry = {}, sleep.".format(retries))
+    return False
+
+
+def main_with_captcha(props_path=DEFAULT_CONFIG):
     """Main function to add courses and priorities and grasp them."""
-    props_path = r'E:\SYS Files\Documents\Python files\WebScraping\NJU_Login\jiaowu\SeizeCourse\toefl.json'
-    err_count = 0
 
     grasper = ToeflScraping()
     grasper.init_from_config(props_path)
+    if not login_with_retry(grasper):
+        return
+
+    heartbeat = grasper.start_heartbeat()
+    try:
+        grasp_seats(grasper)
+    finally:
+        if heartbeat:
+            heartbeat.stop()
+        if grasper.snapshots is not None:
+            grasper.snapshots.close()
 
-    login_success = False
-    homepage_success = False
-    while not (login_success and homepage_success):
-        err_count += 1
-        if err_count > 8:
-            grasper.logger.warn("login retry = 8, sleep.")
-            return
-        login_success = grasper.login()
-        homepage_success = grasper.visit_homepage()
-    msg = 'User {} login success!'.format(grasper.user)
-    grasper.logger.info(msg)
+    del grasper
 
+
+def grasp_seats(grasper):
+    profiler = LoopProfiler.from_env(grasper.logger)
+    planner = grasper.planner
     for i in range(300):
-        # raw = raw_input("Input month.city, eg: [YYYYMM].[Shanghai]")
-        rand = np.random.rand()
-        if rand > 0.66:
-            raw = '201710.Jiangsu'
-        elif rand > 0.33:
-            raw = '201710.Zhejiang'
-        else:
-            raw = "201710.Shanghai"
+        if not grasper.login_state and not login_with_retry(grasper):
+            return
 
-        if raw:
-            month, city = raw.split('.')
-        else:
-            month, city = "201710.Shanghai".split('.')
+        # the seat table most likely to have changed, as often as the budget allows
+        (month, city), wait = planner.next()
+        sleep(wait)
 
         if i % 1 == 0:
             grasper.logger.info("grasping... count={} month={}, city={}".format(i, month, city))
-
-        register_success = grasper.seize_seats(month, city)
+        if i % 50 == 0:
+            grasper.logger.info("connections: {}".format(grasper.connection_stats()))
+            grasper.logger.info(grasper.parse_cache.summary())
+            grasper.logger.info("polling: {}".format(planner.summary()))
+            grasper.metrics.flush()
+            grasper.trim_session()
+            # keep the cookies the site has rotated since the login
+            grasper.save_session()
+
+        key = ('SeatsQuery', month, city)
+        digest = grasper.pages.digest(key)
+        with profiler.iteration(), grasper.span('seize_seats'):
+            register_success = grasper.seize_seats(month, city)
+        planner.observe((month, city), grasper.pages.digest(key) != digest)
         if register_success:
             grasper.logger.warn("register success!")
             raise ValueError("register success!")
-        sleep(2)
 
-    del grasper
 
+def main_concurrent(month='201710', provinces=('Shanghai', 'Jiangsu', 'Zhejiang'), max_concurrency=3,
+                    props_path=DEFAULT_CONFIG):
+    """Check several provinces at the same time, one session per province on a shared engine."""
+
+    engine = RequestEngine(max_concurrency)
+    try:
+        graspers = []
+        for _ in provinces:
+            grasper = AsyncToeflScraping(engine)
+            grasper.init_from_config(props_path)
+            graspers.append(grasper)
+
+        for _ in range(8):
+            pending = [g for g in graspers if not g.login_state]
+            if not pending:
+                break
+            gather([g.login_async() for g in pending])
+        # the last round may have logged in the rest
+        if not all(g.login_state for g in graspers):
+            graspers[0].logger.warn("login retry = 8, sleep.")
+            return
+        gather([g.visit_homepage_async() for g in graspers])
 
-if __name__ == "__main__":
+        for i in range(300):
+            graspers[0].logger.info("grasping... count={} month={}, provinces={}".format(i, month, provinces))
+            results = gather([g.seize_seats_async(month, p) for g, p in zip(graspers, provinces)])
+            if any(results):
+                graspers[0].logger.warn("register success!")
+                raise ValueError("register success!")
+    finally:
+        engine.close()
+
+
+def _fetch_seats(item):
+    grasper, month, province = item
+    with grasper.query_lock:
+        return grasper.fetch_seats(month, province)
+
+
+def main_pipeline(month='201710', provinces=('Shanghai', 'Jiangsu', 'Zhejiang'), parsers=None,
+                  props_path=DEFAULT_CONFIG):
+    """
+    Check several provinces with the seat tables fetched in threads and parsed in processes.
+
+    One session per province, as in main_concurrent; the records are
+    handled in the order of the queries.
+
+    """
+    graspers = []
+    for _ in provinces:
+        grasper = ToeflScraping()
+        grasper.init_from_config(props_path)
+        # one saved session would be shared by all provinces
+        grasper.session_store = None
+        if not login_with_retry(grasper):
+            return
+        graspers.append(grasper)
+
+    queries = ((g, month, p) for i in range(300) for g, p in zip(graspers, provinces))
+    with Pipeline(fetchers=len(graspers), parsers=parsers) as pipeline:
+        for i, result in enumerate(pipeline.run(_fetch_seats, parse_seat_page, queries)):
+            grasper, month, province = result.item
+            if i % len(graspers) == 0:
+                grasper.logger.info("grasping... count={} month={}, provinces={}".format(
+                    i // len(graspers), month, provinces))
+            if result.parsed:
+                grasper.store_seats(month, province, result.context, result.value)
+            if grasper.handle_seats(month, province, result.value):
+                grasper.logger.warn("register success!")
+                raise ValueError("register success!")
+
+
+def run_forever(main=main_with_captcha, pause=61):
+    """Restart main after any error until it raises ShouldTerminateException."""
     while True:
         try:
-            main_with_captcha()
-            sleep(61)
+            main()
+            sleep(pause)
         except ShouldTerminateException:
             break
         except Exception, e:
             print "except in main: {}".format(e)
+
+
+def test_seize_seats_unchanged():
+    from scheduler import RequestScheduler
+    from parsecache import ParseCache
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    server = StandInServer(load_exchanges(fixture_path('toefl'))).start()
+    calls = []
+
+    def new_grasper():
+        grasper = ToeflScraping()
+        grasper.scheduler = RequestScheduler(enabled=False)
+        grasper.refresh_session()
+        grasper.url_prefix = 'https://toefl.etest.net.cn/cn/'
+        grasper.captcha_solver = lambda img: ('abcd', None)
+        grasper.register = lambda date, location_code: False
+        parse = grasper.str2dic
+        grasper.str2dic = lambda s: calls.append(s) or parse(s)
+        server.attach(grasper)
+        return grasper
+
+    ToeflScraping.parse_cache = ParseCache()
+    try:
+        grasper = new_grasper()
+        for _ in range(3):
+            grasper.seize_seats('201710', 'Jiangsu')
+        assert len(calls) == 1 and grasper.pages.stats['unchanged'] == 2
+        grasper.log_payload_limit = 10
+        assert grasper.excerpt(u'x' * 25) == u'x' * 10 + u'... [15 more characters]'
+        assert len(grasper.seat_history) == 3 * len(grasper.seat_history.snapshot())
+
+        # a seat table parsed by another scraper
+        new_grasper().seize_seats('201710', 'Jiangsu')
+        assert len(calls) == 1 and ToeflScraping.parse_cache.stats['hits'] == 1
+    finally:
+        del ToeflScraping.parse_cache
+        server.stop()
+
+    print 'seize seats unchanged test passed'
+
+
+def test_fetch_seats_throttled():
+    from scheduler import RequestScheduler
+    from replay import StandInServer, load_exchanges, fixture_path, THROTTLE_PAGE
+
+    exchanges = load_exchanges(fixture_path('toefl'))
+    table = [ex for ex in exchanges if ex['params'].get('mvfSiteProvinces') == 'Jiangsu'][0]
+    # the first query of the table is answered with the throttling page
+    exchanges.insert(exchanges.index(table), dict(table, content=THROTTLE_PAGE.encode('gb2312')))
+    server = StandInServer(exchanges).start()
+
+    now = [1000.]
+
+    def sleeper(sec):
+        now[0] += sec
+
+    solved = []
+    grasper = ToeflScraping()
+    grasper.scheduler = RequestScheduler(hold=30., clock=lambda: now[0], sleeper=sleeper)
+    grasper.refresh_session()
+    grasper.url_prefix = 'https://toefl.etest.net.cn/cn/'
+    grasper.captcha_solver = lambda img: solved.append(now[0]) or ('abcd', None)
+    server.attach(grasper)
+    try:
+        res, body = grasper.fetch_seats('201710', 'Jiangsu')
+    finally:
+        server.stop()
+
+    assert body == table['content']
+    # one more captcha, solved once the hold of the throttle was over
+    assert len(solved) == 2 and solved[1] - solved[0] >= 30., solved
+    assert grasper.scheduler.snapshot()['toefl.etest.net.cn']['throttles'] == 1
+
+    print 'fetch seats throttled test passed'
+
+
+def test_resume_session():
+    import shutil
+    import tempfile
+    from scheduler import RequestScheduler
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    server = StandInServer(load_exchanges(fixture_path('toefl'))).start()
+    config_path = os.path.join(tempfile.mkdtemp(), 'toefl.json')
+
+    logins = []
+
+    def new_grasper():
+        grasper = ToeflScraping()
+        grasper.scheduler = RequestScheduler(enabled=False)
+        grasper.refresh_session()
+        grasper.url_prefix = 'https://toefl.etest.net.cn/cn/'
+        grasper.user = 'NEEA1234'
+        grasper.captcha_solver = lambda img: ('abcd', None)
+        grasper.session_store = SessionStore.from_dict({}, config_path)
+        login = grasper.login
+        grasper.login = lambda: logins.append(1) or login()
+        server.attach(grasper)
+        return grasper
+
+    try:
+        assert login_with_retry(new_grasper()) and len(logins) == 1
+
+        # a restart
+        served = server.stats['served']
+        grasper = new_grasper()
+        assert login_with_retry(grasper) and grasper.login_state and len(logins) == 1
+        assert server.stats['served'] == served + 1  # only the homepage
+        assert grasper.ses.cookies.get('JSESSIONID') == '0123456789ABCDEF'
+
+        # the site has dropped the session
+        grasper = new_grasper()
+        grasper.is_session_alive = lambda: False
+        assert not grasper.resume_session() and not grasper.ses.cookies
+        assert not new_grasper().resume_session()  # the saved session was deleted
+    finally:
+        server.stop()
+        shutil.rmtree(os.path.dirname(config_path))
+
+    print 'resume session test passed'
+
+
+def test_pipeline_seats():
+    from scheduler import RequestScheduler
+    from seatparser import load_fixture
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    server = StandInServer(load_exchanges(fixture_path('toefl')), latency=0.01).start()
+    provinces = ['Shanghai', 'Jiangsu', 'Zhejiang']
+    graspers, handled = [], []
+    for _ in provinces:
+        grasper = ToeflScraping()
+        grasper.scheduler = RequestScheduler(enabled=False)
+        grasper.refresh_session()
+        grasper.url_prefix = 'https://toefl.etest.net.cn/cn/'
+        grasper.captcha_solver = lambda img: ('abcd', None)
+        grasper.register = lambda date, location_code: False
+        server.attach(grasper)
+        graspers.append(grasper)
+
+    queries = [(g, '201710', p) for g, p in zip(graspers, provinces)]
+    try:
+        with Pipeline(fetchers=3, parsers=2) as pipeline:
+            # the first round is stored before the second is fetched, which then finds it unchanged
+            for _ in range(2):
+                for result in pipeline.run(_fetch_seats, parse_seat_page, queries):
+                    grasper, month, province = result.item
+                    if result.parsed:
+                        grasper.store_seats(month, province, result.context, result.value)
+                    handled.append((province, result.parsed, result.value))
+    finally:
+        server.stop()
+
+    assert [h[0] for h in handled] == provinces * 2
+    assert [h[1] for h in handled] == [True] * 3 + [False] * 3  # the second round is unchanged
+    expected = ToeflScraping().str2dic(load_fixture('seats_query_nested.html'))
+    assert handled[2][2] == expected and handled[5][2] is handled[2][2]
+
+    print 'pipeline seats test passed'
+
+
+if __name__ == "__main__":
+    run_forever()
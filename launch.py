@@ -0,0 +1,270 @@
+# encoding: utf-8
+
+"""
+Fire course submits at a known opening time, by the clock of the server.
+
+The Date header of a response tells the server second when it was handled.
+A request sent at t0 and answered at t1 with Date s bounds the offset of
+the server clock to [s - t1, s + 1 - t0].  ClockSync times every further
+sample so that, by the current estimate, it reaches the server at a second
+boundary: whichever side of it the Date falls on halves the interval, down
+to about the round-trip time.
+
+LaunchScheduler sleeps until shortly before the opening, synchronises the
+clock, warms the session, connections and prepared requests up, then sends
+the submits so that they arrive at the corrected instant.
+
+"""
+import re
+import math
+import calendar
+from time import time, sleep, strptime
+from email.utils import parsedate_tz, mktime_tz
+from collections import namedtuple
+
+
+# offset: server clock minus local clock, error: half width of the interval it lies in
+ClockEstimate = namedtuple('ClockEstimate', ['offset', 'error', 'rtt'])
+
+# jw publishes the opening times in Beijing time, whatever the zone of the machine
+DEFAULT_TZ = '+08:00'
+
+
+def date_header_seconds(res):
+    """Seconds since epoch of the Date header of res, None without one."""
+    date = res.headers.get('Date')
+    parsed = parsedate_tz(date) if date else None
+    return mktime_tz(parsed) if parsed else None
+
+
+class ClockSync(object):
+    """
+    Parameters
+    ----------
+    samples : int, default 6
+        Requests sent, each one may wait up to a second for its instant.
+    clock, sleeper : callable
+        Replaceable in tests.
+
+    """
+    def __init__(self, samples=6, clock=time, sleeper=sleep):
+        self.samples = samples
+        self.clock = clock
+        self.sleeper = sleeper
+
+    def estimate(self, ses, url):
+        """ClockEstimate of the server of url, from GET requests sent by ses."""
+        lo, hi = -float('inf'), float('inf')
+        rtt = None
+        for _ in range(self.samples):
+            if rtt is not None:
+                # reach the server when, by the middle of the interval, its second turns
+                mid = (lo + hi) / 2.
+                now = self.clock()
+                t0 = math.ceil(now + rtt / 2. + mid) - mid - rtt / 2.
+                self.sleeper(max(0., t0 - now))
+
+            t0 = self.clock()
+            res = ses.get(url)
+            t1 = self.clock()
+            s = date_header_seconds(res)
+            if s is None:
+                raise ValueError("No Date header in the response of {}".format(url))
+
+            rtt = t1 - t0 if rtt is None else min(rtt, t1 - t0)
+            lo, hi = max(lo, s - t1), min(hi, s + 1 - t0)
+            if lo > hi:
+                # the server clock stepped meanwhile, start over from this sample
+                lo, hi = s - t1, s + 1 - t0
+        return ClockEstimate((lo + hi) / 2., (hi - lo) / 2., rtt)
+
+
+def utc_offset_seconds(tz):
+    """Seconds east of UTC of an offset as '+08:00' or '-0500'."""
+    m = re.match(r'^([+-])(\d\d):?(\d\d)$', tz)
+    if not m:
+        raise ValueError("Bad UTC offset {!r}, expected as '+08:00'.".format(tz))
+    sign, hours, minutes = m.groups()
+    return (-1 if sign == '-' else 1) * (int(hours) * 3600 + int(minutes) * 60)
+
+
+def parse_open_at(value, tz=DEFAULT_TZ):
+    """Seconds since epoch of 'YYYY-mm-dd HH:MM:SS' at the UTC offset tz, numbers are taken as they are."""
+    if isinstance(value, basestring):
+        return calendar.timegm(strptime(value, '%Y-%m-%d %H:%M:%S')) - utc_offset_seconds(tz)
+    return float(value)
+
+
+class LaunchScheduler(object):
+    """
+    Submit courses at an opening time.
+
+    Parameters
+    ----------
+    grasper : CourseGrasper
+        Logged in.
+    open_at : float
+        Seconds since epoch by the server clock.
+    courses : list of JwCourse
+        Submitted in this order at every attempt.
+    prewarm : float, default 20.
+        Seconds before open_at to synchronise the clock and warm up.
+    attempts : int, default 3
+    spacing : float, default 0.2
+        Seconds between attempts.
+    sync_samples : int, default 6
+    sync_path : str
+        Page under the grasper's url_prefix requested to read the server clock.
+
+    """
+    def __init__(self, grasper, open_at, courses, prewarm=20., attempts=3, spacing=0.2, sync_samples=6,
+                 sync_path='student/elective/index.do', clock=time, sleeper=sleep):
+        self.grasper = grasper
+        self.open_at = open_at
+        self.courses = list(courses)
+        self.prewarm = prewarm
+        self.attempts = attempts
+        self.spacing = spacing
+        self.sync_path = sync_path
+        self.clock = clock
+        self.sleeper = sleeper
+        self.sync = ClockSync(sync_samples, clock, sleeper)
+        self.estimate = None
+
+    @classmethod
+    def from_dict(cls, grasper, dic, courses):
+        """The scheduler of the 'launch' entry of a config, 'open_at' and 'tz' as in parse_open_at."""
+        dic = dict(dic)
+        dic.pop('courses', None)
+        open_at = parse_open_at(dic.pop('open_at'), dic.pop('tz', DEFAULT_TZ))
+        return cls(grasper, open_at, courses, **dic)
+
+    def sleep_until(self, t):
+        """Sleep until local time t, the last few ms in short sleeps for their granularity."""
+        while True:
+            left = t - self.clock()
+            if left <= 0:
+                return
+            self.sleeper(left - 0.02 if left > 0.05 else min(left, 0.001))
+
+    def warm_up(self):
+        """Login again if the session expired and warm the courses up, returns whether logged in."""
+        grasper = self.grasper
+        if not grasper.is_session_alive():
+            grasper.logger.warn("Session expired before the launch, login again.")
+            grasper.login()
+            if not grasper.login_state:
+                grasper.logger.error("Login failed before the launch.")
+                return False
+        for course_obj in self.courses:
+            grasper.warm_up(course_obj)
+        return True
+
+    def run(self):
+        """
+        Returns
+        -------
+        success : bool
+            Whether a submit was accepted.
+
+        """
+        grasper = self.grasper
+        logger = grasper.logger
+        # the local clock is good enough for the time to start
+        self.sleep_until(self.open_at - self.prewarm)
+
+        # the samples and the submits are timed, a wait for a token of the scheduler would shift them
+        with grasper.ses.unscheduled():
+            est = self.estimate = self.sync.estimate(grasper.ses, grasper.url_prefix + self.sync_path)
+        logger.info("Server clock offset {:+.3f} s +- {:.3f} s, rtt {:.0f} ms.".format(
+            est.offset, est.error, est.rtt * 1e3))
+        if not self.warm_up():
+            return False
+
+        # sent half a round trip early, to be handled at open_at
+        fire_at = self.open_at - est.offset - est.rtt / 2.
+        logger.info("Launch in {:.1f} s.".format(fire_at - self.clock()))
+        self.sleep_until(fire_at)
+
+        with grasper.ses.unscheduled():
+            return self._fire(fire_at)
+
+    def _fire(self, fire_at):
+        grasper = self.grasper
+        logger = grasper.logger
+        for attempt in range(self.attempts):
+            if attempt:
+                self.sleep_until(fire_at + attempt * self.spacing)
+            for course_obj in self.courses:
+                prepared = grasper.course_requests(course_obj)
+                sent = self.clock()
+                res = grasper.send_prepared(prepared.submit, prepared.send_kwargs)
+                err_msg = grasper.check_res(res)
+                logger.info(u"Attempt {} of {}: sent {:+.1f} ms from the corrected instant, "
+                            u"server Date {}, {}".format(attempt + 1, course_obj, (sent - fire_at) * 1e3,
+                                                         res.headers.get('Date'), err_msg or 'success'))
+                if not err_msg:
+                    return True
+        return False
+
+
+def test_clock_sync():
+    now = [1000.3]
+    true_offset, rtt = 2.345, 0.04
+
+    def sleeper(sec):
+        now[0] += sec
+
+    class Session(object):
+        def get(self, url):
+            from requests.models import Response
+            from email.utils import formatdate
+            now[0] += rtt / 2.
+            res = Response()
+            res.headers['Date'] = formatdate(int(now[0] + true_offset), usegmt=True)
+            now[0] += rtt / 2.
+            return res
+
+    est = ClockSync(samples=8, clock=lambda: now[0], sleeper=sleeper).estimate(Session(), 'http://x/')
+    assert abs(est.offset - true_offset) <= est.error + 1e-9, est
+    assert est.error < rtt and abs(est.rtt - rtt) < 1e-9, est
+    assert now[0] - 1000.3 < 8.
+
+    assert parse_open_at(12.5) == 12.5
+    # 04:30 UTC whatever the zone of the machine
+    assert parse_open_at('2017-09-04 12:30:00') == 1504499400
+    assert parse_open_at('2017-09-04 12:30:00', '+0000') == 1504528200
+    assert parse_open_at('2017-09-03 23:30:00', '-05:00') == 1504499400
+    try:
+        parse_open_at('2017-09-04 12:30:00', 'CST')
+        assert False
+    except ValueError:
+        pass
+
+    import logging
+    logging.getLogger('launch-test').addHandler(logging.NullHandler())
+
+    class Grasper(object):
+        logger = logging.getLogger('launch-test')
+        login_state = False
+        warmed = []
+
+        def is_session_alive(self):
+            return False
+
+        def login(self):
+            self.login_state = False
+
+        def warm_up(self, course_obj):
+            self.warmed.append(course_obj)
+
+    grasper = Grasper()
+    assert not LaunchScheduler(grasper, 0., ['course']).warm_up() and not grasper.warmed
+    grasper.login = lambda: setattr(grasper, 'login_state', True)
+    assert LaunchScheduler(grasper, 0., ['course']).warm_up() and grasper.warmed == ['course']
+
+    print 'clock sync test passed'
+
+
+if __name__ == '__main__':
+    test_clock_sync()
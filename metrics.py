@@ -0,0 +1,218 @@
+# encoding: utf-8
+
+"""
+Per-request timing of BaseWebScraping sessions.
+
+TunedAdapter reports, for each request, the time spent in the phases
+connect (DNS lookup and TCP handshake, only for a new connection), tls,
+ttfb (waiting for the response headers), download and total, plus the
+body size.  Scrapers add named spans, e.g. the decode and parse time of a
+page.  Everything is aggregated into histograms per endpoint, which can be
+written as a Prometheus text snapshot, and optionally streamed as JSON lines.
+
+"""
+import os
+import json
+import threading
+from time import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+SECOND_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+PHASES = ('connect', 'tls', 'ttfb', 'download', 'total')
+
+_local = threading.local()
+
+
+def start_phases():
+    """Open a fresh phase record for the request sent by the current thread."""
+    _local.phases = dict.fromkeys(PHASES[:2], 0.)
+    return _local.phases
+
+
+def add_phase(name, seconds):
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[name] = phases.get(name, 0.) + seconds
+
+
+def phase_total(name):
+    phases = getattr(_local, 'phases', None)
+    return phases.get(name, 0.) if phases else 0.
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed upper bounds, as in Prometheus."""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns [(le, count)] with le as Prometheus prints it."""
+        res = []
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'), ), self.counts):
+            total += n
+            res.append(('+Inf' if bound == float('inf') else repr(bound), total))
+        return res
+
+
+class MetricsRegistry(object):
+    """
+    Histograms keyed by metric name and labels.
+
+    Attributes
+    ----------
+    jsonl_path : str or None
+        If set, every request record and span is appended there as one JSON line.
+    prometheus_path : str or None
+        Where flush writes the Prometheus text snapshot.
+
+    """
+    HELP = {'scraping_request_seconds': 'Time per request phase.',
+            'scraping_response_bytes': 'Size of response bodies on the wire.',
+            'scraping_span_seconds': 'Time of named spans, e.g. decode and parse.',
+            'scraping_saved_seconds': 'Estimated time of requests left out, e.g. skipped warm-ups.'}
+
+    def __init__(self, jsonl_path=None, prometheus_path=None):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.errors = dict()
+        self.__histograms = dict()
+        self.__lock = threading.Lock()
+        self.__jsonl = None
+
+    def configure(self, jsonl_path=None, prometheus_path=None):
+        with self.__lock:
+            if self.__jsonl:
+                self.__jsonl.close()
+                self.__jsonl = None
+            self.jsonl_path = jsonl_path
+            self.prometheus_path = prometheus_path
+
+    def observe(self, metric, labels, value, buckets=SECOND_BUCKETS):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.__lock:
+            hist = self.__histograms.get(key)
+            if hist is None:
+                hist = self.__histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+    def histogram(self, metric, **labels):
+        return self.__histograms.get((metric, tuple(sorted(labels.items()))))
+
+    def _write_record(self, record):
+        if not self.jsonl_path:
+            return
+        line = json.dumps(record, sort_keys=True)
+        with self.__lock:
+            if self.__jsonl is None:
+                self.__jsonl = open(self.jsonl_path, 'a', 1)
+            self.__jsonl.write(line + '\n')
+
+    def record_request(self, endpoint, method, status, phases, wire_bytes):
+        for phase in PHASES:
+            if phase in phases:
+                self.observe('scraping_request_seconds', {'endpoint': endpoint, 'phase': phase}, phases[phase])
+        if wire_bytes is not None:
+            self.observe('scraping_response_bytes', {'endpoint': endpoint}, wire_bytes, BYTE_BUCKETS)
+
+        record = dict(phases, ts=time(), endpoint=endpoint, method=method, status=status, bytes=wire_bytes)
+        self._write_record(record)
+
+    def record_error(self, endpoint, error):
+        with self.__lock:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        self._write_record({'ts': time(), 'endpoint': endpoint, 'error': error.__class__.__name__})
+
+    @contextmanager
+    def span(self, name, endpoint=''):
+        start = time()
+        try:
+            yield
+        finally:
+            seconds = time() - start
+            self.observe('scraping_span_seconds', {'span': name, 'endpoint': endpoint}, seconds)
+            self._write_record({'ts': start, 'span': name, 'endpoint': endpoint, 'seconds': seconds})
+
+    def prometheus_text(self):
+        with self.__lock:
+            items = sorted(self.__histograms.items())
+            errors = sorted(self.errors.items())
+
+        lines = []
+        last_metric = None
+        for (metric, labels), hist in items:
+            if metric != last_metric:
+                lines.append('# HELP {} {}'.format(metric, self.HELP.get(metric, metric)))
+                lines.append('# TYPE {} histogram'.format(metric))
+                last_metric = metric
+            label_str = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            for le, n in hist.cumulative():
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, label_str, le, n))
+            lines.append('{}_sum{{{}}} {!r}'.format(metric, label_str, hist.sum))
+            lines.append('{}_count{{{}}} {}'.format(metric, label_str, hist.count))
+
+        if errors:
+            lines.append('# HELP scraping_request_errors_total Requests failed without a response.')
+            lines.append('# TYPE scraping_request_errors_total counter')
+            for endpoint, n in errors:
+                lines.append('scraping_request_errors_total{{endpoint="{}"}} {}'.format(endpoint, n))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_path):
+        """Write the snapshot to a temporary file first, so scrapers never read half a file."""
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.rename(tmp_path, file_path)
+
+    def flush(self):
+        if self.prometheus_path:
+            self.write_prometheus(self.prometheus_path)
+
+
+def test_metrics_registry():
+    import os
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp()
+    registry = MetricsRegistry(jsonl_path=os.path.join(tmp_dir, 'requests.jsonl'),
+                               prometheus_path=os.path.join(tmp_dir, 'metrics.prom'))
+    registry.record_request('SeatsQuery', 'POST', 200,
+                            {'connect': 0.02, 'tls': 0., 'ttfb': 0.3, 'download': 0.004, 'total': 0.33}, 20000)
+    registry.record_request('SeatsQuery', 'POST', 200, {'ttfb': 0.05, 'total': 0.06}, 3000)
+    with registry.span('parse', 'SeatsQuery'):
+        pass
+    registry.record_error('login', IOError())
+    registry.flush()
+
+    hist = registry.histogram('scraping_request_seconds', endpoint='SeatsQuery', phase='ttfb')
+    assert hist.count == 2 and abs(hist.sum - 0.35) < 1e-9
+    assert dict(hist.cumulative())['0.1'] == 1 and dict(hist.cumulative())['+Inf'] == 2
+
+    text = open(registry.prometheus_path).read()
+    assert 'scraping_request_seconds_bucket{endpoint="SeatsQuery",phase="ttfb",le="0.5"} 2' in text
+    assert 'scraping_response_bytes_count{endpoint="SeatsQuery"} 2' in text
+    assert 'scraping_span_seconds_count{endpoint="SeatsQuery",span="parse"} 1' in text
+    assert 'scraping_request_errors_total{endpoint="login"} 1' in text
+
+    registry.configure()  # closes the JSON lines file
+    records = [json.loads(l) for l in open(os.path.join(tmp_dir, 'requests.jsonl'))]
+    assert len(records) == 4 and records[2]['span'] == 'parse' and records[3]['error'] == 'IOError'
+
+    print 'metrics registry test passed'
+
+
+if __name__ == '__main__':
+    test_metrics_registry()
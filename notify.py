@@ -0,0 +1,323 @@
+# encoding: utf-8
+
+"""
+Notifications dispatched to pluggable sinks from a background thread.
+
+Notifier.notify only puts the notification on a queue, so a sound being
+played or a slow webhook never stalls the poll loop.  A notification with
+the same key as one sent within dedup_window seconds is dropped, and the
+sinks run at most once every min_interval seconds: the notifications
+queued meanwhile are coalesced into one.
+
+A sink is any object with a send(notification) method, e.g.::
+
+    notifier = Notifier([LogSink(logger), SoundSink(), WebhookSink('http://127.0.0.1:8000/hook'),
+                         MailboxSink('mailbox')])
+    notifier.notify('renew-started', 'Course renew started', 'Go check the course!')
+
+"""
+import os
+import sys
+import json
+import Queue
+import logging
+import threading
+from time import time
+from collections import namedtuple
+
+
+Notification = namedtuple('Notification', ['key', 'title', 'message', 'ts'])
+
+
+class LogSink(object):
+    def __init__(self, logger, level=logging.WARN):
+        self.logger = logger
+        self.level = level
+
+    def send(self, notification):
+        self.logger.log(self.level, u"{}: {}".format(notification.title, notification.message))
+
+
+class SoundSink(object):
+    """
+    Play a sound file with winsound, ring the terminal bell where it is missing.
+
+    Parameters
+    ----------
+    sound_path : str, default None
+        .wav file, the default system sound if None.
+
+    """
+    def __init__(self, sound_path=None):
+        self.sound_path = sound_path
+
+    def send(self, notification):
+        try:
+            import winsound
+        except ImportError:  # not on Windows
+            sys.stdout.write('\a')
+            sys.stdout.flush()
+            return
+        if self.sound_path:
+            winsound.PlaySound(self.sound_path, winsound.SND_FILENAME)
+        else:
+            winsound.PlaySound('SystemExclamation', winsound.SND_ALIAS)
+
+
+class WebhookSink(object):
+    """POST the notification as JSON to url."""
+    def __init__(self, url, timeout=5.):
+        self.url = url
+        self.timeout = timeout
+        self.__session = None
+
+    def send(self, notification):
+        import requests
+
+        if self.__session is None:
+            self.__session = requests.Session()
+        res = self.__session.post(self.url, data=json.dumps(notification._asdict()),
+                                  headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+        res.raise_for_status()
+
+
+class MailboxSink(object):
+    """
+    One JSON file per notification in directory.
+
+    Files are written under a temporary name first, so a reader listing
+    *.json never gets half a file; it deletes the files it has handled.
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.__count = 0
+
+    def send(self, notification):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.__count += 1
+        name = '{:.6f}-{}-{}'.format(notification.ts, os.getpid(), self.__count)
+        file_path = os.path.join(self.directory, name + '.json')
+        tmp_path = os.path.join(self.directory, name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(notification._asdict(), f)
+        os.rename(tmp_path, file_path)
+
+
+class Notifier(object):
+    """
+    Parameters
+    ----------
+    sinks : list
+        Objects with a send(notification) method.
+    dedup_window : float, default 60.
+        Seconds during which a notification with the key of a sent one is dropped.
+    min_interval : float, default 5.
+        Seconds between two dispatches to the sinks.
+    max_queue : int, default 100
+        Notifications waiting for the worker, newer ones are dropped beyond it.
+    logger : logging.Logger, default None
+        Where the failures of sinks go.
+
+    Attributes
+    ----------
+    stats : dict
+        Counts of 'sent' notifications, 'deduped', 'coalesced' into another
+        one, 'dropped' on a full queue and 'failed' sink calls.
+
+    """
+    def __init__(self, sinks, dedup_window=60., min_interval=5., max_queue=100, logger=None, clock=time):
+        self.sinks = list(sinks)
+        self.dedup_window = dedup_window
+        self.min_interval = min_interval
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.stats = {'sent': 0, 'deduped': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0}
+
+        self.__clock = clock
+        self.__queue = Queue.Queue(max_queue)
+        self.__last_sent = dict()  # key -> time it was last accepted
+        self.__last_dispatch = None
+        self.__lock = threading.Lock()
+        self.__worker = None
+        self.__closed = threading.Event()
+
+    @classmethod
+    def from_dict(cls, dic, logger):
+        """
+        The notifier of the 'notify' entry of a config.
+
+        Keys 'sound' (true or a .wav path), 'webhook' (URL) and 'mailbox'
+        (directory) add sinks to the log sink, the others are passed on.
+
+        """
+        dic = dict(dic)
+        sinks = [LogSink(logger)]
+        sound = dic.pop('sound', True)
+        if sound:
+            sinks.append(SoundSink(sound if isinstance(sound, basestring) else None))
+        webhook = dic.pop('webhook', None)
+        if webhook:
+            sinks.append(WebhookSink(webhook))
+        mailbox = dic.pop('mailbox', None)
+        if mailbox:
+            sinks.append(MailboxSink(mailbox))
+        return cls(sinks, logger=logger, **dic)
+
+    def notify(self, key, title, message=u''):
+        """
+        Queue a notification, never blocks.
+
+        Returns
+        -------
+        queued : bool
+            False if it was deduplicated or the queue is full.
+
+        """
+        now = self.__clock()
+        with self.__lock:
+            last = self.__last_sent.get(key)
+            if last is not None and now - last < self.dedup_window:
+                self.stats['deduped'] += 1
+                return False
+            self.__last_sent[key] = now
+            if len(self.__last_sent) > 1024:
+                for k, t in self.__last_sent.items():
+                    if now - t >= self.dedup_window:
+                        del self.__last_sent[k]
+            if self.__worker is None:
+                self.__worker = threading.Thread(target=self._run, name='notifier')
+                self.__worker.daemon = True
+                self.__worker.start()
+        try:
+            self.__queue.put_nowait(Notification(key, title, message, now))
+        except Queue.Full:
+            with self.__lock:
+                self.stats['dropped'] += 1
+            return False
+        return True
+
+    def _drain(self):
+        notifications = []
+        while True:
+            try:
+                notifications.append(self.__queue.get_nowait())
+            except Queue.Empty:
+                return notifications
+
+    @staticmethod
+    def coalesce(notifications):
+        """One notification standing for several."""
+        if len(notifications) == 1:
+            return notifications[0]
+        return Notification(tuple(n.key for n in notifications),
+                            u'{} notifications'.format(len(notifications)),
+                            u'\n'.join(u'{}: {}'.format(n.title, n.message) for n in notifications),
+                            notifications[-1].ts)
+
+    def dispatch(self, notification):
+        for sink in self.sinks:
+            try:
+                sink.send(notification)
+            except Exception, e:
+                self.stats['failed'] += 1
+                self.logger.warn("Notification sink {} failed: {}".format(sink.__class__.__name__, e))
+        self.__last_dispatch = self.__clock()
+
+    def _run(self):
+        while not self.__closed.is_set():
+            try:
+                first = self.__queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            if self.__last_dispatch is not None:
+                # a burst keeps queueing while the interval runs out
+                self.__closed.wait(max(0., self.__last_dispatch + self.min_interval - self.__clock()))
+            notifications = [first] + self._drain()
+            with self.__lock:
+                self.stats['sent'] += len(notifications)
+                self.stats['coalesced'] += len(notifications) - 1
+            self.dispatch(self.coalesce(notifications))
+            for _ in notifications:
+                self.__queue.task_done()
+
+    def flush(self):
+        """Wait until every queued notification has been dispatched."""
+        self.__queue.join()
+
+    def close(self):
+        self.__closed.set()
+        if self.__worker is not None:
+            self.__worker.join()
+
+
+def test_notifier():
+    import shutil
+    import tempfile
+    import BaseHTTPServer
+    from time import sleep
+
+    posted = []
+
+    class Hook(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            posted.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Hook)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    class SlowSink(object):
+        def __init__(self):
+            self.received = []
+
+        def send(self, notification):
+            sleep(0.2)  # a sound being played
+            self.received.append(notification)
+
+    class BrokenSink(object):
+        def send(self, notification):
+            raise IOError('no device')
+
+    mailbox = tempfile.mkdtemp()
+    slow = SlowSink()
+    logger = logging.getLogger('notifier')
+    logger.addHandler(logging.NullHandler())
+    notifier = Notifier([slow, BrokenSink(), MailboxSink(mailbox),
+                         WebhookSink('http://127.0.0.1:{}/hook'.format(server.server_port))],
+                        dedup_window=10., min_interval=0.3, logger=logger)
+    try:
+        start = time()
+        assert notifier.notify('renew-started', 'Course renew started', 'Go check it!')
+        assert not notifier.notify('renew-started', 'Course renew started', 'Go check it!')
+        sleep(0.05)
+        # a burst while the slow sink plays, coalesced into one dispatch
+        for i in range(5):
+            assert notifier.notify(('course', i), 'Course changed', u'课程 {}'.format(i))
+        assert time() - start < 0.1  # never blocked by the sinks
+        notifier.flush()
+    finally:
+        notifier.close()
+        server.shutdown()
+
+    assert [n.title for n in slow.received] == ['Course renew started', '5 notifications']
+    assert notifier.stats == {'sent': 6, 'deduped': 1, 'coalesced': 4, 'dropped': 0, 'failed': 2}, notifier.stats
+    assert len(posted) == 2 and posted[1]['key'][0] == ['course', 0]
+    assert len([f for f in os.listdir(mailbox) if f.endswith('.json')]) == 2
+    shutil.rmtree(mailbox)
+
+    notifier = Notifier.from_dict({'sound': 'ring.wav', 'mailbox': mailbox, 'min_interval': 1.}, logger)
+    assert [s.__class__ for s in notifier.sinks] == [LogSink, SoundSink, MailboxSink]
+    assert notifier.min_interval == 1. and notifier.sinks[1].sound_path == 'ring.wav'
+
+    print 'notifier test passed'
+
+
+if __name__ == '__main__':
+    test_notifier()
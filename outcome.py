@@ -0,0 +1,115 @@
+# encoding: utf-8
+
+import re
+from collections import namedtuple
+
+
+class Outcome(object):
+    """Typed outcomes of a page of our jw system."""
+    SUCCESS = 'success'
+    FULL = 'full'
+    CONFLICT = 'conflict'
+    NOT_STARTED = 'not-started'
+    LOGIN_OK = 'login-ok'
+    UNKNOWN = 'unknown'
+
+
+Classification = namedtuple('Classification', ['outcome', 'message'])
+
+
+class OutcomeClassifier(object):
+    """
+    Classify a page by the known markers it contains.
+
+    Raw bytes are searched directly with the C substring search and only the
+    alert message is ever decoded.  When an alert anchor is configured the
+    alert message is located first and the markers are matched against it,
+    so the common submit response is settled after one scan up to the anchor.
+
+    Parameters
+    ----------
+    markers : list of (str, unicode)
+        (outcome, marker) pairs, earlier pairs win when several are found.
+    alert_anchor : unicode, default None
+        If given, the first ``alert("...")`` after this anchor is returned as message.
+    encoding : str
+
+    """
+    def __init__(self, markers, alert_anchor=None, encoding='utf8'):
+        self.markers = list(markers)
+        self.encoding = encoding
+
+        self.__encoded = [(o, m.encode(encoding)) for o, m in self.markers]
+        self.__anchor = alert_anchor.encode(encoding) if alert_anchor else None
+        self.__alert = re.compile(r'alert\(("[^"\n]*")\)')
+
+    def find_alert(self, content):
+        """Returns the alert message after the anchor, or None."""
+        if not self.__anchor:
+            return None
+        pos = content.find(self.__anchor)
+        if pos < 0:
+            return None
+        alert = self.__alert.search(content, pos + len(self.__anchor))
+        if not alert:
+            return None
+        return alert.group(1).decode(self.encoding, 'replace')
+
+    def classify(self, content):
+        """
+        Returns
+        -------
+        res : Classification
+            (outcome, message), message is the alert message or None.
+
+        """
+        if isinstance(content, unicode):
+            content = content.encode(self.encoding)
+
+        message = self.find_alert(content)
+        if message is not None:
+            for outcome, marker in self.markers:
+                if marker in message:
+                    return Classification(outcome, message)
+
+        for outcome, marker in self.__encoded:
+            if marker in content:
+                return Classification(outcome, message)
+        return Classification(Outcome.UNKNOWN, message)
+
+
+JW_CLASSIFIER = OutcomeClassifier([(Outcome.SUCCESS, u'课程选择成功'),
+                                   (Outcome.FULL, u'班级已满'),
+                                   (Outcome.CONFLICT, u'和已选课程存在时间冲突'),
+                                   (Outcome.NOT_STARTED, u'现在还没有开始通修课补选'),
+                                   (Outcome.LOGIN_OK, u'teachinginfo')],
+                                  alert_anchor=u'function initSelectedList')
+
+
+def test_outcome_classifier():
+    page = u'<script>function initSelectedList(){{\n var a = 1;\n alert("{}");\n}}</script>'
+
+    res = JW_CLASSIFIER.classify(page.format(u'课程选择成功！'))
+    assert res.outcome == Outcome.SUCCESS
+    assert res.message == u'"课程选择成功！"'
+
+    res = JW_CLASSIFIER.classify(page.format(u'班级已满').encode('utf8'))
+    assert res.outcome == Outcome.FULL
+
+    res = JW_CLASSIFIER.classify(page.format(u'和已选课程存在时间冲突'))
+    assert res.outcome == Outcome.CONFLICT
+
+    res = JW_CLASSIFIER.classify(u'<div>现在还没有开始通修课补选</div><a href="teachinginfo">')
+    assert res.outcome == Outcome.NOT_STARTED
+
+    assert JW_CLASSIFIER.classify('<a href="/jiaowu/teachinginfo/">').outcome == Outcome.LOGIN_OK
+
+    res = JW_CLASSIFIER.classify(page.format(u'系统繁忙'))
+    assert res == (Outcome.UNKNOWN, u'"系统繁忙"')
+    assert JW_CLASSIFIER.classify('') == (Outcome.UNKNOWN, None)
+
+    print 'outcome classifier test passed'
+
+
+if __name__ == '__main__':
+    test_outcome_classifier()
@@ -0,0 +1,200 @@
+# encoding: utf-8
+
+"""
+Bounded LRU cache of parse results keyed by (parser name, body digest).
+
+PageMemo only knows the last body of each page; when several pages, e.g.
+the seat tables of the provinces the TOEFL loop rotates through, come back
+to a body seen before, ParseCache returns the value parsed then.  Entries
+are weighted by the size of their body, the least recently used ones are
+evicted beyond max_bytes, and every entry expires ttl seconds after it was
+parsed.
+
+"""
+import heapq
+import threading
+from time import time
+from collections import OrderedDict
+
+from changes import body_digest
+
+
+_MISSING = object()
+
+
+class ParseCache(object):
+    """
+    Parameters
+    ----------
+    max_bytes : int, default 4MB
+        Bound of the summed body sizes of the entries.
+    ttl : float, default 600.
+        Seconds an entry is kept after it was parsed.
+    clock : callable
+        Replaceable in tests.
+
+    Attributes
+    ----------
+    stats : dict
+        Counts of 'hits', 'misses', 'evictions' (size bound) and 'expired'.
+
+    """
+    def __init__(self, max_bytes=4 * 1024 * 1024, ttl=600., clock=time):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.__clock = clock
+        self.__entries = OrderedDict()  # key -> (value, size, expires), least recently used first
+        # (expires, key) of the entries, recency does not follow expiry; pairs of entries since
+        # dropped or put again are skipped when popped
+        self.__expiry = []
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def configure(self, max_bytes=4 * 1024 * 1024, ttl=600.):
+        with self.__lock:
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            self._shrink(self.__clock())
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def nbytes(self):
+        return self.__bytes
+
+    @property
+    def hit_ratio(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return float(self.stats['hits']) / lookups if lookups else 0.
+
+    def _drop(self, key):
+        value, size, expires = self.__entries.pop(key)
+        self.__bytes -= size
+
+    def _shrink(self, now):
+        expiry = self.__expiry
+        while expiry and expiry[0][0] <= now:
+            expires, key = heapq.heappop(expiry)
+            entry = self.__entries.get(key)
+            if entry is not None and entry[2] == expires:
+                self._drop(key)
+                self.stats['expired'] += 1
+        while self.__bytes > self.max_bytes:
+            self._drop(next(iter(self.__entries)))
+            self.stats['evictions'] += 1
+        if len(expiry) > 2 * len(self.__entries) + 16:
+            self.__expiry = [(e[2], k) for k, e in self.__entries.items()]
+            heapq.heapify(self.__expiry)
+
+    def _get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[2] <= self.__clock():
+                self._drop(key)
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return _MISSING
+            self.stats['hits'] += 1
+            # move to the most recently used end
+            del self.__entries[key]
+            self.__entries[key] = entry
+            return entry[0]
+
+    def _put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.__lock:
+            now = self.__clock()
+            if key in self.__entries:
+                self._drop(key)
+            self.__entries[key] = (value, size, now + self.ttl)
+            heapq.heappush(self.__expiry, (now + self.ttl, key))
+            self.__bytes += size
+            self._shrink(now)
+
+    def get(self, name, content, default=None):
+        """The value parser name gave for content, default if not cached."""
+        value = self._get((name, body_digest(content)))
+        return default if value is _MISSING else value
+
+    def put(self, name, content, value):
+        self._put((name, body_digest(content)), value, len(content))
+
+    def parse(self, name, content, parser):
+        """
+        parser(content) through the cache.
+
+        Parameters
+        ----------
+        name : str
+            Identifies the parser, values of different parsers are never mixed.
+        content : str
+            Raw body.
+        parser : callable
+            content -> value, values must not be mutated by their users.
+
+        """
+        key = (name, body_digest(content))
+        value = self._get(key)
+        if value is _MISSING:
+            value = parser(content)
+            self._put(key, value, len(content))
+        return value
+
+    def summary(self):
+        return "parse cache: hit ratio {:.2f} of {} lookups, {} entries, {:.1f} KB, {} evictions, {} expired".format(
+            self.hit_ratio, self.stats['hits'] + self.stats['misses'], len(self), self.__bytes / 1024.,
+            self.stats['evictions'], self.stats['expired'])
+
+
+def test_parse_cache():
+    now = [0.]
+    cache = ParseCache(max_bytes=10, ttl=5., clock=lambda: now[0])
+    calls = []
+
+    def parser(content):
+        calls.append(content)
+        return len(calls)
+
+    assert cache.parse('a', 'xxxx', parser) == 1
+    assert cache.parse('a', 'xxxx', parser) == 1
+    assert cache.parse('b', 'xxxx', parser) == 2  # another parser
+    assert cache.get('a', 'yyyy') is None and cache.get('a', 'xxxx') == 1
+    assert cache.nbytes == 8 and cache.stats['hits'] == 2 and cache.stats['misses'] == 3
+
+    # ('b', 'xxxx') is the least recently used one
+    assert cache.parse('a', 'zzzz', parser) == 3
+    assert cache.stats['evictions'] == 1 and cache.get('b', 'xxxx') is None and len(cache) == 2
+
+    assert cache.parse('a', 'x' * 11, parser) == 4 and len(cache) == 2  # larger than max_bytes
+    cache.put('c', 'zzzz', 0)
+    assert cache.get('a', 'xxxx') is None and cache.get('c', 'zzzz') == 0
+
+    now[0] = 6.
+    assert cache.parse('a', 'xxxx', parser) == 5
+    assert cache.stats['expired'] == 2 and len(cache) == 1, cache.stats
+
+    cache.configure(max_bytes=2)
+    assert len(cache) == 0 and cache.nbytes == 0
+    assert 'hit ratio 0.27 of 11 lookups' in cache.summary()
+
+    # an expired entry used more recently than an unexpired one is dropped all the same
+    cache = ParseCache(max_bytes=100, ttl=5., clock=lambda: now[0])
+    now[0] = 0.
+    cache.put('a', 'old', 1)
+    now[0] = 1.
+    cache.put('a', 'new', 2)
+    assert cache.get('a', 'old') == 1
+    now[0] = 5.5
+    cache.put('a', 'newer', 3)
+    assert len(cache) == 2 and cache.stats['expired'] == 1 and cache.nbytes == 8
+
+    print 'parse cache test passed'
+
+
+if __name__ == '__main__':
+    test_parse_cache()
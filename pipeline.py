@@ -0,0 +1,163 @@
+# encoding: utf-8
+
+"""
+Fetch/parse pipeline overlapping network I/O with parsing.
+
+Pipeline.run takes items, e.g. (scraper, month, province), fetches them on
+a pool of threads and parses the raw bodies on a pool of processes, so
+one page is parsed on another core while the next ones are on the wire.
+Results come back in the order of the items.  At most max_pending items
+are between their fetch and their consumer: when parsing or the consumer
+falls behind, no new fetch starts.
+
+"""
+import multiprocessing
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+
+
+# returned by a fetch whose value needs no parsing, e.g. an unchanged page
+Parsed = namedtuple('Parsed', ['value'])
+
+# context is what the fetch returned besides the body, parsed is False for a Parsed fetch
+Result = namedtuple('Result', ['item', 'context', 'value', 'parsed'])
+
+
+class _Done(object):
+    """Stands for the parse AsyncResult of a body parsed in the fetch thread."""
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+
+class Pipeline(object):
+    """
+    Parameters
+    ----------
+    fetchers : int, default 3
+        Threads running fetch, the number of requests on the wire.
+    parsers : int, default None
+        Processes running parse, the number of CPUs by default, 0 parses in
+        the fetch threads.
+    max_pending : int, default None
+        Items fetched or being fetched but not yet consumed, 2 * fetchers by default.
+
+    """
+    def __init__(self, fetchers=3, parsers=None, max_pending=None):
+        self.fetchers = fetchers
+        self.parsers = multiprocessing.cpu_count() if parsers is None else parsers
+        self.max_pending = max_pending or 2 * fetchers
+        self.__fetch_pool = ThreadPool(processes=fetchers)
+        self.__parse_pool = multiprocessing.Pool(processes=self.parsers) if self.parsers else None
+
+    def _fetch(self, fetch, parse, item):
+        """Runs in a fetch thread, returns (context, parse AsyncResult, parsed)."""
+        context, body = fetch(item)
+        if isinstance(body, Parsed):
+            return context, _Done(body.value), False
+        if self.__parse_pool is None:
+            return context, _Done(parse(body)), True
+        return context, self.__parse_pool.apply_async(parse, (body,)), True
+
+    def run(self, fetch, parse, items, timeout=3600):
+        """
+        Yield a Result per item, in the order of items.
+
+        Parameters
+        ----------
+        fetch : callable
+            item -> (context, body), called in a fetch thread; body is
+            either a Parsed or the argument of parse.
+        parse : callable
+            body -> value, called in a parser process, so it and body must
+            be picklable, e.g. a module level function of a str.
+        items : iterable
+            Consumed lazily, only max_pending ahead of the consumer.
+
+        Exceptions of fetch and parse are re-raised here, in order.
+
+        """
+        pending = deque()
+        items = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.max_pending:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((item, self.__fetch_pool.apply_async(self._fetch, (fetch, parse, item))))
+            if not pending:
+                return
+
+            item, fetched = pending.popleft()
+            context, parsing, parsed = fetched.get(timeout)
+            yield Result(item, context, parsing.get(timeout), parsed)
+
+    def close(self):
+        self.__fetch_pool.close()
+        self.__fetch_pool.join()
+        if self.__parse_pool is not None:
+            self.__parse_pool.close()
+            self.__parse_pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _square(x):
+    return x * x
+
+
+def test_pipeline():
+    import threading
+    from time import time, sleep
+
+    lock = threading.Lock()
+    state = {'in_flight': 0, 'max_in_flight': 0, 'fetched': 0}
+
+    def fetch(i):
+        with lock:
+            state['in_flight'] += 1
+            state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+        sleep(0.05 if i % 3 == 0 else 0.01)  # later items are often fetched first
+        with lock:
+            state['in_flight'] -= 1
+            state['fetched'] += 1
+        return 'ctx{}'.format(i), Parsed(-1) if i == 4 else i
+
+    with Pipeline(fetchers=3, parsers=2, max_pending=4) as pipeline:
+        start = time()
+        results = pipeline.run(fetch, _square, xrange(12))
+        first = next(results)
+        sleep(0.2)
+        # the consumer stalls, fetching stops at max_pending
+        assert state['fetched'] <= 4, state
+        results = [first] + list(results)
+        elapsed = time() - start
+
+    assert [r.item for r in results] == range(12)
+    assert [r.value for r in results] == [i * i if i != 4 else -1 for i in range(12)]
+    assert results[5].context == 'ctx5' and results[5].parsed and not results[4].parsed
+    assert state['max_in_flight'] <= 3
+    assert elapsed < 0.2 + 12 * 0.05 / 2, elapsed
+
+    with Pipeline(fetchers=2, parsers=0) as pipeline:
+        try:
+            list(pipeline.run(lambda i: (None, 'x' if i == 2 else i), _square, range(4)))
+        except TypeError:
+            pass
+        else:
+            raise AssertionError('the parse error was not re-raised')
+
+    print 'pipeline test passed'
+
+
+if __name__ == '__main__':
+    test_pipeline()
@@ -0,0 +1,264 @@
+# encoding: utf-8
+
+"""
+Polling planner spending a request budget where the pages change.
+
+Every target, e.g. a (month, province) seat table or a course type, has a
+change rate estimated from the polls of it: the changes seen over the
+seconds observed, both decayed with half_life so the estimate follows the
+season.  Detecting a change of a page polled every T seconds takes T / 2 on
+average; for a total of `budget` polls per second, the sum of these delays
+weighted by the change rates is smallest with poll frequencies
+proportional to the square root of the rates.  A target gets no more than
+polls_per_change polls per expected change, the budget it leaves goes to
+the others, and none is polled less than every max_interval seconds.
+
+The planner picks the target that is due first and never allows two polls
+closer than 1 / budget seconds, so the overall rate stays within the budget
+whatever the estimates.
+
+"""
+import math
+import random
+from time import time
+
+
+class TargetStats(object):
+    """Decayed change count and observed seconds of one target."""
+    __slots__ = ('changes', 'exposure', 'last_polled', 'jitter')
+
+    def __init__(self, changes, exposure):
+        self.changes = changes
+        self.exposure = exposure
+        self.last_polled = None
+        self.jitter = 1.
+
+    @property
+    def rate(self):
+        """Changes per second."""
+        return self.changes / self.exposure
+
+
+class PollPlanner(object):
+    """
+    Parameters
+    ----------
+    targets : iterable
+        Hashable targets, more are added by observe.
+    budget : float, default 0.5
+        Polls per second over all targets.
+    max_interval : float, default 30.
+        Seconds between two polls of the most static target.
+    polls_per_change : float, default 10.
+        Polls per expected change beyond which a target gets no more of the budget.
+    prior_interval : float, default 60.
+        Seconds between changes assumed of a target before its first polls.
+    half_life : float, default 3600.
+        Seconds after which an observation weighs half.
+    jitter : float, default 0.2
+        Relative random spread of the intervals, the polls follow no fixed pattern.
+    clock, rand : callable
+        Replaceable in tests.
+
+    Attributes
+    ----------
+    stats : dict
+        Counts of 'polls' and 'changes' observed.
+
+    """
+    def __init__(self, targets=(), budget=0.5, max_interval=30., polls_per_change=10., prior_interval=60.,
+                 half_life=3600., jitter=0.2, clock=time, rand=random.random):
+        self.budget = budget
+        self.max_interval = max_interval
+        self.polls_per_change = polls_per_change
+        self.prior_interval = prior_interval
+        self.half_life = half_life
+        self.jitter = jitter
+        self.stats = {'polls': 0, 'changes': 0}
+        self.__clock = clock
+        self.__rand = rand
+        self.__targets = dict()
+        self.__order = []  # targets in the order they were added, the first polls follow it
+        self.__intervals = None
+        self.__last_poll = None
+        for target in targets:
+            self.add(target)
+
+    @classmethod
+    def from_dict(cls, dic, targets):
+        """The planner of the 'polling' entry of a config, its 'targets' replace the default ones."""
+        dic = dict(dic)
+        targets = [tuple(t) if isinstance(t, list) else t for t in dic.pop('targets', targets)]
+        return cls(targets, **dic)
+
+    @property
+    def targets(self):
+        return list(self.__order)
+
+    def add(self, target):
+        if target not in self.__targets:
+            self.__targets[target] = TargetStats(1., self.prior_interval)
+            self.__order.append(target)
+            self.__intervals = None
+
+    def rate(self, target):
+        """Estimated changes per second of target."""
+        return self.__targets[target].rate
+
+    def intervals(self):
+        """dict of target -> seconds between its polls."""
+        if self.__intervals is None:
+            floor = 1. / self.max_interval
+            free = dict((t, s.rate) for t, s in self.__targets.items())
+            freq = dict()
+            budget = self.budget
+            # water-filling: the targets past their cap keep it, the rest share what is left
+            while free:
+                weights = dict((t, math.sqrt(r)) for t, r in free.items())
+                total = sum(weights.values())
+                share = dict((t, max(budget, 0.) * (w / total if total else 1. / len(free)))
+                             for t, w in weights.items())
+                capped = [t for t in free if share[t] > max(self.polls_per_change * free[t], floor)]
+                if not capped:
+                    freq.update(share)
+                    break
+                for t in capped:
+                    freq[t] = max(self.polls_per_change * free.pop(t), floor)
+                    budget -= freq[t]
+            self.__intervals = dict((t, 1. / max(f, floor)) for t, f in freq.items())
+        return self.__intervals
+
+    def next(self):
+        """
+        Returns
+        -------
+        target : hashable
+            The target to poll next.
+        wait : float
+            Seconds to sleep before polling it.
+
+        """
+        intervals = self.intervals()
+        due = dict()
+        for target in self.__order:
+            stats = self.__targets[target]
+            if stats.last_polled is None:
+                due[target] = -float('inf')
+            else:
+                due[target] = stats.last_polled + intervals[target] * stats.jitter
+        target = min(self.__order, key=due.get)
+
+        at = due[target]
+        if self.__last_poll is not None:
+            at = max(at, self.__last_poll + 1. / self.budget)
+        return target, max(0., at - self.__clock())
+
+    def observe(self, target, changed):
+        """Record a poll of target done now, changed is whether its page differed from the previous poll."""
+        self.add(target)
+        now = self.__clock()
+        stats = self.__targets[target]
+        if stats.last_polled is not None:
+            # the first poll of a target only sets the page it is compared to
+            elapsed = now - stats.last_polled
+            decay = 0.5 ** (elapsed / self.half_life)
+            stats.changes = stats.changes * decay + bool(changed)
+            stats.exposure = stats.exposure * decay + elapsed
+            self.stats['changes'] += bool(changed)
+            self.__intervals = None
+        stats.last_polled = now
+        stats.jitter = 1. + self.jitter * (2. * self.__rand() - 1.)
+        self.__last_poll = now
+        self.stats['polls'] += 1
+
+    def summary(self):
+        intervals = self.intervals()
+        return ', '.join('{}: every {:.1f} s, 1 change / {:.0f} s'.format(
+            t, intervals[t], 1. / max(self.rate(t), 1e-9)) for t in self.__order)
+
+
+def simulate(change_rates, duration, budget=0.5, adaptive=True, seed=0, **kwargs):
+    """
+    Poll targets changing at change_rates (changes per second) for duration seconds.
+
+    The targets are picked by a PollPlanner, or at random every 1 / budget
+    seconds if not adaptive, as the poll loops used to.
+
+    Returns
+    -------
+    polls : int
+    delay : float
+        Mean seconds between a change and the poll that saw it.
+
+    """
+    rng = random.Random(seed)
+    now = [0.]
+    targets = sorted(change_rates)
+    planner = PollPlanner(targets, budget, clock=lambda: now[0], rand=rng.random, **kwargs)
+    next_change = dict((t, rng.expovariate(r)) for t, r in change_rates.items())
+    pending = dict((t, []) for t in change_rates)
+    delays = []
+    polls = 0
+    while now[0] < duration:
+        if adaptive:
+            target, wait = planner.next()
+        else:
+            target, wait = rng.choice(targets), 1. / budget
+        now[0] += wait
+        for t, r in change_rates.items():
+            while next_change[t] <= now[0]:
+                pending[t].append(next_change[t])
+                next_change[t] += rng.expovariate(r)
+        changed = bool(pending[target])
+        delays.extend(now[0] - c for c in pending[target])
+        pending[target] = []
+        planner.observe(target, changed)
+        polls += 1
+    return polls, sum(delays) / max(len(delays), 1)
+
+
+def test_poll_planner():
+    now = [0.]
+    planner = PollPlanner(['a', 'b'], budget=1., clock=lambda: now[0], rand=lambda: 0.5)
+    # unknown targets are polled once first, in order
+    assert planner.next() == ('a', 0.)
+    planner.observe('a', False)
+    target, wait = planner.next()
+    assert target == 'b' and wait == 1.  # the budget spacing
+    now[0] = 1.
+    planner.observe('b', True)
+    assert planner.stats == {'polls': 2, 'changes': 0}
+
+    # 'a' changes on every poll, 'b' never
+    for _ in range(200):
+        target, wait = planner.next()
+        now[0] += wait
+        planner.observe(target, target == 'a')
+    intervals = planner.intervals()
+    assert planner.rate('a') > 10 * planner.rate('b')
+    assert intervals['a'] < 2. and intervals['b'] > 10 * intervals['a'], intervals
+    assert 200 / (now[0] - 1.) <= planner.budget + 1e-9  # within the budget
+    assert 'a: every' in planner.summary()
+
+    # a static target alone backs off, well under the budget
+    planner = PollPlanner(['s'], budget=1., clock=lambda: now[0])
+    for _ in range(100):
+        target, wait = planner.next()
+        now[0] += wait
+        planner.observe(target, False)
+    assert planner.intervals()['s'] > 10.
+
+    planner = PollPlanner.from_dict({'targets': [['201710', 'Shanghai']], 'budget': 0.2}, [('201710', 'Jiangsu')])
+    assert planner.targets == [('201710', 'Shanghai')] and planner.budget == 0.2
+
+    # same number of polls as the uniform random choice, faster detection
+    rates = {'Shanghai': 1. / 20, 'Jiangsu': 1. / 200, 'Zhejiang': 1. / 2000}
+    polls, delay = simulate(rates, 20000.)
+    uniform_polls, uniform_delay = simulate(rates, 20000., adaptive=False)
+    assert polls <= uniform_polls * 1.01 and delay < 0.8 * uniform_delay, (polls, delay, uniform_polls, uniform_delay)
+
+    print 'poll planner test passed'
+
+
+if __name__ == '__main__':
+    test_poll_planner()
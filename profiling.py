@@ -0,0 +1,235 @@
+# encoding: utf-8
+
+"""
+Opt-in profiling of the long-running main loops.
+
+Set the environment variable SCRAPING_PROFILE, e.g.::
+
+    SCRAPING_PROFILE="iterations=50,windows=3,out=profile,top=30,sample=0.005" python grasptoefl.py
+
+Every window of `iterations` loop iterations runs under cProfile, and at its
+end the following reports are written to `out`:
+
+- cpu_<k>.txt, cpu_<k>.prof : per-function CPU time (pstats text and raw dump)
+- alloc_<k>.txt : top allocation sites and the top diffs against the
+  previous window, by tracemalloc when available, otherwise top object
+  counts per type from the gc
+- samples_<k>.txt : collapsed stacks of the sampling profiler, only with `sample`
+
+"""
+import os
+import gc
+import signal
+import pstats
+import cProfile
+from StringIO import StringIO
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2 without the pytracemalloc backport
+    tracemalloc = None
+
+
+ENV_NAME = 'SCRAPING_PROFILE'
+
+
+class StackSampler(object):
+    """Sample the stack of the main thread every `interval` seconds of CPU time."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def _handler(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._handler)
+        # restart system calls, e.g. socket reads, instead of failing with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def report(self, top):
+        lines = ['{} {}'.format(stack, n) for stack, n in self.stacks.most_common(top)]
+        return '\n'.join(lines) + '\n'
+
+
+class LoopProfiler(object):
+    """
+    Profile windows of loop iterations.
+
+    Parameters
+    ----------
+    iterations : int, default 50
+        Iterations per window.
+    windows : int, default 3
+        Profiling stops after this number of windows, 0 means never.
+    out : str, default 'profile'
+        Directory of the reports.
+    top : int, default 30
+        Length of every top-N list.
+    sample : float, default 0.
+        Interval in seconds of the sampling profiler, 0 means no sampling.
+    enabled : bool, default True
+    logger : logging.Logger, default None
+
+    """
+    def __init__(self, iterations=50, windows=3, out='profile', top=30, sample=0., enabled=True, logger=None):
+        self.iterations = int(iterations)
+        self.windows = int(windows)
+        self.out = out
+        self.top = int(top)
+        self.sample = float(sample)
+        self.enabled = enabled
+        self.logger = logger
+
+        self.window = 0
+        self.__count = 0
+        self.__profile = None
+        self.__sampler = None
+        self.__last_alloc = None
+
+    @classmethod
+    def from_env(cls, logger=None, environ=os.environ):
+        """A profiler set up by SCRAPING_PROFILE, disabled if it is not set."""
+        value = environ.get(ENV_NAME)
+        if not value:
+            return cls(enabled=False)
+
+        kwargs = dict(item.split('=', 1) for item in value.split(',') if '=' in item)
+        return cls(logger=logger, **kwargs)
+
+    def _start_window(self):
+        if not os.path.isdir(self.out):
+            os.makedirs(self.out)
+        self.__profile = cProfile.Profile()
+        if self.sample:
+            self.__sampler = StackSampler(self.sample)
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        if self.__last_alloc is None:
+            self.__last_alloc = self._alloc_snapshot()
+
+    def _alloc_snapshot(self):
+        if tracemalloc:
+            return tracemalloc.take_snapshot()
+        gc.collect()
+        return Counter(type(o).__name__ for o in gc.get_objects())
+
+    def _alloc_report(self, snapshot):
+        lines = []
+        if tracemalloc:
+            lines.append('Top {} allocation sites:'.format(self.top))
+            lines.extend(str(s) for s in snapshot.statistics('lineno')[:self.top])
+            lines.append('')
+            lines.append('Top {} diffs against the previous snapshot:'.format(self.top))
+            lines.extend(str(s) for s in snapshot.compare_to(self.__last_alloc, 'lineno')[:self.top])
+        else:
+            lines.append('tracemalloc unavailable, live objects per type from the gc.')
+            lines.append('Top {} types:'.format(self.top))
+            lines.extend('{:>10d} {}'.format(n, name) for name, n in snapshot.most_common(self.top))
+            lines.append('')
+            lines.append('Top {} diffs against the previous snapshot:'.format(self.top))
+            diff = Counter(snapshot)
+            diff.subtract(self.__last_alloc)
+            ranked = sorted(diff.items(), key=lambda x: -abs(x[1]))[:self.top]
+            lines.extend('{:>+10d} {}'.format(n, name) for name, n in ranked if n)
+        return '\n'.join(lines) + '\n'
+
+    def _write(self, name, text):
+        file_path = os.path.join(self.out, name)
+        with open(file_path, 'w') as f:
+            f.write(text)
+        return file_path
+
+    def _end_window(self):
+        k = self.window
+
+        self.__profile.dump_stats(os.path.join(self.out, 'cpu_{}.prof'.format(k)))
+        stream = StringIO()
+        stats = pstats.Stats(self.__profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        stats.sort_stats('tottime').print_stats(self.top)
+        paths = [self._write('cpu_{}.txt'.format(k), stream.getvalue())]
+
+        snapshot = self._alloc_snapshot()
+        paths.append(self._write('alloc_{}.txt'.format(k), self._alloc_report(snapshot)))
+        self.__last_alloc = snapshot
+
+        if self.__sampler:
+            paths.append(self._write('samples_{}.txt'.format(k), self.__sampler.report(self.top)))
+
+        if self.logger:
+            self.logger.info("Profile window {} written: {}".format(k, ', '.join(paths)))
+
+        self.__profile = None
+        self.__sampler = None
+        self.__count = 0
+        self.window += 1
+        if self.windows and self.window >= self.windows:
+            self.enabled = False
+            if tracemalloc and tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    @contextmanager
+    def iteration(self):
+        """Wrap one loop iteration."""
+        if not self.enabled:
+            yield
+            return
+
+        if self.__profile is None:
+            self._start_window()
+        if self.__sampler:
+            self.__sampler.start()
+        self.__profile.enable()
+        try:
+            yield
+        finally:
+            self.__profile.disable()
+            if self.__sampler:
+                self.__sampler.stop()
+            self.__count += 1
+            if self.__count >= self.iterations:
+                self._end_window()
+
+
+def test_loop_profiler():
+    import tempfile
+
+    out = tempfile.mkdtemp()
+    profiler = LoopProfiler.from_env(environ={ENV_NAME: 'iterations=2,windows=2,top=5,sample=0.001,out=' + out})
+    assert profiler.enabled and profiler.iterations == 2
+    assert not LoopProfiler.from_env(environ={}).enabled
+
+    kept = []
+    for i in range(6):
+        with profiler.iteration():
+            kept.append([object() for _ in range(20000)])
+            sum(x * x for x in range(50000))
+
+    assert profiler.window == 2 and not profiler.enabled
+    files = sorted(os.listdir(out))
+    for k in range(2):
+        for name in ['cpu_{}.txt', 'cpu_{}.prof', 'alloc_{}.txt', 'samples_{}.txt']:
+            assert name.format(k) in files, name.format(k)
+    assert 'cpu_2.txt' not in files
+    assert '<genexpr>' in open(os.path.join(out, 'cpu_0.txt')).read()
+    assert 'test_loop_profiler' in open(os.path.join(out, 'samples_0.txt')).read()
+    assert 'object' in open(os.path.join(out, 'alloc_1.txt')).read()
+
+    print 'loop profiler test passed'
+
+
+if __name__ == '__main__':
+    test_loop_profiler()
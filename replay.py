@@ -0,0 +1,409 @@
+# encoding: utf-8
+
+"""
+Record real exchanges of a BaseWebScraping session into fixtures and serve
+them back from a local HTTP stand-in, so polling loops can run offline.
+
+Recording::
+
+    adapter = record(grasper, 'fixtures/toefl')
+    ...  # use grasper as usual
+    adapter.save()
+
+Replaying::
+
+    server = replay(grasper, 'fixtures/toefl', latency=0.05, throttle_rate=0.1)
+    ...  # every request of grasper.ses now goes to the stand-in
+    server.stop()
+
+"""
+import os
+import re
+import json
+import random
+import socket
+import threading
+from io import BytesIO
+from time import sleep
+from urlparse import urlsplit, parse_qsl
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from transport import TunedAdapter
+
+
+EXCHANGES_FILE = 'exchanges.json'
+
+# header fields worth keeping in a fixture, live session cookies are never kept
+KEPT_HEADERS = ['Content-Type', 'Location', 'Date', 'ETag', 'Last-Modified']
+# request fields holding credentials, left out of the fixtures which are meant to be committed
+REDACTED_PARAMS = frozenset(['userName', 'username', 'password', 'ValidateCode', 'LoginCode'])
+
+THROTTLE_PAGE = u'<html><body><p>您的操作太频繁，请稍后再试。</p></body></html>'
+FAILURE_PAGE = u'<html><body><h1>500 Internal Server Error</h1></body></html>'
+
+
+def normalize_path(path):
+    """Timestamps and random numbers in a path, e.g. of captcha images, are replaced by 0."""
+    return re.sub(r'\d{4,}(\.\d+)?', '0', path)
+
+
+def request_params(url, body):
+    """Merge query string and form body of a request into one dict."""
+    params = dict(parse_qsl(urlsplit(url).query, keep_blank_values=True))
+    if isinstance(body, basestring) and '=' in body:
+        params.update(parse_qsl(body, keep_blank_values=True))
+    return params
+
+
+def load_exchanges(fixture_dir):
+    """Returns the list of exchanges of a fixture dir, with their content read in."""
+    with open(os.path.join(fixture_dir, EXCHANGES_FILE)) as f:
+        exchanges = json.load(f)
+
+    for ex in exchanges:
+        if 'content_file' in ex:
+            with open(os.path.join(fixture_dir, ex['content_file']), 'rb') as f:
+                ex['content'] = f.read()
+        else:
+            ex['content'] = ex.get('content', u'').encode(ex.get('encoding', 'utf8'))
+    return exchanges
+
+
+class RecordingAdapter(TunedAdapter):
+    """
+    Transport adapter which keeps a copy of every exchange it sends.
+
+    Attributes
+    ----------
+    fixture_dir : str
+    exchanges : list of dict
+
+    """
+    def __init__(self, fixture_dir, config=None, **kwargs):
+        TunedAdapter.__init__(self, config, **kwargs)
+        self.fixture_dir = fixture_dir
+        self.exchanges = []
+        self.__lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        response = TunedAdapter.send(self, request, **kwargs)
+        content = response.content
+
+        # response.raw is consumed by .content, give stream readers a fresh one
+        response.raw = BytesIO(content)
+
+        with self.__lock:
+            n = len(self.exchanges)
+            ext = os.path.splitext(urlsplit(request.url).path)[1] or '.html'
+            ex = {'method': request.method,
+                  'path': urlsplit(request.url).path,
+                  'params': request_params(request.url, request.body),
+                  'status': response.status_code,
+                  'headers': dict((k, response.headers[k]) for k in KEPT_HEADERS if k in response.headers),
+                  'content_file': '{:04d}{}'.format(n, ext),
+                  'content': content}
+            self.exchanges.append(ex)
+        return response
+
+    def save(self):
+        """Write the content files and exchanges.json, without the fields of REDACTED_PARAMS."""
+        if not os.path.isdir(self.fixture_dir):
+            os.makedirs(self.fixture_dir)
+
+        records = []
+        for ex in self.exchanges:
+            with open(os.path.join(self.fixture_dir, ex['content_file']), 'wb') as f:
+                f.write(ex['content'])
+            record = dict((k, v) for k, v in ex.items() if k != 'content')
+            record['params'] = dict((k, v) for k, v in ex['params'].items() if k not in REDACTED_PARAMS)
+            records.append(record)
+
+        with open(os.path.join(self.fixture_dir, EXCHANGES_FILE), 'w') as f:
+            json.dump(records, f, indent=2, sort_keys=True)
+
+
+class RedirectAdapter(TunedAdapter):
+    """Transport adapter sending every request to the stand-in, whatever its host."""
+    def __init__(self, base_url, config=None, **kwargs):
+        TunedAdapter.__init__(self, config, **kwargs)
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        parts = urlsplit(original_url)
+        request.url = self.base_url + original_url[len(parts.scheme) + 3 + len(parts.netloc):]
+        response = TunedAdapter.send(self, request, **kwargs)
+        response.url = original_url
+        return response
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    # keep-alive, every response carries a Content-Length
+    protocol_version = 'HTTP/1.1'
+    # buffer the response and send it in one go, small writes stall on Nagle's algorithm
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.server.stand_in.track(self.connection)
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        finally:
+            self.server.stand_in.untrack(self.connection)
+
+    def do_GET(self):
+        self.server.stand_in.handle(self, '')
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.server.stand_in.handle(self, self.rfile.read(length))
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer(object):
+    """
+    Local HTTP stand-in serving recorded exchanges.
+
+    An exchange is matched by method and normalized path, then by the number
+    of request params equal to the recorded ones.  Exchanges with equal score
+    are served in turn.  A GET whose If-None-Match equals the ETag of the
+    exchange gets an empty 304.
+
+    Parameters
+    ----------
+    exchanges : list of dict
+        See load_exchanges.
+    latency : float, default 0.
+        Seconds to wait before each response.
+    jitter : float, default 0.
+        Uniform random extra latency in seconds.
+    throttle_rate : float, default 0.
+        Probability of answering with the throttling page.
+    fail_rate : float, default 0.
+        Probability of answering with a 500 failure page.
+    encoding : str, default 'gb2312'
+        Encoding of the throttling and failure pages.
+    rotate_cookies : int, default 0
+        If set, every response sets a cookie of a new name living that many
+        seconds, as tracking cookies of some sites do.
+    seed : int, default None
+
+    Attributes
+    ----------
+    stats : dict
+        Counts of 'served', 'not_modified', 'throttled', 'failed' and 'unmatched' requests.
+
+    """
+    def __init__(self, exchanges, latency=0., jitter=0., throttle_rate=0., fail_rate=0.,
+                 encoding='gb2312', rotate_cookies=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.fail_rate = fail_rate
+        self.throttle_page = THROTTLE_PAGE.encode(encoding)
+        self.failure_page = FAILURE_PAGE.encode(encoding)
+        self.content_type = 'text/html; charset={}'.format(encoding)
+        self.rotate_cookies = rotate_cookies
+
+        self.__routes = dict()
+        for ex in exchanges:
+            key = (ex['method'], normalize_path(ex['path']))
+            self.__routes.setdefault(key, []).append(ex)
+        self.__turns = dict()
+
+        self.stats = {'served': 0, 'not_modified': 0, 'throttled': 0, 'failed': 0, 'unmatched': 0}
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__httpd = None
+        self.__thread = None
+        self.__connections = dict()  # socket -> handler thread
+
+    @property
+    def url(self):
+        host, port = self.__httpd.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self, port=0):
+        self.__httpd = _ThreadingHTTPServer(('127.0.0.1', port), _StandInHandler)
+        self.__httpd.stand_in = self
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        if self.__httpd:
+            self.__httpd.shutdown()
+            self.__httpd.server_close()
+            self.__httpd = None
+        # wake up handlers waiting on keep-alive connections
+        with self.__lock:
+            connections = self.__connections.items()
+        for conn, thread in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1.)
+
+    def track(self, conn):
+        with self.__lock:
+            self.__connections[conn] = threading.current_thread()
+
+    def untrack(self, conn):
+        with self.__lock:
+            self.__connections.pop(conn, None)
+
+    def attach(self, scraper):
+        """Route every request of scraper.ses to this stand-in."""
+        scraper.mount(RedirectAdapter(self.url, scraper.transport_config))
+
+    def match(self, method, path, params):
+        candidates = self.__routes.get((method, normalize_path(path)))
+        if not candidates:
+            return None
+
+        def score(ex):
+            return sum(1 for k, v in ex['params'].items() if params.get(k) == v)
+        best = max(score(ex) for ex in candidates)
+        tied = [ex for ex in candidates if score(ex) == best]
+
+        key = (method, normalize_path(path), best)
+        turn = self.__turns.get(key, 0)
+        self.__turns[key] = turn + 1
+        return tied[turn % len(tied)]
+
+    def handle(self, handler, body):
+        with self.__lock:
+            r = self.__random.random()
+            delay = self.latency + self.jitter * self.__random.random()
+            if r < self.fail_rate:
+                kind = 'failed'
+                status, headers, content = 500, {'Content-Type': self.content_type}, self.failure_page
+            elif r < self.fail_rate + self.throttle_rate:
+                kind = 'throttled'
+                status, headers, content = 200, {'Content-Type': self.content_type}, self.throttle_page
+            else:
+                path = urlsplit(handler.path).path
+                ex = self.match(handler.command, path, request_params(handler.path, body))
+                if ex is None:
+                    kind = 'unmatched'
+                    status, headers, content = 404, {}, ''
+                elif ex['headers'].get('ETag') and ex['headers']['ETag'] == handler.headers.getheader('If-None-Match'):
+                    kind = 'not_modified'
+                    status, headers, content = 304, {'ETag': ex['headers']['ETag']}, ''
+                else:
+                    kind = 'served'
+                    status, headers, content = ex['status'], ex['headers'], ex['content']
+            self.stats[kind] += 1
+            if self.rotate_cookies:
+                n = sum(self.stats.values())
+                headers = dict(headers, **{'Set-Cookie': 'track{0}={0}; Max-Age={1:d}; Path=/'.format(
+                    n, self.rotate_cookies)})
+
+        if delay > 0:
+            sleep(delay)
+
+        handler.send_response(status)
+        for k, v in headers.items():
+            if k != 'Content-Length':
+                handler.send_header(k, v)
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+
+def record(scraper, fixture_dir):
+    """Record every exchange of scraper.ses, call .save() on the returned adapter to write fixtures."""
+    adapter = RecordingAdapter(fixture_dir, scraper.transport_config)
+    scraper.mount(adapter)
+    return adapter
+
+
+def replay(scraper, fixture_dir, **kwargs):
+    """Start a StandInServer with the fixtures of fixture_dir and attach scraper to it."""
+    server = StandInServer(load_exchanges(fixture_dir), **kwargs).start()
+    server.attach(scraper)
+    return server
+
+
+def fixture_path(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', name)
+
+
+def test_stand_in_server():
+    from base import BaseWebScraping
+    from scheduler import RequestScheduler
+
+    scraper = BaseWebScraping()
+    scraper.scheduler = RequestScheduler(enabled=False)
+    scraper.refresh_session()
+    prefix = 'https://toefl.etest.net.cn/cn/'
+    server = replay(scraper, fixture_path('toefl'), seed=0)
+
+    res = scraper.ses.post(prefix + 'SeatsQuery', {'mvfSiteProvinces': 'Jiangsu', 'afCalcResult': 'abcd'})
+    assert res.status_code == 200
+    assert u'南京大学' in res.content.decode('gb2312')
+    assert res.url == prefix + 'SeatsQuery'
+
+    res = scraper.ses.get(prefix + '1508212345678.1234567890123456VerifyCode3.jpg')
+    assert res.status_code == 200 and res.content
+
+    res = scraper.ses.get(prefix + 'NotRecorded')
+    assert res.status_code == 404
+    server.stop()
+
+    exchanges = load_exchanges(fixture_path('toefl'))
+    server = StandInServer(exchanges, throttle_rate=0.5, fail_rate=0.2, seed=1).start()
+    server.attach(scraper)
+    for _ in range(50):
+        scraper.ses.get(prefix + 'MyHome/?')
+    server.stop()
+    assert sum(server.stats.values()) == 50
+    assert server.stats['throttled'] and server.stats['failed'] and server.stats['served']
+
+    page = {'method': 'GET', 'path': '/cn/page', 'params': {}, 'status': 200,
+            'headers': {'ETag': '"v1"'}, 'content': 'page'}
+    server = StandInServer([page]).start()
+    server.attach(scraper)
+    assert scraper.ses.get(prefix + 'page').content == 'page'
+    res = scraper.ses.get(prefix + 'page', headers={'If-None-Match': '"v1"'})
+    assert res.status_code == 304 and not res.content
+    server.stop()
+
+    server = StandInServer([page], rotate_cookies=60).start()
+    server.attach(scraper)
+    for _ in range(3):
+        scraper.ses.get(prefix + 'page')
+    server.stop()
+    assert sorted(c.name for c in scraper.ses.cookies) == ['track1', 'track2', 'track3']
+
+    # recording a login keeps neither the credentials nor the session cookies
+    import shutil
+    import tempfile
+    fixture_dir = tempfile.mkdtemp()
+    server = StandInServer([dict(page, method='POST', path='/jiaowu/login.do')], rotate_cookies=60).start()
+    scraper.refresh_session()
+    adapter = record(scraper, fixture_dir)
+    scraper.ses.post(server.url + '/jiaowu/login.do?returnUrl=null',
+                     {'userName': 'MG1700000', 'password': 'secret', 'ValidateCode': 'wxyz'})
+    server.stop()
+    adapter.save()
+    with open(os.path.join(fixture_dir, EXCHANGES_FILE)) as f:
+        saved = f.read()
+    assert not any(s in saved for s in ('MG1700000', 'secret', 'wxyz', 'track', 'Cookie')), saved
+    assert load_exchanges(fixture_dir)[0]['params'] == {'returnUrl': 'null'}
+    shutil.rmtree(fixture_dir)
+
+    print 'stand-in server test passed'
+
+
+if __name__ == '__main__':
+    test_stand_in_server()
@@ -0,0 +1,285 @@
+# encoding: utf-8
+
+"""
+Adaptive per-host request scheduler.
+
+Every request of a BaseWebScraping session takes a token from the bucket of
+its host.  The refill rate follows AIMD: it grows a little after each good
+response and is cut by a factor when the server answers with a throttling
+page or an error, then it is held for a while before growing again.
+
+"""
+import threading
+from contextlib import contextmanager
+from time import time, sleep
+from urlparse import urlsplit
+
+import requests
+
+
+class HostScheduler(object):
+    """
+    Token bucket with AIMD rate for one host.
+
+    Parameters
+    ----------
+    rate : float, default 1.
+        Initial requests per second.
+    min_rate, max_rate : float
+        Bounds of the rate.
+    burst : int, default 3
+        Capacity of the bucket, i.e. requests that may be sent back to back.
+    increase : float, default 0.02
+        Added to the rate after each good response.
+    decrease : float, default 0.5
+        Factor applied to the rate on a throttling page.
+    error_decrease : float, default 0.75
+        Factor applied to the rate on a connection error or a 5xx/429 status.
+    hold : float, default 60.
+        Seconds without increase after a decrease.
+    clock, sleeper : callable
+        Replaceable in tests.
+
+    Attributes
+    ----------
+    stats : dict
+        Counts of 'requests', 'throttles', 'errors' and total 'waited' seconds.
+
+    """
+    def __init__(self, rate=1., min_rate=1. / 60, max_rate=5., burst=3,
+                 increase=0.02, decrease=0.5, error_decrease=0.75, hold=60.,
+                 clock=time, sleeper=sleep):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.error_decrease = error_decrease
+        self.hold = hold
+        self.__clock = clock
+        self.__sleep = sleeper
+
+        self.__rate = float(rate)
+        self.__tokens = float(burst)
+        self.__last = clock()
+        self.__hold_until = 0.
+        self.__lock = threading.Lock()
+        self.stats = {'requests': 0, 'throttles': 0, 'errors': 0, 'waited': 0.}
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    def _refill(self, now):
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.__rate)
+        self.__last = now
+
+    def acquire(self):
+        """Block until a token is available, returns the seconds waited."""
+        with self.__lock:
+            self._refill(self.__clock())
+            self.__tokens -= 1
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0.
+            self.stats['requests'] += 1
+            self.stats['waited'] += wait
+        if wait > 0:
+            self.__sleep(wait)
+        return wait
+
+    def _cut(self, factor):
+        now = self.__clock()
+        self._refill(now)
+        self.__rate = max(self.min_rate, self.__rate * factor)
+        # drop the tokens saved up at the former rate
+        self.__tokens = min(self.__tokens, 0.)
+        self.__hold_until = now + self.hold
+
+    def cool_down(self):
+        """Block until the hold of the last decrease is over, returns the seconds waited."""
+        with self.__lock:
+            wait = max(0., self.__hold_until - self.__clock())
+            self.stats['waited'] += wait
+        if wait > 0:
+            self.__sleep(wait)
+        return wait
+
+    def on_success(self):
+        with self.__lock:
+            now = self.__clock()
+            if now >= self.__hold_until:
+                self._refill(now)
+                self.__rate = min(self.max_rate, self.__rate + self.increase)
+
+    def on_throttle(self):
+        with self.__lock:
+            self.stats['throttles'] += 1
+            self._cut(self.decrease)
+
+    def on_error(self):
+        with self.__lock:
+            self.stats['errors'] += 1
+            self._cut(self.error_decrease)
+
+    def snapshot(self):
+        with self.__lock:
+            res = dict(self.stats)
+            res['rate'] = self.__rate
+            return res
+
+
+class RequestScheduler(object):
+    """
+    HostScheduler registry shared by all scrapers of a process.
+
+    Parameters
+    ----------
+    enabled : bool, default True
+        If False, requests are never delayed.
+    **host_kwargs
+        Passed to every HostScheduler.
+
+    """
+    def __init__(self, enabled=True, **host_kwargs):
+        self.enabled = enabled
+        self.host_kwargs = host_kwargs
+        self.__hosts = dict()
+        self.__lock = threading.Lock()
+
+    def for_url(self, url):
+        if not self.enabled:
+            return None
+        host = urlsplit(url).netloc
+        with self.__lock:
+            if host not in self.__hosts:
+                self.__hosts[host] = HostScheduler(**self.host_kwargs)
+            return self.__hosts[host]
+
+    def rates(self):
+        """Returns {host: current requests per second}."""
+        with self.__lock:
+            return dict((host, s.rate) for host, s in self.__hosts.items())
+
+    def snapshot(self):
+        with self.__lock:
+            return dict((host, s.snapshot()) for host, s in self.__hosts.items())
+
+
+class ScheduledSession(requests.Session):
+    """
+    requests.Session whose requests go through a RequestScheduler.
+
+    Parameters
+    ----------
+    scheduler : RequestScheduler
+    throttle_markers : list of str
+        Byte strings of the site encoding which mark a throttling page.
+    logger : logging.Logger, default None
+
+    Attributes
+    ----------
+    last_sent : float
+        Seconds since epoch of the last request, 0. before the first one.
+
+    """
+    def __init__(self, scheduler, throttle_markers=(), logger=None):
+        requests.Session.__init__(self)
+        self.scheduler = scheduler
+        self.throttle_markers = list(throttle_markers)
+        self.logger = logger
+        self.last_sent = 0.
+        self.__local = threading.local()
+
+    @contextmanager
+    def unscheduled(self):
+        """
+        Requests of this thread in the block take no token, e.g. a burst
+        timed to an instant; their responses still adjust the rate.
+
+        """
+        self.__local.unscheduled = True
+        try:
+            yield self
+        finally:
+            self.__local.unscheduled = False
+
+    def send(self, request, **kwargs):
+        self.last_sent = time()
+        host = self.scheduler.for_url(request.url)
+        if host is None:
+            return requests.Session.send(self, request, **kwargs)
+
+        if not getattr(self.__local, 'unscheduled', False):
+            host.acquire()
+        try:
+            res = requests.Session.send(self, request, **kwargs)
+        except requests.ConnectionError:
+            host.on_error()
+            raise
+
+        if res.status_code == 429 or res.status_code >= 500:
+            host.on_error()
+        elif not kwargs.get('stream') and any(m in res.content for m in self.throttle_markers):
+            host.on_throttle()
+            if self.logger:
+                self.logger.info("Throttled by {}, rate down to {:.3f} req/s".format(
+                    urlsplit(request.url).netloc, host.rate))
+        else:
+            host.on_success()
+        return res
+
+
+def test_host_scheduler():
+    now = [0.]
+
+    def sleeper(sec):
+        now[0] += sec
+
+    s = HostScheduler(rate=1., burst=2, increase=0.1, hold=10., clock=lambda: now[0], sleeper=sleeper)
+    assert s.acquire() == 0 and s.acquire() == 0
+    assert abs(s.acquire() - 1.) < 1e-9
+
+    s.on_success()
+    assert abs(s.rate - 1.1) < 1e-9
+    s.on_throttle()
+    assert abs(s.rate - 0.55) < 1e-9
+    s.on_success()
+    assert abs(s.rate - 0.55) < 1e-9  # held after a throttle
+    now[0] += 4.
+    assert abs(s.cool_down() - 6.) < 1e-9 and s.cool_down() == 0.
+    s.on_success()
+    assert abs(s.rate - 0.65) < 1e-9
+
+    for _ in range(20):
+        s.on_throttle()
+    assert s.rate == s.min_rate
+    assert s.snapshot()['throttles'] == 21
+
+    scheduler = RequestScheduler(rate=2.)
+    assert scheduler.for_url('https://a.cn/x') is scheduler.for_url('https://a.cn/y')
+    assert scheduler.rates() == {'a.cn': 2.}
+    assert RequestScheduler(enabled=False).for_url('https://a.cn/') is None
+
+    from replay import StandInServer
+
+    server = StandInServer([{'method': 'GET', 'path': '/x', 'params': {}, 'status': 200,
+                             'headers': {}, 'content': 'ok'}]).start()
+    try:
+        ses = ScheduledSession(RequestScheduler(rate=1. / 60, burst=1, increase=0., clock=lambda: now[0],
+                                                sleeper=sleeper))
+        url = server.url + '/x'
+        ses.get(url)
+        start = now[0]
+        with ses.unscheduled():
+            for _ in range(3):
+                ses.get(url)
+        assert now[0] == start
+        ses.get(url)
+        assert now[0] - start > 50.
+    finally:
+        server.stop()
+
+    print 'host scheduler test passed'
+
+
+if __name__ == '__main__':
+    test_host_scheduler()
@@ -0,0 +1,252 @@
+# encoding: utf-8
+
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+from collections import defaultdict
+
+from seatrecords import SeatRecord, records_to_time_dic
+
+
+# E0E0E0 means time, CCCCCC means seat info
+COLOR_DATE = u'#E0E0E0'
+COLOR_SEAT = u'#CCCCCC'
+
+STATUS_MAP = {u'有名额': True,
+              u'名额已报满': False}
+
+
+class _StopParsing(Exception):
+    pass
+
+
+class SeatTableParser(HTMLParser):
+    """
+    Event-based extractor of the seat table on the SeatsQuery page.
+
+    Only rows inside ``<div id="maincontent">`` whose bgcolor is
+    #E0E0E0 (date) or #CCCCCC (seat info) are collected, no DOM is built,
+    and parsing stops as soon as the maincontent div is closed.
+
+    Attributes
+    ----------
+    records : list of SeatRecord
+        Rows in page order.
+    time_dic : defaultdict(list)
+        Same output as the former BeautifulSoup version of str2dic.
+    found_main : bool
+        Whether the maincontent div was met.
+    row_count : int
+        Number of <tr> in maincontent, regardless of color.
+    main_text : unicode
+        Text of maincontent, only kept when it contains no <tr>.
+
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+
+        self.records = []
+        self.found_main = False
+        self.row_count = 0
+
+        self._main_depth = 0  # depth of nested <div> in maincontent, 0 means outside
+        self._main_chunks = []
+        self._row_color = None
+        self._row_chunks = []
+        self._cells = []
+        self._cell_chunks = None
+        self._date = '0'*8
+
+    @property
+    def time_dic(self):
+        return records_to_time_dic(self.records)
+
+    @property
+    def main_text(self):
+        return u''.join(self._main_chunks)
+
+    def handle_starttag(self, tag, attrs):
+        if not self._main_depth:
+            if tag == 'div' and not self.found_main and dict(attrs).get('id') == 'maincontent':
+                self.found_main = True
+                self._main_depth = 1
+            return
+
+        if tag == 'div':
+            self._main_depth += 1
+        elif tag == 'tr':
+            self._end_row()
+            self.row_count += 1
+            self._main_chunks = []
+            color = dict(attrs).get('bgcolor')
+            if color in (COLOR_DATE, COLOR_SEAT):
+                self._row_color = color
+        elif tag == 'td' and self._row_color == COLOR_SEAT:
+            self._end_cell()
+            self._cell_chunks = []
+
+    def handle_endtag(self, tag):
+        if not self._main_depth:
+            return
+
+        if tag == 'div':
+            self._main_depth -= 1
+            if not self._main_depth:
+                self._end_row()
+                raise _StopParsing
+        elif tag == 'tr':
+            self._end_row()
+        elif tag == 'td':
+            self._end_cell()
+
+    def handle_data(self, data):
+        if not self._main_depth:
+            return
+
+        if self._row_color:
+            self._row_chunks.append(data)
+            if self._cell_chunks is not None:
+                self._cell_chunks.append(data)
+        elif not self.row_count:
+            self._main_chunks.append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data(u'&' + name)
+
+    def handle_charref(self, name):
+        if name[0] in 'xX':
+            code = int(name[1:], 16)
+        else:
+            code = int(name)
+        self.handle_data(unichr(code))
+
+    def _end_cell(self):
+        if self._cell_chunks is not None:
+            self._cells.append(u''.join(self._cell_chunks))
+            self._cell_chunks = None
+
+    def _end_row(self):
+        color = self._row_color
+        if not color:
+            return
+        self._end_cell()
+
+        if color == COLOR_DATE:
+            self._date = u''.join(self._row_chunks).encode('ascii', 'ignore')[:9]
+        else:
+            tds = self._cells
+            status = tds[4]
+            if status not in STATUS_MAP:
+                raise NotImplementedError(u"status = {}".format(status))
+
+            self.records.append(SeatRecord(self._date, tds[1], tds[2], STATUS_MAP[status]))
+
+        self._row_color = None
+        self._row_chunks = []
+        self._cells = []
+
+
+def parse_seat_table(s):
+    """
+    Run SeatTableParser over a decoded SeatsQuery page.
+
+    Parameters
+    ----------
+    s : unicode
+
+    Returns
+    -------
+    parser : SeatTableParser
+
+    """
+    parser = SeatTableParser()
+    try:
+        parser.feed(s)
+        parser.close()
+    except _StopParsing:
+        pass
+
+    if not parser.found_main:
+        raise ValueError("No maincontent div in SeatsQuery page.")
+    return parser
+
+
+def parse_seat_page(content, encoding='gb2312'):
+    """SeatRecord list of a raw SeatsQuery page, picklable for parser processes."""
+    return parse_seat_table(content.decode(encoding, 'replace')).records
+
+
+def parse_seat_table_soup(s):
+    """Reference BeautifulSoup implementation, kept for parity tests and benchmarks."""
+    from bs4 import BeautifulSoup
+
+    time_dic = defaultdict(list)
+
+    soup = BeautifulSoup(s, 'html.parser')
+    try:
+        main = soup.find_all('div', {'id': 'maincontent'})[0]
+
+        sections_raw = main.find_all('tr')
+        color_allowed = [COLOR_DATE, COLOR_SEAT]
+        sections = filter(lambda x: x.attrs.get('bgcolor') in color_allowed, sections_raw)
+
+        date = '0'*8
+        for sec in sections:
+            if sec.attrs['bgcolor'] == COLOR_DATE:
+                date = sec.text.encode('ascii', 'ignore')[:9]
+            else:
+                tds = sec.find_all('td')
+                site_dic = {'location': tds[2].text,
+                            'status': STATUS_MAP[tds[4].text],
+                            'location_code': tds[1].text}
+                time_dic[date].append(site_dic)
+    finally:
+        soup.decompose()
+
+    return time_dic
+
+
+def load_fixture(name, encoding='gb2312'):
+    """Read a recorded page under fixtures/ and return it decoded."""
+    import os
+    import codecs
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', name)
+    with codecs.open(path, 'r', encoding) as f:
+        return f.read()
+
+
+def test_seat_table_parser():
+    import json
+
+    for name in ['seats_query_open.html', 'seats_query_full.html', 'seats_query_nested.html']:
+        page = load_fixture(name)
+        expected = json.loads(load_fixture(name.replace('.html', '.json'), 'utf-8'))
+        parser = parse_seat_table(page)
+        assert dict(parser.time_dic) == expected, name
+        assert len(parser.records) == sum(len(sites) for sites in expected.values()), name
+
+        try:
+            soup_res = parse_seat_table_soup(page)
+        except ImportError:
+            continue
+        assert dict(soup_res) == dict(parser.time_dic), name
+
+    parser = parse_seat_table(load_fixture('seats_query_empty.html'))
+    assert parser.row_count == 0
+    assert not parser.time_dic
+    assert u'没有' in parser.main_text
+
+    try:
+        parse_seat_table(u'<html><body></body></html>')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    print 'seat table parser test passed'
+
+
+if __name__ == '__main__':
+    test_seat_table_parser()
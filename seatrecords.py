@@ -0,0 +1,171 @@
+# encoding: utf-8
+
+"""
+Compact representation of seat query results.
+
+SeatRecord is one row of the seat table of a SeatsQuery page.  SeatHistory
+keeps many snapshots of such rows in a few typed arrays, the strings of
+location codes and names are stored once in a table and referred to by
+index, so a row costs about 20 bytes instead of a dict of 3 items.
+
+"""
+from array import array
+from time import time
+from collections import namedtuple, defaultdict
+
+
+SeatRecord = namedtuple('SeatRecord', ['date', 'location_code', 'location', 'status'])
+
+
+def records_to_time_dic(records):
+    """date -> list of site dicts, the former output of str2dic."""
+    time_dic = defaultdict(list)
+    for r in records:
+        time_dic[r.date].append({'location': r.location, 'status': r.status, 'location_code': r.location_code})
+    return time_dic
+
+
+def time_dic_to_records(time_dic):
+    return [SeatRecord(date, s['location_code'], s['location'], s['status'])
+            for date, sites in sorted(time_dic.items()) for s in sites]
+
+
+class SeatHistory(object):
+    """
+    Columnar, array-backed history of SeatRecord snapshots.
+
+    Parameters
+    ----------
+    max_rows : int, default None
+        When exceeded, the oldest rows are dropped.
+    drop_ratio : float, default 0.1
+        Part of max_rows dropped beyond the excess, a full history is shifted
+        once every so many snapshots rather than on each of them.
+
+    Attributes
+    ----------
+    ts : array('d')
+        Seconds since epoch of the snapshot of each row.
+    date : array('i')
+        Exam dates as YYYYMMDD.
+    code, location : array('i')
+        Indexes into the string tables.
+    status : array('b')
+
+    """
+    def __init__(self, max_rows=None, drop_ratio=0.1):
+        self.max_rows = max_rows
+        self.drop_ratio = drop_ratio
+        self.ts = array('d')
+        self.date = array('i')
+        self.code = array('i')
+        self.location = array('i')
+        self.status = array('b')
+        self.__strings = []
+        self.__index = dict()
+
+    def _intern(self, s):
+        i = self.__index.get(s)
+        if i is None:
+            i = self.__index[s] = len(self.__strings)
+            self.__strings.append(s)
+        return i
+
+    def __len__(self):
+        return len(self.ts)
+
+    def append(self, record, ts=None):
+        self.extend([record], ts)
+
+    def extend(self, records, ts=None):
+        """Add one snapshot, all records get the same timestamp."""
+        ts = time() if ts is None else ts
+        for r in records:
+            self.ts.append(ts)
+            self.date.append(int(r.date))
+            self.code.append(self._intern(r.location_code))
+            self.location.append(self._intern(r.location))
+            self.status.append(bool(r.status))
+
+        if self.max_rows is not None and len(self) > self.max_rows:
+            self.drop(len(self) - self.max_rows + int(self.max_rows * self.drop_ratio))
+
+    def drop(self, n):
+        """Forget the n oldest rows, the string tables are kept."""
+        for column in (self.ts, self.date, self.code, self.location, self.status):
+            del column[:n]
+
+    def record(self, i):
+        strings = self.__strings
+        return SeatRecord('{:08d}'.format(self.date[i]), strings[self.code[i]],
+                          strings[self.location[i]], bool(self.status[i]))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.record(i)
+
+    def snapshot(self, ts=None):
+        """Records of the snapshot taken at ts, the last one by default."""
+        if not len(self):
+            return []
+        ts = self.ts[-1] if ts is None else ts
+        return [self.record(i) for i in xrange(len(self)) if self.ts[i] == ts]
+
+    @property
+    def nbytes(self):
+        """Size of the arrays, the string tables are not counted."""
+        return sum(c.itemsize * len(c) for c in (self.ts, self.date, self.code, self.location, self.status))
+
+    def to_dataframe(self):
+        """Columns ts, date, location_code, location and status."""
+        import numpy as np
+        import pandas as pd
+
+        strings = np.array(self.__strings, dtype=object)
+        return pd.DataFrame({'ts': pd.to_datetime(np.frombuffer(self.ts, dtype=np.float64), unit='s'),
+                             'date': np.frombuffer(self.date, dtype=np.int32),
+                             'location_code': strings[np.frombuffer(self.code, dtype=np.int32)],
+                             'location': strings[np.frombuffer(self.location, dtype=np.int32)],
+                             'status': np.frombuffer(self.status, dtype=np.int8).astype(bool)},
+                            columns=['ts', 'date', 'location_code', 'location', 'status'])
+
+
+def test_seat_history():
+    records = [SeatRecord('20171014', 'STN80001A', u'上海交通大学', False),
+               SeatRecord('20171014', 'STN80002A', u'上海财经大学', True),
+               SeatRecord('20171028', 'STN80001A', u'上海交通大学', True)]
+    assert time_dic_to_records(records_to_time_dic(records)) == records
+
+    history = SeatHistory(max_rows=5)
+    history.extend(records, ts=1.)
+    history.extend(records[:2], ts=2.)
+    assert len(history) == 5 and list(history) == records + records[:2]
+    assert history.snapshot() == records[:2] and history.snapshot(1.) == records
+    assert history.nbytes == 5 * 21
+
+    history.extend(records[2:], ts=3.)
+    assert len(history) == 5 and history.record(0) == records[1]
+
+    # rows dropped in chunks of a tenth of max_rows
+    history = SeatHistory(max_rows=100)
+    sizes = []
+    for i in range(40):
+        history.extend(records, ts=float(i))
+        sizes.append(len(history))
+    assert sizes[32:] == [99, 90, 93, 96, 99, 90, 93, 96], sizes
+    assert history.record(0) == records[0] and history.ts[0] == 8.
+
+    history = SeatHistory(max_rows=5)
+    history.extend(records, ts=1.)
+    history.extend(records[:2], ts=2.)
+    history.extend(records[2:], ts=3.)
+    df = history.to_dataframe()
+    assert list(df['location_code']) == ['STN80002A', 'STN80001A', 'STN80001A', 'STN80002A', 'STN80001A']
+    assert df['status'].tolist() == [True, True, False, True, True]
+    assert df['date'].iloc[-1] == 20171028 and df['ts'].iloc[-1].second == 3
+
+    print 'seat history test passed'
+
+
+if __name__ == '__main__':
+    test_seat_history()
@@ -0,0 +1,240 @@
+# encoding: utf-8
+
+"""
+Preference ranking of the open seats of seat tables.
+
+SeatSelector scores every open (date, site) of a seat table: a candidate
+is kept if its date is in the date window, its province is allowed and its
+site is whitelisted, then ordered by the priority of its site, the rank of
+its province and its date.  As with PriorityQueue of graspcourse, lower
+priorities come first, and once a registration went through at some
+priority only strictly better candidates are offered.
+
+Seat tables of the site have some hundred rows, their open seats are
+ranked in Python; numpy pays off from NUMPY_MIN_ROWS rows on and is
+imported on the first such ranking, the scrapers start without it.
+
+"""
+from itertools import compress, imap, repeat
+from operator import itemgetter
+
+
+# priority of the sites without one, offered until a registration
+DEFAULT_PRIORITY = 65535
+# rows of a seat table from which rank scores its open seats with numpy
+NUMPY_MIN_ROWS = 1000
+
+
+class SeatSelector(object):
+    """
+    Parameters
+    ----------
+    date_from, date_to : int or str, default None
+        Bounds of the date window as YYYYMMDD, both included, None for no bound.
+    provinces : list of str, default None
+        Allowed provinces in order of preference, None allows all of them alike.
+    whitelist : list of str, default None
+        The only location codes offered, None offers all of them.
+    priorities : dict, default None
+        location code -> priority, lower first, DEFAULT_PRIORITY for the others.
+    max_attempts : int, default None
+        Candidates offered per seat table, None for all of them.
+
+    Attributes
+    ----------
+    priority : int
+        Only candidates of lower priority are offered, see accept.
+
+    """
+    def __init__(self, date_from=None, date_to=None, provinces=None, whitelist=None, priorities=None,
+                 max_attempts=None):
+        self.date_from = int(date_from) if date_from is not None else None
+        self.date_to = int(date_to) if date_to is not None else None
+        self.provinces = list(provinces) if provinces is not None else None
+        self.whitelist = set(whitelist) if whitelist is not None else None
+        self.priorities = dict(priorities or {})
+        self.max_attempts = max_attempts
+        self.priority = DEFAULT_PRIORITY + 1
+        # location code -> priority of the sites that may be offered
+        if self.whitelist is None:
+            self.__lookup = self.priorities
+        else:
+            self.__lookup = dict((c, self.priorities.get(c, DEFAULT_PRIORITY)) for c in self.whitelist)
+
+    @classmethod
+    def from_dict(cls, dic):
+        """The selector of the 'seat_preferences' entry of a config."""
+        return cls(**dic)
+
+    def province_rank(self, province):
+        """Rank of province in the preferences, None if it is not allowed."""
+        if self.provinces is None or province is None:
+            return 0
+        try:
+            return self.provinces.index(province)
+        except ValueError:
+            return None
+
+    def site_priorities(self, codes, count=-1):
+        """
+        Array of the priorities of the location codes of the iterable codes.
+
+        Sites out of the whitelist get the current threshold, i.e. are never offered.
+
+        """
+        import numpy as np
+
+        default = DEFAULT_PRIORITY if self.whitelist is None else self.priority
+        # the lookups run in C, one dict.get per code
+        return np.fromiter(imap(self.__lookup.get, codes, repeat(default)), np.int64, count)
+
+    def scores(self, dates, priorities, province_ranks=0):
+        """
+        Score of every candidate, lower first, -1 for the candidates not offered.
+
+        Parameters
+        ----------
+        dates : array of int
+            YYYYMMDD of the open seats.
+        priorities : array of int
+            Priorities of their sites, as of site_priorities.
+        province_ranks : int or array of int
+            Ranks of their provinces, as of province_rank.
+
+        """
+        import numpy as np
+
+        dates = np.asarray(dates, dtype=np.int64)
+        prio = np.asarray(priorities, dtype=np.int64)
+        keep = prio < self.priority
+        if self.date_from is not None:
+            keep &= dates >= self.date_from
+        if self.date_to is not None:
+            keep &= dates <= self.date_to
+        # dates take 8 digits, the provinces the next 4
+        score = prio * 10 ** 12 + np.asarray(province_ranks, dtype=np.int64) * 10 ** 8 + dates
+        score[~keep] = -1
+        return score
+
+    def order(self, scores):
+        """Indexes of the offered candidates by score, at most max_attempts of them."""
+        import numpy as np
+
+        candidates = np.flatnonzero(scores >= 0)
+        if self.max_attempts == 1 and len(candidates):
+            return candidates[[np.argmin(scores[candidates])]]
+        ranked = candidates[np.argsort(scores[candidates], kind='mergesort')]
+        return ranked[:self.max_attempts]
+
+    def rank(self, records, province=None):
+        """
+        The open SeatRecords of one seat table to try, best first.
+
+        Parameters
+        ----------
+        records : list of SeatRecord
+        province : str, default None
+            Province of the seat table, None if unknown.
+
+        """
+        province_rank = self.province_rank(province)
+        if province_rank is None:
+            return []
+        available = compress(records, imap(itemgetter(3), records))
+        if len(records) >= NUMPY_MIN_ROWS:
+            return self.__rank_numpy(list(available), province_rank)
+
+        # the order of the scores, the province rank is the same for the whole table
+        lookup = self.__lookup.get
+        default = DEFAULT_PRIORITY if self.whitelist is None else self.priority
+        date_from, date_to = self.date_from, self.date_to
+        keyed = []
+        for record in available:
+            prio = lookup(record[1], default)
+            if prio >= self.priority:
+                continue
+            date = int(record[0])
+            if (date_from is None or date >= date_from) and (date_to is None or date <= date_to):
+                keyed.append((prio, date, len(keyed), record))
+        if not keyed:
+            return keyed
+        keyed.sort()
+        return [k[3] for k in keyed[:self.max_attempts]]
+
+    def __rank_numpy(self, available, province_rank):
+        if not available:
+            return []
+        import numpy as np
+
+        n = len(available)
+        dates = np.fromiter(imap(int, imap(itemgetter(0), available)), np.int64, n)
+        prio = self.site_priorities(imap(itemgetter(1), available), n)
+        return [available[i] for i in self.order(self.scores(dates, prio, province_rank))]
+
+    def best(self, records, province=None):
+        """The best open SeatRecord of one seat table, None if no seat is acceptable."""
+        max_attempts, self.max_attempts = self.max_attempts, 1
+        try:
+            ranked = self.rank(records, province)
+        finally:
+            self.max_attempts = max_attempts
+        return ranked[0] if ranked else None
+
+    def accept(self, location_code):
+        """A registration at location_code went through, only better sites are offered from now on."""
+        self.priority = min(self.priority, self.priorities.get(location_code, DEFAULT_PRIORITY))
+
+
+def test_seat_selector():
+    from seatrecords import SeatRecord
+
+    records = [SeatRecord('20171014', 'STN80001A', u'上海交通大学', True),
+               SeatRecord('20171014', 'STN80002A', u'上海财经大学', True),
+               SeatRecord('20171021', 'STN80003A', u'复旦大学', True),
+               SeatRecord('20171028', 'STN80002A', u'上海财经大学', True),
+               SeatRecord('20171104', 'STN80002A', u'上海财经大学', True),
+               SeatRecord('20171021', 'STN80002A', u'上海财经大学', False)]
+
+    # no preferences: the earliest open seat
+    selector = SeatSelector()
+    assert selector.best(records) == records[0]
+    assert [r.location_code for r in selector.rank(records)] == ['STN80001A', 'STN80002A', 'STN80003A',
+                                                                'STN80002A', 'STN80002A']
+
+    selector = SeatSelector.from_dict({'date_from': '20171015', 'date_to': 20171031,
+                                       'provinces': ['Shanghai', 'Jiangsu'],
+                                       'priorities': {'STN80002A': 0, 'STN80003A': 1}})
+    assert selector.rank(records, 'Shanghai') == [records[3], records[2]]
+    assert selector.rank(records, 'Zhejiang') == []
+    assert selector.rank([r._replace(status=False) for r in records]) == []
+
+    # a registration at priority 1, only priority 0 is offered then
+    selector.accept('STN80003A')
+    assert selector.rank(records, 'Shanghai') == [records[3]]
+    selector.accept('STN80002A')
+    assert selector.best(records, 'Shanghai') is None
+
+    selector = SeatSelector(whitelist=['STN80002A'], max_attempts=2)
+    assert selector.rank(records) == [records[1], records[3]]
+    assert list(selector.site_priorities(['STN80001A', 'STN80002A'])) == [DEFAULT_PRIORITY + 1, DEFAULT_PRIORITY]
+
+    # large tables are ranked with numpy, in the same order
+    selector = SeatSelector(date_from=20171015, priorities={'STN80002A': 1, 'STN80003A': 0}, max_attempts=10)
+    rank_numpy = selector._SeatSelector__rank_numpy
+    opened = [r for r in records if r.status]
+    assert selector.rank(records) == rank_numpy(opened, 0)
+    large = records * (NUMPY_MIN_ROWS // 5)
+    assert len(selector.rank(large)) == 10
+    selector.max_attempts = None
+    assert selector.rank(large) == [r for r in selector.rank(records) for _ in range(NUMPY_MIN_ROWS // 5)]
+
+    # a preferred province comes before a later one at the same site priority
+    selector = SeatSelector(provinces=['Jiangsu', 'Shanghai'])
+    scores = selector.scores([20171014, 20171021], selector.site_priorities(['STN80001A', 'STN80001A']), [1, 0])
+    assert list(selector.order(scores)) == [1, 0]
+
+    print 'seat selector test passed'
+
+
+if __name__ == '__main__':
+    test_seat_selector()
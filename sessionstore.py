@@ -0,0 +1,233 @@
+# encoding: utf-8
+
+"""
+Authenticated sessions kept on disk across restarts.
+
+A login costs a captcha, which is both slow and paid for, so the cookie jar
+of a logged in session is written to a file per (site, account); the
+headers come from the config of each run.  After a restart the scraper
+loads the cookies, checks them with one cheap request and only logs in
+again when the site has dropped the session.  Heartbeat keeps an idle
+session alive with the same cheap request and writes back the cookies the
+site rotated.
+
+"""
+import os
+import re
+import json
+import threading
+from time import time
+
+from requests.cookies import create_cookie
+
+
+COOKIE_FIELDS = ('name', 'value', 'domain', 'path', 'expires', 'secure')
+
+
+def _cookie_to_dict(cookie):
+    dic = dict((k, getattr(cookie, k)) for k in COOKIE_FIELDS)
+    dic['rest'] = {'HttpOnly': None} if cookie.has_nonstandard_attr('HttpOnly') else {}
+    return dic
+
+
+class SessionStore(object):
+    """
+    JSON files of cookies, one per (site, account).
+
+    Parameters
+    ----------
+    directory : str
+        Created on first save.  The files hold live credentials and are
+        only readable by their owner.
+    max_age : float, default 86400.
+        Seconds after which a saved session is not loaded any more.
+    heartbeat : float, default 240.
+        Seconds of idleness after which the session is checked, 0 for no heartbeat.
+
+    """
+    def __init__(self, directory, max_age=86400., heartbeat=240.):
+        self.directory = directory
+        self.max_age = max_age
+        self.heartbeat = heartbeat
+
+    @classmethod
+    def from_dict(cls, dic, config_path):
+        """
+        The 'session_store' entry of a config, None if it has "enabled": false.
+
+        The directory defaults to 'sessions', relative to the config file.
+
+        """
+        dic = dict(dic)
+        if not dic.pop('enabled', True):
+            return None
+        directory = os.path.join(os.path.dirname(os.path.abspath(config_path)), dic.pop('directory', 'sessions'))
+        return cls(directory, **dic)
+
+    def file_path(self, site, account):
+        name = re.sub(r'[^\w.-]', '_', u'{}-{}'.format(site, account))
+        return os.path.join(self.directory, name + '.json')
+
+    def save(self, site, account, ses):
+        """Write the cookies of ses, to a temporary file first."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+        state = {'saved_at': time(),
+                 'cookies': [_cookie_to_dict(c) for c in ses.cookies]}
+        file_path = self.file_path(site, account)
+        tmp_path = file_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, file_path)
+
+    def load(self, site, account, ses):
+        """
+        Put the saved cookies into ses, its configured headers are kept.
+
+        Returns
+        -------
+        loaded : bool
+            False if nothing usable was saved, ses is left untouched then.
+
+        """
+        try:
+            with open(self.file_path(site, account)) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        now = time()
+        if now - state.get('saved_at', 0) > self.max_age:
+            return False
+        cookies = [c for c in state['cookies'] if c['expires'] is None or c['expires'] > now]
+        if not cookies:
+            return False
+
+        for c in cookies:
+            ses.cookies.set_cookie(create_cookie(**c))
+        return True
+
+    def delete(self, site, account):
+        try:
+            os.remove(self.file_path(site, account))
+        except OSError:
+            pass
+
+
+class Heartbeat(object):
+    """
+    Keep the session of a scraper alive from a daemon thread.
+
+    Every `interval` seconds without other requests the scraper is asked
+    is_session_alive(); a live session is saved, a dead one sets
+    login_state to False for the main loop to log in again.
+
+    Parameters
+    ----------
+    scraper : BaseWebScraping
+    interval : float, default 240.
+
+    """
+    def __init__(self, scraper, interval=240.):
+        self.scraper = scraper
+        self.interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def beat(self):
+        scraper = self.scraper
+        if time() - scraper.ses.last_sent < self.interval:
+            return None
+        try:
+            alive = scraper.is_session_alive()
+        except Exception, e:
+            scraper.logger.warn("heartbeat failed: {}".format(e))
+            return None
+        if alive:
+            scraper.save_session()
+        else:
+            scraper.logger.warn("session expired, login again.")
+            scraper.login_state = False
+        return alive
+
+    def _run(self):
+        while not self.__stop.wait(self.interval):
+            self.beat()
+
+    def start(self):
+        self.__thread = threading.Thread(target=self._run, name='heartbeat')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+
+def test_session_store():
+    import shutil
+    import tempfile
+    import requests
+
+    config_path = os.path.join(tempfile.mkdtemp(), 'toefl.json')
+    assert SessionStore.from_dict({'enabled': False}, config_path) is None
+    store = SessionStore.from_dict({'max_age': 3600.}, config_path)
+    directory = store.directory
+    assert directory == os.path.join(os.path.dirname(config_path), 'sessions') and store.max_age == 3600.
+    ses = requests.Session()
+    ses.headers['Referer'] = 'https://toefl.etest.net.cn/cn/TOEFLAPP'
+    ses.cookies.set('JSESSIONID', 'abc', domain='toefl.etest.net.cn', path='/cn/')
+    ses.cookies.set('old', 'x', domain='toefl.etest.net.cn', expires=1)
+    store.save('toefl.etest.net.cn', 'NEEA1234', ses)
+    file_path = store.file_path('toefl.etest.net.cn', 'NEEA1234')
+    assert os.stat(file_path).st_mode & 0777 == 0600
+
+    restored = requests.Session()
+    restored.headers['Referer'] = 'https://toefl.etest.net.cn/'
+    assert store.load('toefl.etest.net.cn', 'NEEA1234', restored)
+    assert restored.cookies.get('JSESSIONID', domain='toefl.etest.net.cn', path='/cn/') == 'abc'
+    assert 'old' not in restored.cookies.keys()  # expired
+    assert restored.headers['Referer'] == 'https://toefl.etest.net.cn/'  # not the saved one
+    assert not store.load('toefl.etest.net.cn', 'other', requests.Session())
+
+    assert not SessionStore(directory, max_age=-1.).load('toefl.etest.net.cn', 'NEEA1234', requests.Session())
+    store.delete('toefl.etest.net.cn', 'NEEA1234')
+    assert not os.path.exists(file_path)
+
+    class Scraper(object):
+        alive = True
+        login_state = True
+        saved = 0
+
+        def __init__(self):
+            import logging
+            self.ses = requests.Session()
+            self.ses.last_sent = 0.
+            self.logger = logging.getLogger('heartbeat')
+            self.logger.addHandler(logging.NullHandler())
+
+        def is_session_alive(self):
+            return self.alive
+
+        def save_session(self):
+            self.saved += 1
+
+    scraper = Scraper()
+    heartbeat = Heartbeat(scraper, interval=60.)
+    assert heartbeat.beat() and scraper.saved == 1
+    scraper.ses.last_sent = time()
+    assert heartbeat.beat() is None  # the main loop has just sent a request
+    scraper.ses.last_sent, scraper.alive = 0., False
+    assert heartbeat.beat() is False and not scraper.login_state and scraper.saved == 1
+    heartbeat.interval = 0.01
+    heartbeat.start().stop()
+
+    shutil.rmtree(os.path.dirname(directory))
+    print 'session store test passed'
+
+
+if __name__ == '__main__':
+    test_session_store()
@@ -0,0 +1,244 @@
+# encoding: utf-8
+
+"""
+Append-only history of seat tables, course lists and submit results.
+
+Rows go to an SQLite database in WAL mode.  add_* only append to a list in
+memory; the rows are written in one transaction when batch_size of them
+are pending or flush_interval seconds have passed, so the poll loop pays
+for a commit once in a while instead of on every snapshot.  A seat table
+or course list whose digest is that of its previous snapshot is not
+appended again, the history keeps the pages as first seen rather than a
+copy per poll.  Queries run on indexes and return iterators over the
+cursor, they never load the whole history.
+
+"""
+import os
+import sqlite3
+import threading
+from time import time
+from collections import namedtuple
+
+
+SeatSnapshot = namedtuple('SeatSnapshot', ['ts', 'month', 'province', 'date', 'location_code', 'status', 'digest'])
+CourseSnapshot = namedtuple('CourseSnapshot', ['ts', 'course_type', 'course_id', 'status', 'digest'])
+# message is None for an accepted submit
+SubmitResult = namedtuple('SubmitResult', ['ts', 'course_id', 'course_type', 'message', 'digest'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seats (ts REAL, month TEXT, province TEXT, date INTEGER,
+                                  location_code TEXT, status INTEGER, digest BLOB);
+CREATE INDEX IF NOT EXISTS seats_ts ON seats (ts);
+CREATE INDEX IF NOT EXISTS seats_site ON seats (location_code, ts);
+CREATE TABLE IF NOT EXISTS courses (ts REAL, course_type TEXT, course_id TEXT, status TEXT, digest BLOB);
+CREATE INDEX IF NOT EXISTS courses_ts ON courses (ts);
+CREATE INDEX IF NOT EXISTS courses_id ON courses (course_id, ts);
+CREATE TABLE IF NOT EXISTS submits (ts REAL, course_id TEXT, course_type TEXT, message TEXT, digest BLOB);
+CREATE INDEX IF NOT EXISTS submits_id ON submits (course_id, ts);
+"""
+
+_INSERT = {'seats': 'INSERT INTO seats VALUES (?, ?, ?, ?, ?, ?, ?)',
+           'courses': 'INSERT INTO courses VALUES (?, ?, ?, ?, ?)',
+           'submits': 'INSERT INTO submits VALUES (?, ?, ?, ?, ?)'}
+
+
+def _blob(digest):
+    return buffer(digest) if digest is not None else None
+
+
+class SnapshotStore(object):
+    """
+    Parameters
+    ----------
+    path : str
+        SQLite database file, created if missing.
+    batch_size : int, default 5000
+        Pending rows that trigger a write.
+    flush_interval : float, default 10.
+        Seconds after which pending rows are written anyway.
+
+    Attributes
+    ----------
+    stats : dict
+        Counts of 'rows' written, 'flushes' and 'unchanged' snapshots skipped.
+
+    """
+    def __init__(self, path, batch_size=5000, flush_interval=10., clock=time):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {'rows': 0, 'flushes': 0, 'unchanged': 0}
+        self.__clock = clock
+        self.__pending = dict((table, []) for table in _INSERT)
+        self.__count = 0
+        self.__last_flush = clock()
+        self.__lock = threading.RLock()
+        # (table, key) -> digest of the last snapshot of a page
+        self.__digests = dict()
+
+        # shared by the threads of the concurrent scrapers, serialized by the lock
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        # a crash may lose the last transactions, never corrupt the file
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.executescript(SCHEMA)
+
+    @classmethod
+    def from_dict(cls, dic, config_path):
+        """
+        The 'snapshot_store' entry of a config, None if it has "enabled": false.
+
+        The path defaults to 'snapshots.db', relative to the config file.
+
+        """
+        dic = dict(dic)
+        if not dic.pop('enabled', True):
+            return None
+        path = os.path.join(os.path.dirname(os.path.abspath(config_path)), dic.pop('path', 'snapshots.db'))
+        return cls(path, **dic)
+
+    def _append(self, table, rows):
+        with self.__lock:
+            self.__pending[table].extend(rows)
+            self.__count += len(rows)
+            if self.__count >= self.batch_size or self.__clock() - self.__last_flush >= self.flush_interval:
+                self.flush()
+
+    def _unchanged(self, key, digest):
+        """Whether digest is that of the previous snapshot of key, None is never."""
+        if digest is None:
+            return False
+        with self.__lock:
+            if self.__digests.get(key) == digest:
+                self.stats['unchanged'] += 1
+                return True
+            self.__digests[key] = digest
+        return False
+
+    def add_seats(self, month, province, records, digest=None, ts=None):
+        """Append the SeatRecords of one seat table, unless its digest is that of the previous one."""
+        if self._unchanged(('seats', month, province), digest):
+            return
+        ts = self.__clock() if ts is None else ts
+        digest = _blob(digest)
+        self._append('seats', [(ts, month, province, int(date), code, status, digest)
+                               for date, code, location, status in records])
+
+    def add_courses(self, course_type, records, digest=None, ts=None):
+        """Append the CourseRecords of one course list, unless its digest is that of the previous one."""
+        if self._unchanged(('courses', course_type), digest):
+            return
+        ts = self.__clock() if ts is None else ts
+        digest = _blob(digest)
+        self._append('courses', [(ts, course_type, r.id, r.status, digest) for r in records])
+
+    def add_submit(self, course_id, course_type, message, digest=None, ts=None):
+        ts = self.__clock() if ts is None else ts
+        self._append('submits', [(ts, str(course_id), course_type, message, _blob(digest))])
+
+    def flush(self):
+        with self.__lock, self.__db:
+            for table, rows in self.__pending.items():
+                if rows:
+                    self.__db.executemany(_INSERT[table], rows)
+                    del rows[:]
+            self.stats['rows'] += self.__count
+            self.stats['flushes'] += 1
+            self.__count = 0
+            self.__last_flush = self.__clock()
+
+    def _select(self, table, row_type, key_column, key, start, end, extra=()):
+        """Iterate the rows of table by ts, with key_column = key and start <= ts < end when given."""
+        if self.__count:
+            self.flush()
+        where, args = [], []
+        for clause, value in [(key_column + ' = ?', key), ('ts >= ?', start), ('ts < ?', end)] + list(extra):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+        sql = 'SELECT * FROM {}{} ORDER BY ts'.format(table, ' WHERE ' + ' AND '.join(where) if where else '')
+        # a cursor of its own, rows are fetched as the caller iterates
+        for row in self.__db.cursor().execute(sql, args):
+            row = list(row)
+            if row[-1] is not None:
+                row[-1] = str(row[-1])
+            yield row_type(*row)
+
+    def seats(self, location_code=None, start=None, end=None, month=None, province=None):
+        """Iterator of SeatSnapshot, of one site or all, within [start, end)."""
+        return self._select('seats', SeatSnapshot, 'location_code', location_code, start, end,
+                            [('month = ?', month), ('province = ?', province)])
+
+    def courses(self, course_id=None, start=None, end=None, course_type=None):
+        """Iterator of CourseSnapshot, of one course or all, within [start, end)."""
+        return self._select('courses', CourseSnapshot, 'course_id', course_id, start, end,
+                            [('course_type = ?', course_type)])
+
+    def submits(self, course_id=None, start=None, end=None):
+        return self._select('submits', SubmitResult, 'course_id', course_id, start, end)
+
+    def count(self, table='seats'):
+        if self.__count:
+            self.flush()
+        with self.__lock:
+            return self.__db.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.__db.close()
+
+
+def test_snapshot_store():
+    import shutil
+    import tempfile
+    from seatrecords import SeatRecord
+    from replay import fixture_path
+    from courselist import parse_course_list
+
+    directory = tempfile.mkdtemp()
+    now = [100.]
+    store = SnapshotStore(os.path.join(directory, 'snapshots.db'), batch_size=10, flush_interval=60.,
+                          clock=lambda: now[0])
+    records = [SeatRecord('20171014', 'STN80001A', u'上海交通大学', False),
+               SeatRecord('20171014', 'STN80002A', u'上海财经大学', True),
+               SeatRecord('20171028', 'STN80001A', u'上海交通大学', True)]
+    store.add_seats('201710', 'Shanghai', records, '\x00\xff' * 8)
+    assert store.stats['flushes'] == 0  # still pending
+    now[0] = 110.
+    store.add_seats('201710', 'Shanghai', records[:2], '\x01' * 16)
+    now[0] = 120.
+    store.add_seats('201710', 'Jiangsu', records[2:], ts=115.)
+    assert store.stats == {'rows': 0, 'flushes': 0, 'unchanged': 0}
+    now[0] = 125.
+    store.add_seats('201710', 'Shanghai', records[:2], '\x01' * 16)  # the page polled again, unchanged
+    assert store.stats['unchanged'] == 1
+    now[0] = 130.
+    store.add_seats('201710', 'Shanghai', records * 2)  # over the batch size
+    assert store.stats == {'rows': 12, 'flushes': 1, 'unchanged': 1}
+
+    site = list(store.seats('STN80001A'))
+    assert [s.ts for s in site] == [100., 100., 110., 115., 130., 130., 130., 130.]
+    assert site[0] == SeatSnapshot(100., '201710', 'Shanghai', 20171014, 'STN80001A', 0, '\x00\xff' * 8)
+    assert [s.province for s in store.seats(start=110., end=130.)] == ['Shanghai', 'Shanghai', 'Jiangsu']
+    assert len(list(store.seats('STN80001A', province='Jiangsu'))) == 1
+
+    with open(fixture_path('jw/course_list.html'), 'rb') as f:
+        courses = parse_course_list(f.read())
+    store.add_courses('tongxiu', courses, '\x02' * 16)
+    store.add_submit(74533, 'tongxiu', u'班级已满')
+    assert list(store.courses(courses[0].id))[0].status == courses[0].status == '30/30'
+    assert list(store.submits())[0].message == u'班级已满'
+    assert store.count() == 12 and store.count('submits') == 1
+    store.close()
+
+    # appended to by the next run
+    store = SnapshotStore(os.path.join(directory, 'snapshots.db'))
+    assert store.count() == 12
+    store.close()
+    shutil.rmtree(directory)
+
+    print 'snapshot store test passed'
+
+
+if __name__ == '__main__':
+    test_snapshot_store()
@@ -0,0 +1,252 @@
+# encoding: utf-8
+
+"""
+Soak test of the poll loops against the local stand-in server.
+
+Runs the step of a poll loop, seize_seats or notify_change, for many
+iterations on the recorded fixtures and samples every `every` iterations
+the RSS of the process, the objects tracked by the gc and the size of the
+session's cookie jar.  Caches, pools and bounded histories fill up during
+the first part of the run; past it, the growth per 1000 iterations of
+each probe must stay under a bound, so the run is a regression gate for
+leaks of the loops::
+
+    python soak.py toefl --iterations 20000
+    python soak.py course --iterations 20000 --rotate-cookies 1
+
+It exits 1 when a probe grows past its bound.
+
+"""
+import gc
+import sys
+import logging
+from time import time
+from collections import namedtuple
+
+
+Sample = namedtuple('Sample', ['iteration', 'elapsed', 'rss_kb', 'objects', 'cookies'])
+
+# growth per 1000 iterations past the warm-up; with rotated cookies the jar holds those of the
+# last second or so, a sawtooth of some hundred cookies, while a jar never trimmed gets thousands
+DEFAULT_BOUNDS = {'rss_kb': 512., 'objects': 500., 'cookies': 50.}
+
+
+def memory_kb(field='VmRSS'):
+    """
+    VmRSS (current) or VmHWM (peak) of this process in KB.
+
+    ru_maxrss is not used when /proc is there, on Linux a child started by
+    subprocess inherits the RSS of its parent into it.
+
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def slope(points):
+    """Least squares slope of (x, y) points, 0. for less than two of them."""
+    n = len(points)
+    if n < 2:
+        return 0.
+    mean_x = sum(x for x, _ in points) / float(n)
+    mean_y = sum(y for _, y in points) / float(n)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var if var else 0.
+
+
+class SoakRun(object):
+    """
+    Parameters
+    ----------
+    scraper : BaseWebScraping
+        Its session's cookie jar is sampled.
+    step : callable
+        i -> None, one iteration of the loop.
+    iterations : int, default 20000
+    every : int, default 500
+        Iterations between two samples.
+    warmup : float, default 0.5
+        Part of the run left out of the growth.
+    teardown : callable, default None
+        Called after the last iteration, e.g. to stop the threads of the scraper.
+
+    Attributes
+    ----------
+    samples : list of Sample
+
+    """
+    def __init__(self, scraper, step, iterations=20000, every=500, warmup=0.5, teardown=None):
+        self.scraper = scraper
+        self.step = step
+        self.teardown = teardown
+        self.iterations = iterations
+        self.every = every
+        self.warmup = warmup
+        self.samples = []
+
+    def sample(self, i, start):
+        gc.collect()
+        sample = Sample(i, time() - start, memory_kb(), len(gc.get_objects()), len(self.scraper.ses.cookies))
+        self.samples.append(sample)
+        return sample
+
+    def run(self, out=None):
+        """Run the iterations, out gets a line per sample if given."""
+        start = time()
+        try:
+            for i in xrange(self.iterations + 1):
+                if i % self.every == 0 or i == self.iterations:
+                    sample = self.sample(i, start)
+                    if out is not None:
+                        out.write('{:8d} {:8.1f} s {:10d} KB {:10d} objects {:6d} cookies\n'.format(*sample))
+                if i < self.iterations:
+                    self.step(i)
+        finally:
+            if self.teardown is not None:
+                self.teardown()
+        return self
+
+    def growth(self):
+        """dict of probe -> growth per 1000 iterations past the warm-up."""
+        past = [s for s in self.samples if s.iteration >= self.warmup * self.iterations]
+        return dict((probe, 1000. * slope([(s.iteration, getattr(s, probe)) for s in past]))
+                    for probe in DEFAULT_BOUNDS)
+
+    def check(self, bounds=None):
+        """Names of the probes growing past their bound, see DEFAULT_BOUNDS."""
+        bounds = dict(DEFAULT_BOUNDS, **(bounds or {}))
+        growth = self.growth()
+        return sorted(probe for probe, bound in bounds.items() if growth[probe] > bound)
+
+
+def _quiet(scraper):
+    from scheduler import RequestScheduler
+
+    scraper.scheduler = RequestScheduler(enabled=False)
+    scraper.refresh_session()
+    # the messages are still built, only not written
+    scraper.logger.handlers = [logging.NullHandler()]
+    scraper.logger.propagate = False
+    return scraper
+
+
+def toefl_soak(server, **kwargs):
+    """SoakRun of seize_seats on the provinces picked by the polling planner, as grasp_seats does."""
+    from grasptoefl import ToeflScraping
+
+    grasper = _quiet(ToeflScraping())
+    grasper.url_prefix = 'https://toefl.etest.net.cn/cn/'
+    grasper.captcha_solver = lambda img: ('abcd', None)
+    # reaches its bound in the warm-up of a short run
+    grasper.seat_history.max_rows = 20000
+    server.attach(grasper)
+    planner = grasper.planner
+
+    def step(i):
+        (month, province), _ = planner.next()
+        key = ('SeatsQuery', month, province)
+        digest = grasper.pages.digest(key)
+        grasper.seize_seats(month, province)
+        planner.observe((month, province), grasper.pages.digest(key) != digest)
+        if i % 50 == 0:
+            grasper.trim_session()
+
+    return SoakRun(grasper, step, **kwargs)
+
+
+def course_soak(server, **kwargs):
+    """SoakRun of notify_change, as the loop of graspcourse.main_with_captcha."""
+    from graspcourse import CourseGrasper
+    from notify import Notifier
+
+    grasper = _quiet(CourseGrasper())
+    grasper.url_prefix = 'http://jw.nju.edu.cn/jiaowu/'
+    grasper.notifier = Notifier([], min_interval=0.)
+    server.attach(grasper)
+
+    def step(i):
+        grasper.notify_change()
+        if i % 50 == 0:
+            grasper.trim_session()
+
+    return SoakRun(grasper, step, teardown=grasper.notifier.close, **kwargs)
+
+
+SCENARIOS = {'toefl': (toefl_soak, 'toefl'), 'course': (course_soak, 'jw')}
+
+
+def soak(scenario, iterations=20000, every=500, warmup=0.5, rotate_cookies=0, out=None):
+    """Run a scenario of SCENARIOS against a fresh stand-in server, returns the SoakRun."""
+    from replay import StandInServer, load_exchanges, fixture_path
+
+    factory, fixtures = SCENARIOS[scenario]
+    server = StandInServer(load_exchanges(fixture_path(fixtures)), rotate_cookies=rotate_cookies).start()
+    try:
+        return factory(server, iterations=iterations, every=every, warmup=warmup).run(out)
+    finally:
+        server.stop()
+
+
+def test_soak():
+    import requests
+
+    class Scraper(object):
+        ses = requests.Session()
+
+    # a leak of a list per iteration; its memory may land in free heap the process already has,
+    # e.g. under a test runner, so the RSS is a metric of the soak runs rather than of this test
+    kept = []
+    run = SoakRun(Scraper(), lambda i: kept.append([' ' * 1024]), iterations=2000, every=200)
+    assert 'objects' in run.run().check(), run.growth()
+    assert abs(slope([(0, 1.), (1, 3.), (2, 5.)]) - 2.) < 1e-9
+    del kept[:]
+
+    for scenario in sorted(SCENARIOS):
+        run = soak(scenario, iterations=400, every=50)
+        assert not run.check({'rss_kb': 2048.}), (scenario, run.growth(), run.samples)
+
+    # the rotated cookies are dropped once expired by trim_session: in a run too short for
+    # a slope of the sawtooth of the jar, it still shrinks at some sample, without the trim
+    # it only grows whatever the speed of the run
+    run = soak('course', iterations=400, every=25, rotate_cookies=1)
+    cookies = [s.cookies for s in run.samples]
+    assert max(cookies) > 0 and any(b < a for a, b in zip(cookies, cookies[1:])), run.samples
+
+    print 'soak test passed'
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Soak test of the poll loops against the stand-in server.')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--every', type=int, default=500, help='iterations between two samples')
+    parser.add_argument('--warmup', type=float, default=0.5, help='part of the run left out of the growth')
+    parser.add_argument('--rotate-cookies', type=int, default=0,
+                        help='seconds of life of a cookie of a new name set by every response, 0 for none')
+    for probe, bound in sorted(DEFAULT_BOUNDS.items()):
+        parser.add_argument('--max-' + probe.replace('_', '-'), type=float, default=bound,
+                            help='growth per 1000 iterations, default {:g}'.format(bound))
+    args = parser.parse_args(argv)
+
+    # the loops print to stdout
+    run = soak(args.scenario, args.iterations, args.every, args.warmup, args.rotate_cookies, sys.stderr)
+    growth = run.growth()
+    failed = run.check(dict((probe, getattr(args, 'max_' + probe)) for probe in DEFAULT_BOUNDS))
+    for probe in sorted(growth):
+        sys.stderr.write('{:10s} {:+12.1f} per 1000 iterations{}\n'.format(probe, growth[probe],
+                                                                       '  LEAK' if probe in failed else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv[1:]))
+    test_soak()
@@ -0,0 +1,236 @@
+# encoding: utf-8
+
+"""
+Tuned transport of BaseWebScraping sessions.
+
+TunedAdapter is a requests HTTPAdapter with a pool size per host, default
+connect/read timeouts, retries with backoff for idempotent requests and
+counters of reused connections versus new TCP/TLS handshakes.
+
+"""
+import copy
+from time import time
+from urlparse import urlsplit
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from metrics import start_phases, add_phase, phase_total
+
+
+# encodings urllib3 can decode by itself
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')
+
+
+class TransportConfig(object):
+    """
+    Settings of the transport, read from the 'transport' entry of the config json.
+
+    Parameters
+    ----------
+    pool_connections : int, default 4
+        Number of hosts whose pool is kept.
+    pool_maxsize : int, default 4
+        Number of keep-alive connections per host.
+    connect_timeout, read_timeout : float
+        Seconds, used when a request does not set its own timeout.
+    retries : int, default 3
+        Retries of GET/HEAD/OPTIONS on connection errors and retry_statuses.
+        Requests of other methods are only retried when the connection failed
+        before anything was sent.
+    backoff_factor : float, default 0.5
+        Retries wait backoff_factor * 2 ** (n - 1) seconds.
+    retry_statuses : tuple of int
+    compress : bool, default True
+        Ask for gzip/deflate bodies.
+
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=4, connect_timeout=5., read_timeout=20.,
+                 retries=3, backoff_factor=0.5, retry_statuses=(502, 503, 504), compress=True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = tuple(retry_statuses)
+        self.compress = compress
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def replace(self, **kwargs):
+        res = copy.copy(self)
+        res.__dict__.update(kwargs)
+        return res
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+    def make_retry(self):
+        kwargs = dict(total=self.retries, connect=self.retries, read=self.retries,
+                      status=self.retries, backoff_factor=self.backoff_factor,
+                      status_forcelist=self.retry_statuses, raise_on_status=False)
+        idempotent = frozenset(['GET', 'HEAD', 'OPTIONS'])
+        try:
+            return Retry(allowed_methods=idempotent, **kwargs)
+        except TypeError:  # urllib3 < 1.26
+            return Retry(method_whitelist=idempotent, **kwargs)
+
+
+def accept_encoding(value):
+    """Keep only the encodings of an Accept-Encoding value we can decode, e.g. drop 'br'."""
+    kept = [e for e in (v.strip() for v in value.split(',')) if e.split(';')[0] in SUPPORTED_ENCODINGS]
+    return ', '.join(kept) or 'identity'
+
+
+class _TimedConnectionMixin(object):
+    """Report the time of new connections to the phase record of the current request."""
+
+    def _new_conn(self):
+        start = time()
+        try:
+            return super(_TimedConnectionMixin, self)._new_conn()
+        finally:
+            add_phase('connect', time() - start)
+
+    def connect(self):
+        # connect() = _new_conn() + TLS handshake for https
+        before = phase_total('connect')
+        start = time()
+        super(_TimedConnectionMixin, self).connect()
+        add_phase('tls', time() - start - (phase_total('connect') - before))
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = type('TimedHTTPConnection', (_TimedConnectionMixin, HTTPConnectionPool.ConnectionCls), {})
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = type('TimedHTTPSConnection', (_TimedConnectionMixin, HTTPSConnectionPool.ConnectionCls), {})
+
+
+def default_endpoint(url):
+    """Last component of the URL path without extension, e.g. 'courseList' for .../courseList.do"""
+    path = urlsplit(url).path.rstrip('/')
+    return path.rsplit('/', 1)[-1].split('.', 1)[0] or '/'
+
+
+class TunedAdapter(HTTPAdapter):
+    """
+    HTTPAdapter configured by a TransportConfig.
+
+    Parameters
+    ----------
+    config : TransportConfig, default None
+
+    Attributes
+    ----------
+    metrics : MetricsRegistry or None
+        Receives the phase timings of each request when set.
+    endpoint : callable
+        url -> endpoint label of the metrics.
+
+    """
+    def __init__(self, config=None, **kwargs):
+        self.transport_config = config or TransportConfig()
+        self.metrics = None
+        self.endpoint = default_endpoint
+        kwargs.setdefault('pool_connections', self.transport_config.pool_connections)
+        kwargs.setdefault('pool_maxsize', self.transport_config.pool_maxsize)
+        kwargs.setdefault('max_retries', self.transport_config.make_retry())
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool,
+                                                   'https': _TimedHTTPSConnectionPool}
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.transport_config.timeout
+        if self.metrics is None:
+            return HTTPAdapter.send(self, request, **kwargs)
+
+        endpoint = self.endpoint(request.url)
+        phases = start_phases()
+        start = time()
+        try:
+            res = HTTPAdapter.send(self, request, **kwargs)
+            headers_at = time()
+            if not kwargs.get('stream'):
+                res.content
+        except Exception as e:
+            self.metrics.record_error(endpoint, e)
+            raise
+        end = time()
+
+        phases['ttfb'] = headers_at - start - phases['connect'] - phases['tls']
+        if not kwargs.get('stream'):
+            phases['download'] = end - headers_at
+        phases['total'] = end - start
+        # streamed bodies are read later by the caller, their size is unknown here
+        wire_bytes = None
+        if not kwargs.get('stream'):
+            try:
+                wire_bytes = res.raw.tell()
+            except AttributeError:
+                wire_bytes = len(res.content)
+        self.metrics.record_request(endpoint, request.method, res.status_code, phases, wire_bytes)
+        return res
+
+    def connection_stats(self):
+        """
+        Counters of the live pools, pools dropped by the pool manager are not counted.
+
+        Returns
+        -------
+        stats : dict
+            'requests', 'new_connections' (TCP/TLS handshakes) and 'reused'.
+
+        """
+        pools = self.poolmanager.pools
+        requests = new = 0
+        for key in pools.keys():
+            pool = pools[key]
+            requests += pool.num_requests
+            new += pool.num_connections
+        return {'requests': requests, 'new_connections': new, 'reused': requests - new}
+
+
+def test_tuned_adapter():
+    from base import BaseWebScraping
+    from scheduler import RequestScheduler
+    from replay import replay, fixture_path
+
+    assert accept_encoding('gzip, deflate, br') == 'gzip, deflate'
+    assert accept_encoding('br') == 'identity'
+
+    config = TransportConfig.from_dict({'pool_maxsize': 2, 'read_timeout': 3.})
+    assert config.timeout == (5., 3.)
+    assert config.replace(pool_maxsize=8).pool_maxsize == 8 and config.pool_maxsize == 2
+    assert 'GET' in str(config.make_retry().__dict__)
+
+    scraper = BaseWebScraping()
+    scraper.scheduler = RequestScheduler(enabled=False)
+    scraper.transport_config = config
+    scraper.refresh_session()
+    assert scraper.headers['Accept-Encoding'] == 'gzip, deflate'
+    scraper.update_header({'Accept-Encoding': 'gzip, deflate, br'})
+    assert scraper.headers['Accept-Encoding'] == 'gzip, deflate'
+
+    server = replay(scraper, fixture_path('toefl'))
+    for _ in range(5):
+        scraper.ses.get('https://toefl.etest.net.cn/cn/MyHome/?')
+    server.stop()
+    stats = scraper.connection_stats()
+    assert stats['requests'] == 5 and stats['new_connections'] == 1 and stats['reused'] == 4, stats
+
+    print 'tuned adapter test passed'
+
+
+if __name__ == '__main__':
+    test_tuned_adapter()